@@ -3,7 +3,24 @@ import unittest
 # import json
 from lxml import etree
 import inklayers, inklayersExt
+import inklayers.server
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+import gzip
+import io
+import json
 import os
+import semantic_version
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import zipfile
+import zlib
+from functools import partial
 
 test_drawing_file = 'fishes.svg'
 config = {'output': {'filename': '%b-%n.%e', 'slides': [{'include': ['L0']}, {'include': ['L0', 'L1']}, {'include': ['#0-#2']}, {'include': ['#0-#3']}, {'include': ['#0-#4']}, {'include': ['#0-#5']}, {'exclude': ['L5 msg:greetings'], 'include': ['#0-#6']}, {'exclude': ['L5 msg:greetings'], 'include': ['#0-#7']}, {'exclude': ['L5 msg:greetings'], 'include': ['#0-#8']}, {'exclude': ['L5 msg:greetings'], 'include': ['#0-#9']}, {'exclude': ['L5 msg:greetings'], 'include': ['#0-#10']}, {'exclude': ['L5 msg:greetings'], 'include': ['#0-#11']}, {'exclude': ['L5 msg:greetings'], 'include': ['#0-#12']}, {'exclude': ['L5 msg:greetings', 'L12 msg:reply'], 'include': ['#0-#12']}], 'type': 'pdf'}, 'input': {'filename': 'fishes.svg'}}
@@ -124,6 +141,31 @@ class TestStringParser(unittest.TestCase):
         layers = inklayers.StringParser.get_filtered_layer_labels(labels, filters)
         self.assertEqual(layers, ['L0', 'L1', 'L2', 'L3', 'L4', 'L6'])
 
+    def test_layer_filtering_with_glob_selector(self):
+        labels = ['L0', 'L1', 'L5 msg:greetings', 'L6', 'L12 msg:reply']
+        filters = {'include': ['*msg:*']}
+        layers = inklayers.StringParser.get_filtered_layer_labels(labels, filters)
+        self.assertEqual(layers, ['L5 msg:greetings', 'L12 msg:reply'])
+        filters = {'include': ['#0-#4'], 'exclude': ['L? *']}
+        layers = inklayers.StringParser.get_filtered_layer_labels(labels, filters)
+        self.assertEqual(layers, ['L0', 'L1', 'L6', 'L12 msg:reply'])
+
+    def test_layer_filtering_with_regex_selector(self):
+        labels = ['background', 'step1', 'step2', 'step10', 'steps', 'notes']
+        filters = {'include': [r're:^step\d+$']}
+        layers = inklayers.StringParser.get_filtered_layer_labels(labels, filters)
+        self.assertEqual(layers, ['step1', 'step2', 'step10'])
+
+    def test_layer_filtering_with_invalid_regex(self):
+        with self.assertRaisesRegex(Exception, 'Config file format error: invalid regular expression'):
+            inklayers.StringParser.get_filtered_layer_labels(['step1'], {'include': ['re:(']})
+
+    def test_layer_filtering_exact_label_has_precedence(self):
+        labels = ['L0', 'L*', 'L2']
+        filters = {'include': ['L*']}
+        layers = inklayers.StringParser.get_filtered_layer_labels(labels, filters)
+        self.assertEqual(layers, ['L*'])
+
 
 # Tests the inclusion of a number into a list of intervals
     def _test_number(self, n, intervals, condition):
@@ -192,6 +234,18 @@ class TestStringParser(unittest.TestCase):
         results = inklayers.StringParser.filter_slide_data(layers)
         self.assertEqual(results, ['L1', 'L2', 'Name\\with backslash', 'L5'])
 
+    def test_parse_resolutions(self):
+        self.assertEqual(inklayers.StringParser.parse_resolutions('@1x:96,@2x:192'), {'@1x': 96.0, '@2x': 192.0})
+        self.assertEqual(inklayers.StringParser.parse_resolutions(['-thumb:24', ':96']), {'-thumb': 24.0, '': 96.0})
+        self.assertEqual(inklayers.StringParser.parse_resolutions({'@2x': 192}), {'@2x': 192.0})
+        self.assertEqual(inklayers.StringParser.parse_resolutions(300), {'': 300.0})
+        self.assertEqual(inklayers.StringParser.parse_resolutions(None), None)
+
+    def test_parse_types(self):
+        self.assertEqual(inklayers.StringParser.parse_types('pdf'), ['pdf'])
+        self.assertEqual(inklayers.StringParser.parse_types('pdf, png'), ['pdf', 'png'])
+        self.assertEqual(inklayers.StringParser.parse_types(['eps', 'png']), ['eps', 'png'])
+
 
 class TestSlideConfiguration(unittest.TestCase):
 
@@ -257,6 +311,26 @@ class TestSlideConfiguration(unittest.TestCase):
         layers = slideMade.get_labels()
         self.assertEqual(layers, ['L0', 'L1', 'L2', 'L3', 'L4', 'L6'])
 
+    def test_slide_resolutions(self):
+        conf = {'output': {'filename': '%b-%n.%e', 'type': 'png', 'resolutions': {'@1x': 96, '@2x': 192},
+                           'slides': [{'include': ['L0']}, {'include': ['L1'], 'resolutions': '-thumb:24,:96'}]}}
+        slideC = inklayers.SlideConfiguration(svg_file, conf, {})
+        self.assertEqual(slideC.slides[0].get_resolution_suffixes(), ['@2x', '@1x'])
+        self.assertEqual(slideC.slides[1].get_resolution_suffixes(), ['', '-thumb'])
+        slideC = inklayers.SlideConfiguration(svg_file, conf, {'type': 'pdf'})
+        self.assertEqual(slideC.slides[0].get_resolution_suffixes(), [''])
+
+    def test_slide_types(self):
+        conf = {'output': {'filename': '%b-%n.%e', 'type': ['pdf', 'png'], 'resolutions': {'@1x': 96, '@2x': 192},
+                           'slides': [{'include': ['L0']}, {'include': ['L1'], 'type': 'png,eps'}]}}
+        slideC = inklayers.SlideConfiguration(svg_file, conf, {})
+        self.assertEqual(slideC.slides[0].types, ['pdf', 'png'])
+        self.assertEqual(slideC.slides[0].get_latex_type(), 'pdf')
+        self.assertEqual(slideC.slides[0].get_resolution_suffixes('pdf'), [''])
+        self.assertEqual(slideC.slides[0].get_resolution_suffixes('png'), ['@2x', '@1x'])
+        self.assertEqual(slideC.slides[1].types, ['png', 'eps'])
+        self.assertEqual(slideC.slides[1].get_latex_type(), 'png')
+
     def test_layers_of_an_empty_slide(self):
         slideToMake = {}
         slideMade = self.slideConf.make_slide(slideToMake)
@@ -265,6 +339,196 @@ class TestSlideConfiguration(unittest.TestCase):
 
 
 
+class TestSlideGenerators(unittest.TestCase):
+
+    infile_path, infile = fileHandler.get_path_and_fullname('fishes.json')
+    svg, conf = fileHandler.load_input_file(infile)
+
+    def test_format_interval_string(self):
+        self.assertEqual(inklayers.StringParser.format_interval_string([0, 1, 2, 3]), '#0-#3')
+        self.assertEqual(inklayers.StringParser.format_interval_string([7, 0, 2, 3]), '#0,#2-#3,#7')
+        intervals = inklayers.StringParser.parse_interval_string('#0,#2-#3,#7')
+        self.assertEqual(inklayers.StringParser.format_interval_string(
+            [n for lower, upper in intervals for n in range(lower, upper + 1)]), '#0,#2-#3,#7')
+
+    def test_generators_match_explicit_slides(self):
+        # fishes3.* describe the slides of fishes.json with two generator entries
+        expected = [slide.get_labels() for slide in inklayers.SlideConfiguration(self.svg, self.conf, {}).slides]
+        for name in ['fishes3.json', 'fishes3.toml', 'fishes3.ini']:
+            svg, conf = fileHandler.load_input_file(fileHandler.get_path_and_fullname(name)[1])
+            slideC = inklayers.SlideConfiguration(svg, conf, {})
+            self.assertEqual([slide.get_labels() for slide in slideC.slides], expected, name)
+            self.assertEqual(slideC.slides[-1].filename, 'fishes-13.svg')
+
+    def test_generator_names_and_settings(self):
+        conf = {'output': {'type': 'pdf', 'filename': '%b-%n.%e', 'slides': [
+            {'name': 'reveal', 'stack': ['L1', '*msg:*'], 'base': 'L0', 'type': 'png'},
+            {'name': 'last', 'based-on': 'reveal-2', 'include': ['L3']}]}}
+        slideC = inklayers.SlideConfiguration(self.svg, conf, {})
+        self.assertEqual([slide.name for slide in slideC.slides], ['reveal-0', 'reveal-1', 'reveal-2', 'last'])
+        self.assertEqual([slide.type for slide in slideC.slides], ['png', 'png', 'png', 'pdf'])
+        self.assertEqual(slideC.slides[1].get_labels(), ['L0', 'L1', 'L5 msg:greetings'])
+        self.assertEqual(slideC.slides[3].get_labels(), ['L0', 'L1', 'L5 msg:greetings', 'L12 msg:reply', 'L3'])
+
+    def test_generator_include_is_added_to_base(self):
+        conf = {'output': {'type': 'pdf', 'filename': '%b-%n.%e', 'slides': [
+            {'stack': ['L1', '*msg:*'], 'base': 'L0', 'include': 'L3', 'exclude': 'L12 msg:reply'}]}}
+        slideC = inklayers.SlideConfiguration(self.svg, conf, {})
+        self.assertEqual([slide.get_labels() for slide in slideC.slides], [
+            ['L0', 'L1', 'L3'], ['L0', 'L1', 'L3', 'L5 msg:greetings'], ['L0', 'L1', 'L3', 'L5 msg:greetings']])
+
+
+class TestSVGFile(unittest.TestCase):
+
+    def test_filtered_obj_exact_label_match(self):
+        # 'L1' is a substring of 'L12 msg:reply', but only exact labels must be kept
+        root = svg_file.get_filtered_obj(['L12 msg:reply'])
+        labels = [inklayers.Layer.get_label_from_obj(x) for x in root if inklayers.Layer.is_layer(x)]
+        self.assertEqual(labels, ['L12 msg:reply'])
+
+    def test_attribute_selector(self):
+        layers = svg_file.get_filtered_labels({'include': ['@id=layer1?']})
+        self.assertEqual(layers, ['L9', 'L10', 'L11', 'L12 msg:reply'])
+        layers = svg_file.get_filtered_labels({'include': ['@inkscape:label=*msg:*']})
+        self.assertEqual(layers, ['L5 msg:greetings', 'L12 msg:reply'])
+
+    def test_selectors_are_cached(self):
+        svg = inklayers.SVGFile('fishes', svg_tree)
+        first = svg.index.select('msg:*')
+        self.assertIs(svg.index.select('msg:*'), first)
+
+    def test_pruned_obj(self):
+        svg = etree.fromstring(b'''<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"
+              xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+              xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd">
+            <defs>
+              <linearGradient id="base"><stop offset="0"/></linearGradient>
+              <linearGradient id="used" xlink:href="#base"/>
+              <filter id="unused"/>
+              <path id="shape" d="M 0,0 H 1"/>
+            </defs>
+            <sodipodi:namedview id="view"/>
+            <metadata id="meta"/>
+            <g inkscape:groupmode="layer" inkscape:label="A">
+              <rect id="r1" style="fill:url(#used)"/>
+              <rect id="r2" style="fill:red;display:none"/>
+              <use xlink:href="#hidden"/>
+              <rect id="hidden" style="display:none"/>
+            </g>
+            <g inkscape:groupmode="layer" inkscape:label="B"><use xlink:href="#shape"/></g>
+          </svg>''')
+        svg_test = inklayers.SVGFile('test', svg.getroottree())
+        root = svg_test.get_filtered_obj(['A'], prune=True)
+        ids = [e.get('id') for e in root.iter() if e.get('id') is not None]
+        self.assertEqual(ids, ['base', 'used', 'r1', 'hidden'])
+        root = svg_test.get_filtered_obj(['B'], prune=True)
+        ids = [e.get('id') for e in root.iter() if e.get('id') is not None]
+        self.assertEqual(ids, ['shape'])
+        # without pruning everything is kept
+        root = svg_test.get_filtered_obj(['B'])
+        self.assertEqual(len([e for e in root.iter() if e.get('id') is not None]), 6)
+
+    def test_filtered_obj_keeps_non_layer_content(self):
+        root = svg_file.get_filtered_obj([])
+        original = svg_tree.getroot()
+        self.assertEqual(root.attrib, original.attrib)
+        self.assertEqual(len(root), len([x for x in original if not inklayers.Layer.is_layer(x)]))
+
+    def test_slideshow_obj(self):
+        infile = fileHandler.get_path_and_fullname('fishes.json')[1]
+        svg, conf = fileHandler.load_input_file(infile)
+        slides = inklayers.SlideConfiguration(svg, conf, {}).slides
+        root, table = svg.get_slideshow_obj(slides)
+        layers = [x for x in root if inklayers.Layer.is_layer(x)]
+        # each layer is included once
+        self.assertEqual([inklayers.Layer.get_label_from_obj(x) for x in layers], svg.get_labels())
+        self.assertEqual(len(table), len(slides))
+        self.assertEqual(table[0], '#0')
+        self.assertEqual(table[-1], '#0-#4,#6-#11')
+        # the first slide is shown without the script
+        self.assertEqual([x.get('class') for x in layers[:2]], [None, 'inklayers-off'])
+        self.assertEqual([x.get('data-inklayer') for x in layers[:2]], ['0', '1'])
+
+    def test_slideshow_obj_inline_display(self):
+        # inkscape writes style="display:inline" on the layers, which beats a plain class rule
+        tree = etree.fromstring(
+            '<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape">'
+            '<g inkscape:groupmode="layer" inkscape:label="A" style="display:inline"><rect/></g>'
+            '<g inkscape:groupmode="layer" inkscape:label="B" style="display:inline"><rect/></g>'
+            '</svg>').getroottree()
+        svg = inklayers.SVGFile('test', tree)
+        conf = {'output': {'type': 'pdf', 'filename': '%b-%n.%e', 'slides': [{'include': ['A']}, {'include': ['A', 'B']}]}}
+        slides = inklayers.SlideConfiguration(svg, conf, {}).slides
+        root, table = svg.get_slideshow_obj(slides)
+        layers = [x for x in root if inklayers.Layer.is_layer(x)]
+        self.assertEqual([x.get('style') for x in layers], ['display:inline', 'display:inline'])
+        self.assertEqual(layers[1].get('class'), 'inklayers-off')
+        style = root.find('{http://www.w3.org/2000/svg}style').text
+        self.assertRegex(style, r'\.inklayers-off \{ display: none !important; \}')
+
+    def test_layer_stats(self):
+        tree = etree.fromstring(
+            '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+            'xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape">'
+            '<defs><filter id="b"><feGaussianBlur stdDeviation="2"/></filter><filter id="s"><feOffset/></filter></defs>'
+            '<g inkscape:groupmode="layer" inkscape:label="plain"><rect/><text>a<tspan>b</tspan></text></g>'
+            '<g inkscape:groupmode="layer" inkscape:label="effects"><rect style="fill:red;filter:url(#b)"/>'
+            '<rect filter="url(#s)" clip-path="url(#c)"/><image xlink:href="data:image/png;base64,AAAAAAAA"/></g>'
+            '</svg>').getroottree()
+        stats = inklayers.SVGFile('test', tree).get_layer_stats()
+        self.assertEqual([(x['index'], x['label'], x['elements'], x['texts']) for x in stats],
+                         [(0, 'plain', 4, 1), (1, 'effects', 4, 0)])
+        self.assertEqual([(x['filters'], x['blurs'], x['masks'], x['image_bytes']) for x in stats],
+                         [(0, 0, 0, 0), (2, 1, 1, 6)])
+        self.assertGreater(stats[1]['bytes'], stats[0]['bytes'])
+
+    def test_minify_svg(self):
+        root = etree.fromstring(
+            '<svg:svg xmlns:svg="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" '
+            'xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd" width="100.123456mm">\n  <!-- c -->\n'
+            '  <sodipodi:namedview id="base"/>\n  <svg:metadata id="m"/>\n'
+            '  <svg:g inkscape:groupmode="layer" id="layer1.5" style="stroke-width:0.26458333">\n'
+            '    <svg:path d="m 1.23456.5,-2.00049 h 1e-7"/>\n'
+            '    <svg:text> a <svg:tspan>b</svg:tspan> c</svg:text>\n  </svg:g>\n</svg:svg>')
+        root = inklayers.minify_svg(root, precision=2)
+        self.assertEqual(etree.tostring(root).decode(),
+                         '<svg xmlns="http://www.w3.org/2000/svg" width="100.12mm"><g id="layer1.5" style="stroke-width:0.26458333">'
+                         '<path d="m 1.23 0.5,-2 h 1e-7"/><text> a <tspan>b</tspan> c</text></g></svg>')
+        self.assertEqual(inklayers.round_decimals('translate(-0.001,12.5)', 0), 'translate(0,12)')
+        # the exponent belongs to its number
+        self.assertEqual(inklayers.round_decimals('1e-3.5', 0), '1e-3 0')
+        self.assertEqual(inklayers.round_decimals('2.5e-3,1.25E2', 1), '0,125')
+        # only the geometry is rounded, not the opacities and the stop offsets
+        root = inklayers.minify_svg(etree.fromstring(
+            '<svg xmlns="http://www.w3.org/2000/svg"><stop offset="0.35" style="stop-opacity:0.35"/>'
+            '<rect x="0.35" opacity="0.35"/></svg>'), precision=0)
+        self.assertEqual(etree.tostring(root).decode(), '<svg xmlns="http://www.w3.org/2000/svg">'
+                         '<stop offset="0.35" style="stop-opacity:0.35"/><rect x="0" opacity="0.35"/></svg>')
+        self.assertEqual(inklayers.export_types('svg,svgz'), ['svg', 'svgz'])
+
+    def test_rasterized_layers(self):
+        infile = fileHandler.get_path_and_fullname('fishes.json')[1]
+        svg, conf = fileHandler.load_input_file(infile)
+        slideConf = inklayers.SlideConfiguration(svg, conf, {'rasterize': ['L1', '#3']})
+        self.assertEqual(slideConf.get_rasterized_labels(), ['L1', 'L3'])
+        self.assertEqual(slideConf.rasterize_dpi, 300)
+        # the layer alone, with the definitions
+        root = svg.get_layer_obj('L1')
+        self.assertEqual([inklayers.Layer.get_label_from_obj(x) for x in root if inklayers.Layer.is_layer(x)], ['L1'])
+        slideConf.rasters['L1'] = 'data:image/png;base64,AAAA'
+        root = slideConf.slides[2].root
+        layers = [x for x in root if inklayers.Layer.is_layer(x)]
+        self.assertEqual([inklayers.Layer.get_label_from_obj(x) for x in layers], ['L0', 'L1', 'L2'])
+        images = layers[1].findall('{http://www.w3.org/2000/svg}image')
+        self.assertEqual(len(layers[1]), 1)
+        self.assertEqual(images[0].get('{http://www.w3.org/1999/xlink}href'), 'data:image/png;base64,AAAA')
+        self.assertEqual([images[0].get(a) for a in ['x', 'y', 'width']], ['0', '0', '551'])
+        self.assertEqual(layers[1].get('id'), svg.layers[1].id)
+        # no layer uses filters
+        slideConf = inklayers.SlideConfiguration(svg, conf, {'rasterize_filters': True})
+        self.assertEqual(slideConf.get_rasterized_labels(), [])
+
+
 class TestSlideConfiguration2(unittest.TestCase):
 
     infile_path, infile = fileHandler.get_path_and_fullname('fishes2.json')
@@ -299,6 +563,360 @@ class TestSlideConfiguration2(unittest.TestCase):
 
 
 
+class TestLibrary(unittest.TestCase):
+
+    def test_export_slides_in_memory(self):
+        conf = {'output': {'filename': '%b-%n.%e', 'type': 'svg', 'slides': config['output']['slides']}}
+        with open(test_drawing_file, 'rb') as f:
+            data = f.read()
+        slides = inklayers.export_slides(data, conf, basename='fishes')
+        filename, media_type, content = next(slides)
+        self.assertEqual((filename, media_type), ('fishes-00.svg', 'image/svg+xml'))
+        root = etree.fromstring(content)
+        self.assertEqual([inklayers.Layer.get_label_from_obj(x) for x in root if inklayers.Layer.is_layer(x)], ['L0'])
+        self.assertEqual(len(list(slides)), len(config['output']['slides']) - 1)
+        # the configuration passed by the caller is not modified
+        self.assertTrue(all('id' not in slide for slide in conf['output']['slides']))
+
+    def test_export_slides_from_tree_with_options(self):
+        conf = {'output': {'filename': '%b-%n.%e', 'type': 'svg', 'slides': []}}
+        slides = list(inklayers.export_slides(svg_tree, conf, {'stack': True, 'exclude': ['L0']}, basename='fishes'))
+        self.assertEqual(len(slides), len(svg_file.layers))
+        root = etree.fromstring(slides[1][2])
+        self.assertEqual([inklayers.Layer.get_label_from_obj(x) for x in root if inklayers.Layer.is_layer(x)], ['L1'])
+
+
+class TestExportScheduler(unittest.TestCase):
+
+    def test_run_measured(self):
+        usage = inklayers.run_measured('test', [sys.executable, '-c', 'pass'])
+        self.assertEqual(usage.name, 'test')
+        self.assertGreater(usage.wall, 0)
+        if hasattr(os, 'wait4'):
+            self.assertGreater(usage.maxrss, 0)
+        with self.assertRaises(subprocess.CalledProcessError):
+            inklayers.run_measured('test', [sys.executable, '-c', 'import sys; sys.exit(3)'])
+
+    def test_parallel_exports(self):
+        scheduler = inklayers.ExportScheduler('3')
+        for i in range(6):
+            scheduler.submit('job%d' % i, [sys.executable, '-c', 'pass'])
+        scheduler.wait()
+        self.assertEqual(sorted(u.name for u in scheduler.usages), ['job%d' % i for i in range(6)])
+        lines = scheduler.summary()
+        self.assertTrue(lines[0].startswith('Exports: 6'))
+        self.assertEqual(scheduler.usages, [])
+
+    def test_adaptive_limit(self):
+        scheduler = inklayers.ExportScheduler('auto')
+        self.assertEqual(scheduler.limit, 1)
+        available = inklayers.get_available_memory()
+        if available is None:
+            self.skipTest('available memory unknown')
+        # exports needing more than the available memory run one at a time
+        scheduler.usages = [inklayers.ResourceUsage('heavy', 1.0, 1.0, available * 2)]
+        scheduler.tune()
+        self.assertEqual(scheduler.limit, 1)
+        scheduler.usages = [inklayers.ResourceUsage('light', 1.0, 1.0, 1024)]
+        scheduler.tune()
+        self.assertEqual(scheduler.limit, scheduler.max_jobs)
+
+
+    def test_bbox_helpers(self):
+        self.assertEqual(inklayers.union_bbox([(0, 5, 10, 10), (-2, 6, 4, 12)]), (-2, 5, 10, 12))
+        self.assertEqual(inklayers.union_bbox([]), None)
+        root = etree.fromstring('<svg xmlns="http://www.w3.org/2000/svg" height="10mm" viewBox="0 0 20 10"/>')
+        self.assertAlmostEqual(inklayers.get_page_height(root), 37.795, 3)
+        root = etree.fromstring('<svg xmlns="http://www.w3.org/2000/svg" height="100%" viewBox="0 0 20 10"/>')
+        self.assertEqual(inklayers.get_page_height(root), 10.0)
+        self.assertEqual(inklayers.get_page_width(root), 20.0)
+
+    def test_stitch_png_bands(self):
+        # 4 x 9 RGB image in three bands, whose first rows use the Sub, Average and Paeth filters
+        raw = [bytes((x * 7 + y * 3 + c * 50) % 256 for x in range(4) for c in range(3)) for y in range(9)]
+        def filtered(row, filter_type):
+            if filter_type == 1:
+                return bytes([1]) + bytes((row[i] - (row[i - 3] if i >= 3 else 0)) % 256 for i in range(len(row)))
+            return bytes([filter_type]) + bytes((row[i] - ((row[i - 3] >> 1) if i >= 3 else 0)) % 256 for i in range(len(row)))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bands = []
+            for i, filter_type in enumerate([1, 3, 1]):
+                rows = raw[3 * i:3 * i + 3]
+                data = filtered(rows[0], filter_type) + b''.join(b'\x02' + bytes(len(rows[0])) for row in rows[1:])
+                idat = zlib.compress(data)
+                chunks = [(b'IHDR', struct.pack('>IIBBBBB', 4, 3, 8, 2, 0, 0, 0)), (b'pHYs', bytes(9)),
+                          (b'IDAT', idat[:5]), (b'IDAT', idat[5:]), (b'IEND', b'')]
+                bands.append(os.path.join(tmpdir, 'band%d.png' % i))
+                with open(bands[-1], 'wb') as f:
+                    f.write(inklayers.write_png_chunks(chunks))
+            out = os.path.join(tmpdir, 'out.png')
+            inklayers.stitch_png_bands(bands, out, chunk_size=16)
+            with open(out, 'rb') as f:
+                chunks = inklayers.read_png_chunks(f.read())
+        self.assertEqual(chunks[0], (b'IHDR', struct.pack('>IIBBBBB', 4, 9, 8, 2, 0, 0, 0)))
+        self.assertEqual([c[0] for c in chunks[1:3]] + [chunks[-1][0]], [b'pHYs', b'IDAT', b'IEND'])
+        data = zlib.decompress(b''.join(c[1] for c in chunks if c[0] == b'IDAT'))
+        rows = [data[i * 13:(i + 1) * 13] for i in range(9)]
+        # the first row of each band is not filtered, the others are kept as they are
+        self.assertEqual([rows[i] for i in (0, 3, 6)], [b'\x00' + raw[i] for i in (0, 3, 6)])
+        self.assertEqual(rows[1], b'\x02' + bytes(12))
+
+    def test_tile_bands(self):
+        bands = inklayers.get_tile_bands((0, 10, 100, 60), 200, 100, 200 * 40)
+        self.assertEqual([h for area, h in bands], [40, 40, 20])
+        self.assertEqual([area for area, h in bands][1], (0, 30, 100, 50))
+
+    def test_longest_first(self):
+        items = ['a', 'b', 'c', 'd', 'e']
+        durations = [1.0, 3.0, None, 5.0, 2.0]
+        self.assertEqual(inklayers.order_longest_first(items, durations), ['c', 'd', 'b', 'e', 'a'])
+        self.assertEqual(inklayers.order_longest_first(items, durations, 2), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(inklayers.estimate_wall_time([5, 3, 2, 1], 2), 6)
+        self.assertEqual(inklayers.estimate_wall_time([1, 2, 3, 5], 2), 7)
+        self.assertEqual(inklayers.estimate_wall_time([], 4), 0)
+
+    def test_timing_database(self):
+        scheduler = inklayers.ExportScheduler('2')
+        for i in range(3):
+            scheduler.submit('job%d' % i, [sys.executable, '-c', 'pass'], group='slide%d' % (i % 2))
+        scheduler.wait()
+        self.assertEqual(sorted(scheduler.group_times), ['slide0', 'slide1'])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            timings = inklayers.TimingDatabase(os.path.join(tmpdir, 'timings.sqlite'))
+            timings.record(scheduler.group_times)
+            timings.record({'slide1': 2.5})
+            timings.close()
+            timings = inklayers.TimingDatabase(os.path.join(tmpdir, 'timings.sqlite'))
+            self.assertEqual(timings.get('slide1'), 2.5)
+            self.assertGreater(timings.get('slide0'), 0)
+            self.assertIsNone(timings.get('slide2'))
+            timings.close()
+
+    def test_render_cache(self):
+        self.assertEqual(inklayers.parse_size('5G'), 5 << 30)
+        self.assertEqual(inklayers.parse_size('1.5k'), 1536)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            svg = os.path.join(tmpdir, 'slide.svg')
+            with open(svg, 'w') as f:
+                f.write('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+                        'width="1" height="2"><image xlink:href="pic.png"/></svg>')
+            data = inklayers.get_render_data(svg)
+            # the attributes are normalized, the linked files are part of the content
+            with open(svg, 'w') as f:
+                f.write('<svg xmlns:xlink="http://www.w3.org/1999/xlink" height="2"  width="1" '
+                        'xmlns="http://www.w3.org/2000/svg"><image xlink:href="pic.png"/></svg>')
+            self.assertEqual(inklayers.get_render_data(svg), data)
+            with open(os.path.join(tmpdir, 'pic.png'), 'wb') as f:
+                f.write(b'PNG')
+            self.assertNotEqual(inklayers.get_render_data(svg), data)
+            key = inklayers.RenderCache.get_key(data, 'png', 96, ' --export-area=0:0:1:2', '1.2.0')
+            self.assertNotEqual(key, inklayers.RenderCache.get_key(data, 'png', 96, ' --export-area=0:0:1:2', '1.3.0'))
+            self.assertEqual(key, inklayers.RenderCache.get_key(data, 'png', 96, '--export-area=0:0:1:2', '1.2.0'))
+            cache = inklayers.RenderCache(os.path.join(tmpdir, 'cache'), 25)
+            out = os.path.join(tmpdir, 'out.png')
+            self.assertFalse(cache.fetch(key, out))
+            for i, name in enumerate(['a', 'b', 'c']):
+                with open(out, 'wb') as f:
+                    f.write(name.encode() * 10)
+                cache.store('%02d%s' % (i, name), out)
+                os.utime(cache.entry_path('%02d%s' % (i, name)), (1000 + i, 1000 + i))
+            self.assertTrue(cache.fetch('00a', out))
+            with open(out, 'rb') as f:
+                self.assertEqual(f.read(), b'a' * 10)
+            # 'a' was used last, 'b' is the least recently used
+            self.assertEqual(cache.evict(), 1)
+            self.assertEqual(sorted(os.path.basename(e[2]) for e in cache.get_entries()), ['a', 'c'])
+            self.assertEqual((cache.hits, cache.misses, cache.bytes_saved), (1, 1, 10))
+
+    def test_raster_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = inklayers.RasterCache(os.path.join(tmpdir, 'rasters'), 25)
+            self.assertIsNone(cache.use('00a'))
+            png = os.path.join(tmpdir, 'layer.png')
+            for i, name in enumerate(['a', 'b', 'c']):
+                with open(png, 'wb') as f:
+                    f.write(name.encode() * 10)
+                cache.store('%02d%s' % (i, name), png)
+                os.utime(cache.entry_path('%02d%s' % (i, name)), (1000 + i, 1000 + i))
+            # the slides reference the entries by path
+            path = cache.use('00a')
+            self.assertEqual(path, os.path.join(tmpdir, 'rasters', '00', 'a.png'))
+            self.assertEqual(cache.evict(), 1)
+            self.assertEqual(sorted(os.path.basename(e[2]) for e in cache.get_entries()), ['a.png', 'c.png'])
+
+    def test_post_processing(self):
+        scheduler = inklayers.ExportScheduler('2')
+        done = []
+        for i in range(4):
+            scheduler.submit('job%d' % i, [sys.executable, '-c', 'pass'],
+                             after=partial(scheduler.post, done.append, i))
+        scheduler.wait()
+        self.assertEqual(sorted(done), [0, 1, 2, 3])
+
+    def test_recompress_png(self):
+        rows = b''.join(b'\x00' + bytes(range(i, i + 30)) for i in range(10))
+        chunks = [(b'IHDR', struct.pack('>IIBBBBB', 10, 10, 8, 2, 0, 0, 0)),
+                  (b'tEXt', b'Software\x00test'), (b'pHYs', bytes(9)),
+                  (b'IDAT', zlib.compress(rows, 0)[:20]), (b'IDAT', zlib.compress(rows, 0)[20:]), (b'IEND', b'')]
+        data = inklayers.write_png_chunks(chunks)
+        optimized = inklayers.optimize_png_data(data, palette=False)
+        self.assertLess(len(optimized), len(data))
+        chunks = inklayers.read_png_chunks(optimized)
+        self.assertEqual([c[0] for c in chunks], [b'IHDR', b'pHYs', b'IDAT', b'IEND'])
+        self.assertEqual(zlib.decompress(chunks[2][1]), rows)
+
+    @unittest.skipUnless(Image, 'Pillow not installed')
+    def test_palette_png(self):
+        image = Image.new('RGBA', (300, 200), (255, 0, 0, 255))
+        image.paste((0, 0, 255, 128), (0, 0, 100, 50))
+        out = io.BytesIO()
+        image.save(out, 'PNG', compress_level=1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'slide.png')
+            with open(filename, 'wb') as f:
+                f.write(out.getvalue())
+            before, after = inklayers.optimize_png(filename)
+            self.assertEqual(before, len(out.getvalue()))
+            self.assertLess(after, before)
+            self.assertEqual(os.path.getsize(filename), after)
+            with Image.open(filename) as optimized:
+                self.assertEqual(optimized.mode, 'P')
+                self.assertEqual(optimized.convert('RGBA').tobytes(), image.tobytes())
+
+    def test_exports_command(self):
+        exports = [('pdf', 'out/s.pdf', None), ('png', 'out/s.png', 192)]
+        command = inklayers.format_inkscape_exports_command('inkscape', semantic_version.Version('1.1.0'), 'out/s.svg', exports)
+        self.assertEqual(command, ['inkscape', 'out/s.svg',
+            "--actions=export-type:pdf;export-filename:out/s.pdf;export-do;export-type:png;export-dpi:192;export-filename:out/s.png;export-do"])
+        # the dpi of the png export does not persist for the pdf
+        command = inklayers.format_inkscape_exports_command('inkscape', semantic_version.Version('1.1.0'), 'out/s.svg',
+                                                            exports[::-1], '--export-dpi=120')
+        self.assertEqual(command[2], "--actions=export-type:png;export-dpi:192;export-filename:out/s.png;export-do;"
+                                     "export-type:pdf;export-dpi:120;export-filename:out/s.pdf;export-do")
+        command = inklayers.format_inkscape_exports_command('inkscape', semantic_version.Version('0.92.4'), 'out/s.svg', exports)
+        self.assertEqual(command, ['inkscape', '--export-pdf', 'out/s.pdf', '--export-png', 'out/s.png',
+                                           '--export-dpi=192', 'out/s.svg'])
+
+    def test_slide_actions(self):
+        slides = [(['a'], None, [('pdf', 's0.pdf', None)]),
+                  (['a', 'b', 'hidden'], '0:0:10:20', [('png', 's1.png', 192), ('pdf', 's1.pdf', None)]),
+                  (['c'], '0:0:10:20', [('pdf', 's2.pdf', None)])]
+        lines = inklayers.format_slide_actions(['a', 'b', 'c'], slides).splitlines()
+        self.assertEqual(lines, [
+            'select-by-id:b,c;object-set-property:display,none;select-clear;export-type:pdf;export-filename:s0.pdf;export-do;',
+            'select-by-id:b;object-set-property:display,inline;select-clear;export-area:0:0:10:20;'
+            'export-dpi:192;export-type:png;export-filename:s1.png;export-do;'
+            'export-dpi:96;export-type:pdf;export-filename:s1.pdf;export-do;',
+            'select-by-id:a,b;object-set-property:display,none;select-clear;'
+            'select-by-id:c;object-set-property:display,inline;select-clear;export-type:pdf;export-filename:s2.pdf;export-do;'])
+        tree = etree.fromstring(
+            '<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape">'
+            '<g inkscape:groupmode="layer" inkscape:label="L0" id="layer1" style="display:inline"/>'
+            '<g inkscape:groupmode="layer" inkscape:label="L1" id="layer2" style="display:none"/>'
+            '<g inkscape:groupmode="layer" inkscape:label="L2" id="layer3"/></svg>').getroottree()
+        svg = inklayers.SVGFile('test', tree)
+        self.assertEqual(svg.get_visible_layer_ids(), ['layer1', 'layer3'])
+
+    @unittest.skipUnless(Image, 'Pillow not installed')
+    def test_downsample_png(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'slide@2x.png')
+            Image.new('RGBA', (200, 100), (255, 0, 0, 255)).save(source)
+            targets = [(os.path.join(tmpdir, 'slide@1x.png'), 0.5), (os.path.join(tmpdir, 'slide-thumb.png'), 0.125)]
+            inklayers.downsample_png(source, targets)
+            with Image.open(targets[0][0]) as image:
+                self.assertEqual(image.size, (100, 50))
+            with Image.open(targets[1][0]) as image:
+                self.assertEqual(image.size, (25, 12))
+
+
+class TestServer(unittest.TestCase):
+
+    def test_parse_address(self):
+        self.assertEqual(inklayers.server.parse_address('8437')[1], ('127.0.0.1', 8437))
+        self.assertEqual(inklayers.server.parse_address('localhost:8437')[1], ('localhost', 8437))
+        self.assertEqual(inklayers.server.parse_address('/tmp/inklayers.sock')[1], '/tmp/inklayers.sock')
+
+    def test_extra_to_actions(self):
+        actions = inklayers.server.extra_to_actions(' --export-dpi=300 --export-area-drawing ')
+        self.assertEqual(actions, ['export-dpi:300', 'export-area-drawing'])
+        for extra in ['--without-gui', '--export-filename=/tmp/x', '--export-dpi 300', '--export-id="a;b"']:
+            with self.assertRaises(ValueError):
+                inklayers.server.extra_to_actions(extra)
+
+    def test_check_args(self):
+        inklayers.server.check_args({'infiles': ['/tmp/a.svg'], 'extra': '--export-dpi=300', 'verbosity': 1})
+        for args in [{'infiles': ['/tmp/a.svg'], 'unknown': 1},
+                     {'infiles': ['/tmp/a.svg'], 'inkscape': '/bin/sh'},
+                     {'infiles': ['/tmp/a.svg'], 'extra': '--export-dpi=96; touch /tmp/x'},
+                     ['/tmp/a.svg']]:
+            with self.assertRaises(ValueError):
+                inklayers.server.check_args(args)
+        # the arguments writing files outside the output folder of the project
+        inklayers.server.check_args({'infiles': ['/tmp/a.svg'], 'outfile': 'web/%b-%n.%e', 'archive': None})
+        for key, value in [('archive', '/tmp/out.zip'), ('archive', '-'), ('emit_ninja', '/tmp/build.ninja'),
+                           ('emit_make', '/tmp/Makefile'), ('render_cache', '/tmp/cache'), ('outfolder', '/tmp'),
+                           ('outfile', '/tmp/%n.%e'), ('outfile', '../../%n.%e')]:
+            with self.assertRaisesRegex(ValueError, 'render server|relative', msg=key):
+                inklayers.server.check_args({'infiles': ['/tmp/a.svg'], key: value})
+
+    def test_loopback_only(self):
+        self.assertTrue(inklayers.server.is_loopback('localhost'))
+        self.assertTrue(inklayers.server.is_loopback('127.0.0.1'))
+        self.assertTrue(inklayers.server.is_loopback('::1'))
+        self.assertFalse(inklayers.server.is_loopback('0.0.0.0'))
+        with self.assertRaises(ValueError):
+            inklayers.server.RenderServer('0.0.0.0:8437')
+
+    def test_svg_cache(self):
+        cache = inklayers.server.SVGCache(1)
+        loaded = []
+        def loader():
+            loaded.append(1)
+            return svg_file
+        cache.get(test_drawing_file, 'fishes', loader)
+        cache.get(test_drawing_file, 'fishes', loader)
+        self.assertEqual((len(loaded), cache.hits, cache.misses), (1, 1, 1))
+        # the least recently used file is evicted
+        cache.get('fishes2.json', 'fishes2', loader)
+        cache.get(test_drawing_file, 'fishes', loader)
+        self.assertEqual(len(loaded), 3)
+
+
+class TestStartup(unittest.TestCase):
+    """
+    Startup benchmark: the modules imported by the command line, read from 'python -X importtime'.
+    """
+    lazy_modules = ['semantic_version', 'pytoml', 'configparser', 'sqlite3']
+
+    def get_import_times(self, *args):
+        """
+        Returns the cumulative import time (us) of each module imported by 'inklayers *args*'.
+        """
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'inklayers'] + list(args),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        times = {}
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                self_time, cumulative, name = line[len('import time:'):].split('|')
+                if cumulative.strip().isdigit():
+                    times[name.strip()] = int(cumulative)
+        return times
+
+    def test_help_and_version(self):
+        for option in ['--help', '--version']:
+            times = self.get_import_times(option)
+            self.assertIn('inklayers.cli', times)
+            for name in ['lxml', 'inklayers.inklayers'] + self.lazy_modules:
+                self.assertNotIn(name, times)
+
+    def test_list(self):
+        times = self.get_import_times('fishes.json', '--list')
+        self.assertIn('inklayers.inklayers', times)
+        for name in self.lazy_modules:
+            self.assertNotIn(name, times)
+
+
 class TestSystem(unittest.TestCase):
 
     infile_path, infile = fileHandler.get_path_and_fullname('fishes.json')
@@ -314,6 +932,321 @@ class TestSystem(unittest.TestCase):
                  "#5: 'L5 msg:greetings'", "#6: 'L6'", "#7: 'L7'", "#8: 'L8'",
                  "#9: 'L9'", "#10: 'L10'", "#11: 'L11'", "#12: 'L12 msg:reply'"])
 
+    def test_report_layer_costs(self):
+        args = {'infiles': ['fishes.json'], 'inkscape': 'Default', 'exclude': None, 'stack': False,
+                'outfile': None, 'type': 'png', 'split': False, 'outfolder': None, 'add': None, 'extra': ' ',
+                'latex': False, 'verbosity': 0, 'debug': False}
+        shell = inklayers.InklayersShell(args)
+        shell.process_input_file(self.infile)
+        lines = shell.report_layer_costs(self.svg)
+        self.assertEqual(lines[0].split(), ['#', 'label', 'elements', 'bytes', 'image_bytes', 'filters',
+                                            'blurs', 'masks', 'texts', 'slides'])
+        self.assertEqual(lines[1].split()[:2] + lines[1].split()[-1:], ['#0', 'L0', '14'])
+        self.assertEqual(lines[13].split()[-1], '1')
+        stats = json.loads('\n'.join(shell.report_layer_costs(self.svg, 'json')))
+        self.assertEqual([x['slides'] for x in stats[:3]], [14, 13, 12])
+
+    def test_split_exports_each_layer_once(self):
+        args = {'infiles': ['fishes.json'], 'inkscape': 'Default', 'exclude': None, 'stack': True,
+                'outfile': None, 'type': 'png', 'split': True, 'outfolder': None, 'add': None, 'extra': ' ',
+                'latex': False, 'verbosity': 0, 'debug': False}
+        shell = inklayers.InklayersShell(args)
+        shell.process_input_file(self.infile)
+        exported = []
+        def fake_svg2file(slide, filename='slide'):
+            exported.append(filename)
+            base_name, ext = os.path.splitext(filename)
+            open(shell.infile_path + inklayers.output_subfolder + base_name + '.' + slide.type, 'w').close()
+        shell.svg2file = fake_svg2file
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shell.infile_path = tmpdir
+            shell.save_files()
+            self.assertEqual(len(exported), len(self.svg.layers))
+            # the last slide of the stack includes all the layers
+            last = shell.slideConf.slides[-1]
+            b = fileHandler.get_basename(last.filename)
+            for i in range(len(last.layers)):
+                self.assertTrue(os.path.exists(tmpdir + inklayers.output_subfolder + b + '-split-' + str(i) + '.png'))
+
+    def test_memory_sink(self):
+        args = {'infiles': ['fishes.json'], 'inkscape': 'Default', 'exclude': None, 'stack': False,
+                'outfile': None, 'type': 'png', 'split': False, 'outfolder': None, 'add': None, 'extra': ' ',
+                'latex': False, 'verbosity': 0, 'debug': False}
+        shell = inklayers.InklayersShell(args)
+        # the staging sinks store the files in their own way
+        self.assertRaises(TypeError, inklayers.StagingSink)
+        shell.output_sink = inklayers.MemorySink()
+        def fake_svg2file(slide, filename='slide'):
+            base_name, ext = os.path.splitext(slide.filename)
+            shell.get_sink().write(base_name + '.png', b'PNG')
+        shell.svg2file = fake_svg2file
+        shell.process_files()
+        files = shell.output_sink.files
+        shell.output_sink.close()
+        self.assertEqual(len(files), 2 * len(shell.slideConf.slides) + 1)
+        self.assertIn('fishes.inc.tex', files)
+        slide = shell.slideConf.slides[0]
+        self.assertTrue(files[slide.filename].startswith(b'<svg'))
+
+    def test_slideshow(self):
+        args = {'infiles': ['fishes.json'], 'inkscape': 'Default', 'exclude': None, 'stack': False,
+                'outfile': None, 'type': 'png', 'split': False, 'outfolder': None, 'add': None, 'extra': ' ',
+                'latex': False, 'verbosity': 0, 'debug': False}
+        for fmt, name in [('svg', 'fishes.slideshow.svg'), ('html', 'fishes.html')]:
+            args['slideshow'] = fmt
+            shell = inklayers.InklayersShell(args)
+            shell.output_sink = inklayers.MemorySink()
+            shell.process_files()
+            files = shell.output_sink.files
+            shell.output_sink.close()
+            self.assertEqual(list(files), [name])
+            self.assertEqual(files[name].count(b'inkscape:groupmode="layer"'), len(self.svg.layers))
+            self.assertIn(b'"#0-#4,#6-#11"]', files[name])
+
+    def test_several_types_exported_together(self):
+        args = {'infiles': ['fishes.json'], 'inkscape': 'Default', 'exclude': None, 'stack': False,
+                'outfile': None, 'type': ['png', 'pdf'], 'split': False, 'outfolder': None, 'add': None, 'extra': ' ',
+                'latex': False, 'verbosity': 0, 'debug': False}
+        shell = inklayers.InklayersShell(args)
+        shell.output_sink = inklayers.MemorySink()
+        shell.process_input_file(self.infile)
+        calls = []
+        def fake_run_exports(svg_file, exports, extra_args=None, after=None):
+            calls.append(exports)
+            for export_type, outfile, dpi in exports:
+                open(outfile, 'w').close()
+            after()
+        shell.run_exports = fake_run_exports
+        for slide in shell.slideConf.slides[:2]:
+            shell.svg2file(slide)
+        shell.print_latex_code(self.infile)
+        files = shell.output_sink.files
+        shell.output_sink.close()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual([(t, os.path.basename(o), dpi) for t, o, dpi in calls[0]],
+                         [('png', 'fishes-00.png', None), ('pdf', 'fishes-00.pdf', None)])
+        # the pdf files are preferred in LaTeX documents
+        self.assertIn(b'{fishes-00.pdf}', files['fishes.inc.tex'])
+
+    def test_export_areas(self):
+        args = {'infiles': ['fishes.json'], 'inkscape': 'Default', 'exclude': None, 'stack': False,
+                'outfile': None, 'type': 'png', 'split': False, 'outfolder': None, 'add': None, 'extra': ' ',
+                'latex': False, 'verbosity': 0, 'debug': False, 'crop': 'slide'}
+        shell = inklayers.InklayersShell(args)
+        shell.process_input_file(self.infile)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # fake inkscape answering the queries and counting its runs
+            shell._inkscape = (os.path.join(tmpdir, 'inkscape'), shell.version)
+            with open(shell.inkPath, 'w') as f:
+                f.write('#!%s\nimport sys\nopen(sys.argv[0] + ".runs", "a").write("x")\n'
+                        'print("WARNING: ignored line")\n'
+                        'for i in range(1, 13): print("layer%%d,%%d,%%d,10,5" %% (i, 10 * i, i))\n' % sys.executable)
+            os.chmod(shell.inkPath, 0o755)
+            environ = dict(os.environ)
+            os.environ['XDG_CACHE_HOME'] = tmpdir
+            try:
+                shell.set_export_areas()
+                first = [slide.area for slide in shell.slideConf.slides]
+                shell.slideConf.crop = 'deck'
+                shell.set_export_areas()
+            finally:
+                os.environ.clear()
+                os.environ.update(environ)
+            with open(shell.inkPath + '.runs') as f:
+                self.assertEqual(f.read(), 'x')
+        ids = [layer.id for layer in shell.slideConf.slides[1].layers]
+        self.assertEqual(ids, ['layer1', 'layer3'])
+        self.assertEqual(first[1], (10.0, 1.0, 40.0, 8.0))
+        self.assertEqual(shell.slideConf.slides[1].area, (10.0, 1.0, 130.0, 17.0))
+        self.assertEqual(shell.format_export_area((10, 1, 40, 8)), '--export-area=10:1:40:8')
+
+    def test_write_if_changed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sink = inklayers.DirectorySink(tmpdir)
+            path = sink.work_path('slide.inc.tex')
+            sink.write('slide.inc.tex', b'first')
+            os.utime(path, (1000, 1000))
+            sink.write('slide.inc.tex', b'first')
+            self.assertEqual((os.path.getmtime(path), sink.unchanged), (1000, 1))
+            sink.write('slide.inc.tex', b'other')
+            self.assertNotEqual(os.path.getmtime(path), 1000)
+            # exported PDF files differing only by the creation date are the same
+            pdf = b"%%PDF-1.5\n1 0 obj << /Creator (cairo) /CreationDate (D:%s+02'00) >>\nendobj\n"
+            sink.write('slide.pdf', pdf % b'20240101120000')
+            os.utime(sink.work_path('slide.pdf'), (1000, 1000))
+            with open(sink.new_path('slide.pdf'), 'wb') as f:
+                f.write(pdf % b'20250202130000')
+            sink.collect(['slide.pdf'])
+            self.assertEqual(os.path.getmtime(sink.work_path('slide.pdf')), 1000)
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['slide.inc.tex', 'slide.pdf'])
+            # a copy with the same content is not replaced
+            sink.copy('slide.pdf', 'copy.pdf')
+            sink.copy('slide.pdf', 'copy.pdf')
+            self.assertEqual(sink.unchanged, 3)
+
+    def test_reuse_renamed_slides(self):
+        args = {'inkscape': 'Default', 'exclude': None, 'stack': False, 'outfile': None, 'type': None,
+                'split': False, 'outfolder': None, 'add': None, 'extra': ' ', 'latex': False, 'verbosity': 0, 'debug': False}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shutil.copy('fishes.svg', tmpdir)
+            infile = os.path.join(tmpdir, 'deck.json')
+            def run(slides):
+                with open(infile, 'w') as f:
+                    json.dump({'input': {'filename': 'fishes.svg'},
+                               'output': {'type': 'pdf', 'filename': '%b-%n.%e',
+                                          'slides': [{'include': x} for x in slides]}}, f)
+                shell = inklayers.InklayersShell(dict(args, infiles=[infile]))
+                exported = []
+                def svg2file(slide, filename='slide'):
+                    exported.append(slide.filename)
+                    shell.get_sink().write(slide.filename[:-4] + '.pdf', ' '.join(slide.get_labels()).encode())
+                shell.svg2file = svg2file
+                shell.process_files()
+                return exported
+            def read(name):
+                with open(os.path.join(tmpdir, 'output', name)) as f:
+                    return f.read()
+            self.assertEqual(run([['L0'], ['L0', 'L1']]), ['fishes-0.svg', 'fishes-1.svg'])
+            # a slide inserted first: the other ones are renamed
+            self.assertEqual(run([['L3'], ['L0'], ['L0', 'L1']]), ['fishes-0.svg'])
+            self.assertEqual([read('fishes-%d.pdf' % i) for i in range(3)], ['L3', 'L0', 'L0 L1'])
+            self.assertIn('{fishes-2.pdf}', read('deck.inc.tex'))
+            self.assertEqual(run([['L3'], ['L0'], ['L0', 'L1']]), [])
+            # the files of the removed slides are removed, unless they were changed by other programs
+            with open(os.path.join(tmpdir, 'output', 'fishes-1.svg'), 'a') as f:
+                f.write('<!-- edited -->')
+            self.assertEqual(run([['L0', 'L1']]), [])
+            self.assertEqual(read('fishes-0.pdf'), 'L0 L1')
+            self.assertEqual(sorted(os.listdir(os.path.join(tmpdir, 'output'))),
+                             ['.deck.json.inklayers.json', 'deck.inc.tex', 'fishes-0.pdf', 'fishes-0.svg', 'fishes-1.svg'])
+            args['rebuild'] = True
+            self.assertEqual(run([['L0', 'L1']]), ['fishes-0.svg'])
+
+    def test_native_svg_types(self):
+        args = {'inkscape': '/nonexistent/inkscape', 'exclude': None, 'stack': False,
+                'outfile': '%b-web-%n.%e', 'type': ['svg', 'svgz'], 'split': False, 'outfolder': None, 'add': None,
+                'extra': ' ', 'latex': False, 'verbosity': 0, 'debug': False, 'minify': True, 'precision': 1}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ['fishes.svg', 'fishes.json']:
+                shutil.copy(name, tmpdir)
+            shell = inklayers.InklayersShell(dict(args, infiles=[os.path.join(tmpdir, 'fishes.json')]))
+            shell.process_files()
+            # inkscape is neither run nor verified
+            self.assertIsNone(shell._inkscape)
+            with open(os.path.join(tmpdir, 'output', 'fishes-web-03.svg'), 'rb') as f:
+                data = f.read()
+            with open(os.path.join(tmpdir, 'output', 'fishes-web-03.svgz'), 'rb') as f:
+                self.assertEqual(gzip.decompress(f.read()), data)
+        self.assertTrue(data.startswith(b'<svg xmlns="http://www.w3.org/2000/svg"'))
+        self.assertNotIn(b'inkscape:', data)
+        self.assertIn(b'viewBox="0 0 551 320.3"', data)
+
+    def test_rasterized_layers_next_to_outputs(self):
+        args = {'exclude': None, 'stack': False, 'outfile': None, 'type': 'pdf', 'split': False, 'outfolder': None,
+                'add': None, 'extra': ' ', 'latex': False, 'verbosity': 0, 'debug': False, 'rasterize': 'L0'}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ['fishes.svg', 'fishes.json']:
+                shutil.copy(name, tmpdir)
+            # fake inkscape writing the bitmaps
+            inkscape = os.path.join(tmpdir, 'inkscape')
+            with open(inkscape, 'w') as f:
+                f.write('#!%s\nimport sys\nopen(sys.argv[sys.argv.index("-o") + 1], "wb").write(b"PNG")\n' % sys.executable)
+            os.chmod(inkscape, 0o755)
+            environ = dict(os.environ)
+            os.environ['XDG_CACHE_HOME'] = os.path.join(tmpdir, 'cache')
+            try:
+                shell = inklayers.InklayersShell(dict(args, infiles=[os.path.join(tmpdir, 'fishes.json')]))
+                shell._inkscape = (inkscape, semantic_version.Version('1.1.0'))
+                shell.svg2file = lambda slide, filename='slide': None
+                shell.process_files()
+            finally:
+                os.environ.clear()
+                os.environ.update(environ)
+            output = os.path.join(tmpdir, 'output')
+            bitmaps = [x for x in os.listdir(output) if '.raster-' in x]
+            self.assertEqual(len(bitmaps), 1)
+            # the slides reference the bitmap next to them, not the one in the cache
+            with open(os.path.join(output, 'fishes-00.svg'), 'rb') as f:
+                self.assertIn(('href="%s"' % bitmaps[0]).encode(), f.read())
+            with open(os.path.join(output, bitmaps[0]), 'rb') as f:
+                self.assertEqual(f.read(), b'PNG')
+
+    def test_build_files(self):
+        args = {'infiles': ['fishes.json'], 'inkscape': 'Default', 'exclude': None, 'stack': False,
+                'outfile': None, 'type': ['pdf', 'png'], 'split': False, 'outfolder': None, 'add': None, 'extra': ' ',
+                'latex': False, 'verbosity': 0, 'debug': False, 'optimize': True}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            args['emit_ninja'] = os.path.join(tmpdir, 'build.ninja')
+            args['emit_make'] = os.path.join(tmpdir, 'Makefile')
+            shell = inklayers.InklayersShell(args)
+            shell.svg2file = lambda slide, filename='slide': self.fail('nothing is exported')
+            shell.process_files()
+            with open(args['emit_ninja']) as f:
+                ninja = f.read().splitlines()
+            with open(args['emit_make']) as f:
+                make = f.read().splitlines()
+        examples = os.path.relpath(os.getcwd(), tmpdir)
+        inputs = ' '.join(os.path.join(examples, x) for x in ['fishes.json', 'fishes.svg'])
+        outputs = ' '.join(os.path.join(examples, 'output', 'fishes-03.' + x) for x in ['svg', 'pdf', 'png'])
+        n = len(shell.slideConf.slides)
+        # one edge per slide, one for the LaTeX code
+        self.assertEqual(len([x for x in ninja if x.startswith('build ') and ': inklayers ' in x]), n + 1)
+        index = ninja.index('build %s: inklayers %s' % (outputs.replace(':', '$:'), inputs))
+        self.assertEqual(ninja[index + 1], '  args = %s 3 --type=pdf,png --optimize' % os.path.join(examples, 'fishes.json'))
+        self.assertIn('  restat = 1', ninja)
+        self.assertIn('build build.ninja: inklayers_regenerate %s' % inputs, ninja)
+        index = make.index('%s &: %s' % (outputs, inputs))
+        self.assertEqual(make[index + 1], '\t$(INKLAYERS) materialize %s 3 --type=pdf,png --optimize' % os.path.join(examples, 'fishes.json'))
+        self.assertEqual(make[3:4], ['.PHONY: inklayers'])
+
+    def test_materialize(self):
+        args = {'inkscape': 'Default', 'exclude': None, 'stack': False,
+                'outfile': None, 'type': 'pdf', 'split': False, 'outfolder': None, 'add': None, 'extra': ' ',
+                'latex': False, 'verbosity': 0, 'debug': False, 'materialize': '2'}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ['fishes.svg', 'fishes.json']:
+                shutil.copy(name, tmpdir)
+            args['infiles'] = [os.path.join(tmpdir, 'fishes.json')]
+            environ = dict(os.environ)
+            os.environ['XDG_CACHE_HOME'] = os.path.join(tmpdir, 'cache')
+            try:
+                shell = inklayers.InklayersShell(args)
+                exported = []
+                shell.svg2file = lambda slide, filename='slide': exported.append(slide.filename)
+                shell.process_files()
+                self.assertEqual(exported, [shell.slideConf.slides[2].filename])
+                self.assertTrue(os.path.exists(os.path.join(tmpdir, 'output', exported[0])))
+                args['materialize'] = '99'
+                with self.assertRaisesRegex(Exception, "Slide '99' not found: use an index from 0 to 13"):
+                    inklayers.InklayersShell(args).process_files()
+            finally:
+                os.environ.clear()
+                os.environ.update(environ)
+
+    def test_zip_archive(self):
+        args = {'infiles': ['fishes.json'], 'inkscape': 'Default', 'exclude': None, 'stack': True,
+                'outfile': None, 'type': 'pdf', 'split': True, 'outfolder': None, 'add': None, 'extra': ' ',
+                'latex': False, 'verbosity': 0, 'debug': False}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            args['archive'] = os.path.join(tmpdir, 'slides.zip')
+            shell = inklayers.InklayersShell(args)
+            def fake_svg2file(slide, filename='slide'):
+                base_name, ext = os.path.splitext(filename)
+                sink = shell.get_sink()
+                with open(sink.work_path(base_name + '.pdf'), 'wb') as f:
+                    f.write(b'PDF')
+                sink.collect([base_name + '.pdf'])
+            shell.svg2file = fake_svg2file
+            shell.process_files()
+            with zipfile.ZipFile(args['archive']) as z:
+                names = z.namelist()
+                last = shell.slideConf.slides[-1]
+                b = fileHandler.get_basename(last.filename)
+                self.assertEqual(z.read(b + '-split-0.pdf'), b'PDF')
+            self.assertIn('fishes.inc.tex', names)
+            self.assertEqual(len(names), len(set(names)))
+            self.assertEqual(os.listdir(tmpdir), ['slides.zip'])
+
     def test_extension_layer_parameters_no_filtering(self):
         # tests slide 11 of fishes.svg (using fishes.json as configuration)
         # default layers: ['L0', 'L1', 'L2', 'L3', 'L4', 'L6', 'L7', 'L8', 'L9', 'L10', 'L11']
@@ -355,6 +1288,71 @@ class TestSystem(unittest.TestCase):
         # exclude layers: 0,1,2,7,9  (exclusion is done afterwards, so #2 is removed)
         self.assertEquals(layers, ['L3', 'L4', 'L6', 'L8', 'L10', 'L11', 'L5 msg:greetings', 'L12 msg:reply'])
 
+    def test_extension_uses_opened_document(self):
+        # the slides are built from the document opened in inkscape, not from the file on disk
+        class ParserSimulator():
+            pass
+        options = ParserSimulator()
+        options.configFile = self.infile
+        options.typeExp = 'None'
+        options.namefmtExp = 'None'
+        options.addLayers = ''
+        options.excludeLayers = ''
+        root = fileHandler.get_etree(test_drawing_file).getroot()
+        root.remove([x for x in root if inklayers.Layer.is_layer(x)][-1])
+        sys = inklayersExt.InklayersExtension(options, root)
+        sys.process_input_file(sys.args.get('infiles'))
+        self.assertEqual(len(sys.slideConf.svg_file.layers), len(self.svg.layers) - 1)
+        self.assertTrue(sys.config_file_is_correct())
+        root.set('{http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd}docname', 'other.svg')
+        self.assertFalse(sys.config_file_is_correct())
+
+    def test_extension_background_job(self):
+        class ParserSimulator():
+            pass
+        options = ParserSimulator()
+        options.configFile = self.infile
+        options.typeExp = 'png'
+        options.namefmtExp = 'None'
+        options.addLayers = ''
+        options.excludeLayers = ''
+        sys = inklayersExt.InklayersExtension(options, self.svg.tree)
+        sys.process_input_file(sys.args.get('infiles'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sys.infile_path = tmpdir
+            job_file = sys.save_file()
+            self.assertEqual(inklayersExt.run_background_job(job_file, '2'), 0)
+            outpath = tmpdir + inklayersExt.output_subfolder
+            with open(outpath + 'fishes.log') as f:
+                log = f.read().splitlines()
+            self.assertEqual(len(log), len(sys.slideConf.slides) + 1)
+            self.assertTrue(log[-1].startswith('Done'))
+            self.assertTrue(os.path.exists(outpath + 'fishes-13.png'))
+            self.assertFalse(os.path.exists(job_file))
+
+    def test_extension_native_svg_types(self):
+        class ParserSimulator():
+            pass
+        options = ParserSimulator()
+        options.configFile = self.infile
+        options.typeExp = 'svgz'
+        options.namefmtExp = 'None'
+        options.addLayers = ''
+        options.excludeLayers = ''
+        sys = inklayersExt.InklayersExtension(options, self.svg.tree)
+        sys.process_input_file(sys.args.get('infiles'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sys.infile_path = tmpdir
+            job_file = sys.save_file()
+            # the svgz files are written directly, nothing is left to inkscape
+            with open(job_file) as f:
+                self.assertEqual(json.load(f)['exports'], [])
+            outpath = tmpdir + inklayersExt.output_subfolder
+            with open(outpath + 'fishes-13.svg', 'rb') as f:
+                data = f.read()
+            with open(outpath + 'fishes-13.svgz', 'rb') as f:
+                self.assertEqual(gzip.decompress(f.read()), data)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -9,11 +9,15 @@ By executing inklayers.py from a commandline more advanced options are avaiable.
 import os
 import inkex
 import sys
+import json
+import subprocess
+import time
 #sys.path.insert(0, 'C:/Users/Fabio/inklayers/')
 
 output_subfolder = '/output/'
 
-from inklayers import InklayersSystem
+from inklayers import InklayersSystem, SVGFile, SlideConfiguration, ExportScheduler, \
+    format_inkscape_command, get_inkscape
 
 
 class OptionHandler(inkex.Effect):
@@ -67,6 +71,8 @@ class OptionHandler(inkex.Effect):
 class InklayersExtension(InklayersSystem):
     """
     A version of Inklayers to be used as Inkscape extension.
+    The slides are built from the document opened in Inkscape, and the
+    conversions run in a background job so that Inkscape is not blocked.
     """
     def __init__(self, options, svg_root):
         InklayersSystem.__init__(self, self.parse_options(options))
@@ -88,64 +94,128 @@ class InklayersExtension(InklayersSystem):
         args['extra'] = ' '
         return args
 
+    def verify_inkscape(self):
+        """
+        Inkscape is verified by the background job, not while the editor waits.
+        """
+        return self.args.get('inkscape'), None
+
+    def process_input_file(self, infile):
+        """
+        Overrides the superclass version.
+        Loads the configuration file and builds the slides from the document
+        opened in Inkscape, without reading the svg file from disk.
+        """
+        self.infile_path, infile = self.fileHandler.get_path_and_fullname(infile)
+        self.svg_name, configFile = self.fileHandler.load_config(infile)
+        svg_tree = self.svg_root.getroottree() if hasattr(self.svg_root, 'getroottree') else self.svg_root
+        svg_file = SVGFile(self.fileHandler.get_basename(os.path.basename(self.svg_name)), svg_tree)
+        self.slideConf = SlideConfiguration(svg_file, configFile, self.filtered_arguments())
 
     def process_file(self):
         """
-        Uses the superclass method to process an input file.
+        Saves the slides of the opened document and starts the background job exporting them.
         """
         self.process_input_file(self.args.get('infiles'))
 
         if self.config_file_is_correct():
-            self.save_file()
+            job_file = self.save_file()
+            self.start_background_job(job_file)
         else:
             raise Exception("The config file doesn't refer to the currently opened file.")
 
     def config_file_is_correct(self):
         """
-        Verifies if the config file used is related to the currently opened file in Inkscape.
+        Verifies if the config file used is related to the currently opened file in Inkscape,
+        comparing the input file name of the config with the name of the document.
+        Unsaved documents have no name and are accepted.
         """
-        h1 = self.slideConf.svg_file.tree.getroot()
-        h2 = self.svg_root
-        if h1.tag == h2.tag and h1.attrib == h2.attrib and h1.tail == h2.tail:
+        docname = self.slideConf.svg_file.tree.getroot().get('{http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd}docname')
+        if docname is None:
             return True
-        else:
-            return False
-        #return etree.tostring(h1) == etree.tostring(h2)
-
+        return os.path.basename(docname) == os.path.basename(self.svg_name)
 
     def save_file(self):
         """
-        Save the slides to svg files before exporting.
+        Save the slides to svg files before exporting, the same way as the command line
+        (see save_svg): the svg and svgz types are written here, only the other types
+        are left to inkscape.
+        Returns the name of the job file listing the exports.
         """
-        from lxml import etree
+        outpath = self.infile_path + output_subfolder
+        os.makedirs(outpath, exist_ok=True)
+        exports = []
         for slide in self.slideConf.slides:
-            filename = self.infile_path + output_subfolder + slide.filename
-            command = etree.tostring(slide.root, pretty_print=True)
-            with open(filename, 'w') as f:
-                f.write(command)
-            inkex.errormsg(str(filename) + ' saved.')
-            self.svg2file(slide)
-
-
-    def svg2file(self, slide):
+            filename = outpath + slide.filename
+            self.save_svg(slide.filename, slide.root, slide.types)
+            base_name, ext = os.path.splitext(slide.filename)
+            for export_type in slide.types:
+                if export_type in slide.native_types:
+                    continue
+                exports.append({'type': export_type, 'svg_file': filename, 'outfile': outpath + base_name + '.' + export_type})
+        job_file = outpath + self.slideConf.svg_file.basefilename + '.job.json'
+        job = {'inkscape': self.args.get('inkscape'), 'extra': self.args.get('extra'), 'exports': exports,
+               'log': outpath + self.slideConf.svg_file.basefilename + '.log'}
+        with open(job_file, 'w') as f:
+            json.dump(job, f)
+        return job_file
+
+    def start_background_job(self, job_file):
         """
-        Launches the inkscape executable to export the slides in the desired format.
+        Starts a detached process running the exports, so that Inkscape is not blocked.
         """
-        outpath = self.infile_path + output_subfolder
-        svg_file = outpath + slide.filename
-        base_name, ext = os.path.splitext(slide.filename)
-        outfile = outpath + base_name + '.' + slide.type
-        command = self.inkPath + ' --export-' + slide.type + ' ' + outfile + ' ' + self.args.get('extra') + ' ' + svg_file
-        self.run(command, shell=True)
-        inkex.errormsg(str(outfile) + ' exported.')
+        kwargs = {'stdin': subprocess.DEVNULL, 'stdout': subprocess.DEVNULL, 'stderr': subprocess.DEVNULL}
+        if sys.platform == 'win32':
+            kwargs['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs['start_new_session'] = True
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), '--background-job', job_file], **kwargs)
+        with open(job_file) as f:
+            log = json.load(f)['log']
+        inkex.errormsg('%d slides saved. The export continues in the background, see %s for the progress.'
+                       % (len(self.slideConf.slides), log))
+
+
+def run_background_job(job_file, jobs='auto'):
+    """
+    Runs the exports listed in the job file, writing the progress to the log file of the job.
+    """
+    with open(job_file) as f:
+        job = json.load(f)
+    exports = job['exports']
+    start = time.monotonic()
+    with open(job['log'], 'w') as log:
+        def progress(msg, level):
+            if level > 1:
+                return
+            progress.done += 1
+            log.write('[%d/%d] %s\n' % (progress.done, len(exports), msg))
+            log.flush()
+        progress.done = 0
+        try:
+            inkPath, version = get_inkscape(job['inkscape'])
+            scheduler = ExportScheduler(jobs, progress)
+            for export in exports:
+                command = format_inkscape_command(inkPath, version, export['type'], export['svg_file'],
+                                                  export['outfile'], job['extra'])
+                scheduler.submit(os.path.basename(export['outfile']), command, stdout=subprocess.DEVNULL)
+            scheduler.wait()
+        except Exception as e:
+            log.write('Error: {}: {}\n'.format(type(e).__name__, e))
+            return 1
+        log.write('Done: %d files exported in %.1fs.\n' % (len(exports), time.monotonic() - start))
+    os.remove(job_file)
+    return 0
 
 
 if __name__ == '__main__':
 
+    if sys.argv[1:2] == ['--background-job']:
+        sys.exit(run_background_job(sys.argv[2]))
+
     try:
         e = OptionHandler()
         e.affect()
-        inkex.errormsg("The files have been exported.")
 
     except Exception as e:
         #import traceback
@@ -1,3 +1,26 @@
-from .inklayers import *
+"""
+The names of the inklayers module are imported when first used (see __getattr__),
+so that starting the command line does not load the export machinery.
+"""
+import importlib
+
 from .version import __version__
+from .cli import export_types, get_commandLine, get_parser, main
+
+
+def __getattr__(name):
+    if name == 'export_slides':
+        return importlib.import_module('.api', __name__).export_slides
+    module = importlib.import_module('.inklayers', __name__)
+    if name in globals():
+        # a submodule, set by its import
+        return globals()[name]
+    try:
+        return getattr(module, name)
+    except AttributeError:
+        raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name)) from None
+
 
+def __dir__():
+    module = importlib.import_module('.inklayers', __name__)
+    return sorted(set(globals()) | {name for name in dir(module) if not name.startswith('_')} | {'export_slides'})
@@ -0,0 +1,104 @@
+"""
+Library interface of inklayers.
+
+Exports slides from an in-memory SVG document without using the filesystem
+for the input, the configuration or the exported files.
+"""
+import gzip
+import os
+import shlex
+import subprocess
+import tempfile
+from lxml import etree
+
+from .inklayers import SVGFile, Slide, SlideConfiguration, get_inkscape, minify_svg
+from .png import optimize_png_data
+
+
+media_types = {
+    'svg': 'image/svg+xml',
+    'svgz': 'image/svg+xml',
+    'png': 'image/png',
+    'pdf': 'application/pdf',
+    'ps': 'application/postscript',
+    'eps': 'application/postscript',
+}
+
+
+def get_svg_tree(svg):
+    """
+    Returns an elementTree object from SVG bytes, an lxml element or an lxml tree.
+    """
+    if isinstance(svg, (bytes, str)):
+        if isinstance(svg, str):
+            svg = svg.encode('utf-8')
+        return etree.fromstring(svg).getroottree()
+    if isinstance(svg, etree._Element):
+        return svg.getroottree()
+    return svg
+
+
+def inkscape_export_bytes(inkPath, version, export_type, data, extra_args=''):
+    """
+    Exports the SVG document *data* (bytes) to *export_type* using inkscape.
+    Inkscape 1.x reads the document from stdin and writes the result to stdout.
+    Older versions use a private temporary folder.
+    Returns the exported bytes.
+    """
+    extra = shlex.split(extra_args) if extra_args else []
+    if version.major >= 1:
+        command = [inkPath, '--pipe', '--export-type={}'.format(export_type), '--export-filename=-'] + extra
+        result = subprocess.run(command, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return result.stdout
+    with tempfile.TemporaryDirectory() as tmpdir:
+        svg_file = os.path.join(tmpdir, 'slide.svg')
+        outfile = os.path.join(tmpdir, 'slide.' + export_type)
+        with open(svg_file, 'wb') as f:
+            f.write(data)
+        command = [inkPath, '--export-{}'.format(export_type), outfile] + extra + [svg_file]
+        subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        with open(outfile, 'rb') as f:
+            return f.read()
+
+
+def export_slides(svg, config, options=None, basename='slides', inkscape='Default', extra=''):
+    """
+    Lazily exports the slides of an SVG document.
+
+    *svg* is the document as bytes or as an lxml element/tree.
+    *config* is the slide configuration, with the same structure of the
+    JSON config files (the 'input' section is not used).
+    *options* overrides the configuration like the command line does
+    (keys: 'add', 'exclude', 'outfile', 'type', 'stack', 'prune', 'optimize', 'minify',
+    'precision'; 'add' and 'exclude' are lists).
+    *basename* replaces %b in the file names.
+
+    Yields a (filename, media_type, bytes) tuple for each slide and type, as soon as it is ready.
+    Slides of type 'svg' and 'svgz' (gzip compressed) are returned without running inkscape,
+    minified if requested (see minify_svg).
+    No state is shared between calls, so the function can be used concurrently.
+    """
+    svg_file = SVGFile(basename, get_svg_tree(svg))
+    slide_conf = SlideConfiguration(svg_file, config, dict(options or {}))
+    for slide in slide_conf.slides:
+        # build the slide tree here, so that only one slide at a time is kept in memory
+        root = svg_file.get_filtered_obj(slide.get_labels(), slide_conf.prune)
+        if set(slide.types) & set(Slide.native_types) and (slide_conf.minify or slide_conf.precision is not None):
+            root = minify_svg(root, slide_conf.minify, slide_conf.precision)
+        data = etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+        del root
+        base_name, ext = os.path.splitext(slide.filename)
+        for export_type in slide.types:
+            if export_type == 'svg':
+                yield slide.filename, media_types['svg'], data
+                continue
+            if export_type == 'svgz':
+                yield base_name + '.svgz', media_types['svgz'], gzip.compress(data, mtime=0)
+                continue
+            inkPath, version = get_inkscape(inkscape)
+            filename = base_name + '.' + export_type
+            media_type = media_types.get(export_type, 'application/octet-stream')
+            exported = inkscape_export_bytes(inkPath, version, export_type, data, extra)
+            if export_type == 'png' and slide_conf.optimize:
+                exported = optimize_png_data(exported)
+            yield filename, media_type, exported
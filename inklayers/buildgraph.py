@@ -0,0 +1,119 @@
+"""
+Build files of inklayers.
+
+Ninja and make files with one edge per slide, so that the build tools
+export again only the slides whose input changed.
+"""
+import os
+import shlex
+
+from .sinks import replace_if_changed
+
+
+def ninja_escape(path):
+    return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+
+def make_escape(path):
+    return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ').replace(':', '\\:')
+
+
+class BuildGraph:
+    """
+    Build file for Ninja or make, with one edge per slide.
+    Each edge runs 'inklayers materialize FILE SLIDE' to produce the files of the
+    slide, and depends on the input file and on its svg file. The build file
+    has also an edge regenerating it when the input files change.
+    Paths are stored absolute and written relative to the folder of the build file,
+    where the commands are run.
+    """
+    def __init__(self, command='inklayers'):
+        self.command = command
+        self.edges = [] # (outputs, inputs, slide, options)
+        self.regenerate = None # (infiles, options) of the command writing the build file
+
+    def add(self, outputs, inputs, slide, options):
+        """
+        Adds the edge producing *outputs* from *inputs*: the first input is the
+        input file of inklayers, *slide* the index of the slide (or 'latex').
+        """
+        self.edges.append(([os.path.abspath(x) for x in outputs], [os.path.abspath(x) for x in inputs], slide, options))
+
+    def write(self, path, fmt):
+        """
+        Writes the build file *path* in the format *fmt* ('ninja' or 'make').
+        The file is replaced only when its content changes.
+        """
+        folder = os.path.dirname(os.path.abspath(path))
+        data = self.format_ninja(path, folder) if fmt == 'ninja' else self.format_make(path, folder)
+        new = os.path.join(folder, '.new-' + os.path.basename(path))
+        with open(new, 'w') as f:
+            f.write(data)
+        replace_if_changed(new, path)
+
+    def get_regenerate_inputs(self):
+        inputs = []
+        for outputs, edge_inputs, slide, options in self.edges:
+            inputs += [x for x in edge_inputs if x not in inputs]
+        return inputs
+
+    def format_command(self, folder, config, slide, options):
+        rel = os.path.relpath(config, folder)
+        return ' '.join(shlex.quote(x) for x in [rel, str(slide)] + options)
+
+    def format_ninja(self, path, folder):
+        rel = lambda x: ninja_escape(os.path.relpath(x, folder))
+        lines = ['# Generated by inklayers, do not edit.',
+                 'inklayers = %s' % self.command.replace('$', '$$'),
+                 '',
+                 'rule inklayers',
+                 '  command = $inklayers materialize $args',
+                 '  description = inklayers $args',
+                 '  restat = 1',
+                 '']
+        if self.regenerate is not None:
+            lines += ['rule inklayers_regenerate',
+                      '  command = $inklayers $args',
+                      '  description = Regenerating $out',
+                      '  generator = 1',
+                      '  restat = 1',
+                      '',
+                      'build %s: inklayers_regenerate %s' % (rel(path), ' '.join(rel(x) for x in self.get_regenerate_inputs())),
+                      '  args = %s' % self.format_regenerate(path, folder, '--emit-ninja').replace('$', '$$'),
+                      '']
+        all_outputs = []
+        for outputs, inputs, slide, options in self.edges:
+            lines += ['build %s: inklayers %s' % (' '.join(rel(x) for x in outputs), ' '.join(rel(x) for x in inputs)),
+                      '  args = %s' % self.format_command(folder, inputs[0], slide, options).replace('$', '$$')]
+            all_outputs += outputs
+        lines += ['', 'build inklayers: phony %s' % ' '.join(rel(x) for x in all_outputs), '']
+        return '\n'.join(lines)
+
+    def format_make(self, path, folder):
+        # the outputs that are not changed keep their modification time: make needs them touched
+        rel = lambda x: make_escape(os.path.relpath(x, folder))
+        # the phony target comes first, as the default goal
+        all_outputs = [x for outputs, inputs, slide, options in self.edges for x in outputs]
+        lines = ['# Generated by inklayers, do not edit.',
+                 'INKLAYERS ?= %s' % self.command.replace('$', '$$'),
+                 '',
+                 '.PHONY: inklayers',
+                 'inklayers: %s' % ' '.join(rel(x) for x in all_outputs),
+                 '']
+        if self.regenerate is not None:
+            lines += ['%s: %s' % (rel(path), ' '.join(rel(x) for x in self.get_regenerate_inputs())),
+                      '\t$(INKLAYERS) %s' % self.format_regenerate(path, folder, '--emit-make').replace('$', '$$'),
+                      '\t@touch $@',
+                      '']
+        for outputs, inputs, slide, options in self.edges:
+            quoted = ' '.join(shlex.quote(os.path.relpath(x, folder)) for x in outputs)
+            lines += ['%s &: %s' % (' '.join(rel(x) for x in outputs), ' '.join(rel(x) for x in inputs)),
+                      '\t$(INKLAYERS) materialize %s' % self.format_command(folder, inputs[0], slide, options).replace('$', '$$'),
+                      '\t@touch %s' % quoted.replace('$', '$$'),
+                      '']
+        return '\n'.join(lines)
+
+    def format_regenerate(self, path, folder, flag):
+        infiles, options = self.regenerate
+        args = [os.path.relpath(x, folder) for x in infiles] + options + ['%s=%s' % (flag, os.path.relpath(path, folder))]
+        return ' '.join(shlex.quote(x) for x in args)
@@ -0,0 +1,253 @@
+"""
+Caches of inklayers.
+
+The render cache of the exported files, the cache of the rasterized layers
+and the database of the export durations, kept in the inklayers cache folder.
+"""
+import glob
+import hashlib
+import os
+import shlex
+import shutil
+import threading
+import time
+from functools import lru_cache, partial
+
+
+def get_cache_dir(*names):
+    """
+    Returns the path of a folder of the inklayers cache (created if needed).
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    path = os.path.join(base, 'inklayers', *names)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def parse_size(value):
+    """
+    Parses a size in bytes, with an optional K, M, G or T suffix (powers of 1024).
+    Example: '5G' -> 5368709120
+    """
+    value = value.strip().upper().rstrip('B')
+    factors = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if value and value[-1] in factors:
+        return int(float(value[:-1]) * factors[value[-1]])
+    return int(value)
+
+
+@lru_cache(maxsize=1024)
+def get_linked_file_digest(path, size, mtime_ns):
+    """
+    Returns the hash of a file linked by the slides, computed once for each
+    size and modification time of the file.
+    """
+    return get_file_digest(path)
+
+
+def get_file_digest(path, ignored=None):
+    """
+    Returns the hash of the file content, read in chunks.
+    The matches of the regular expression *ignored* are left out (the file is read by lines).
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if ignored is None:
+            for chunk in iter(partial(f.read, 1 << 16), b''):
+                digest.update(chunk)
+        else:
+            for line in f:
+                digest.update(ignored.sub(b'', line))
+    return digest.digest()
+
+
+class RenderCache:
+    """
+    Cache of the exported files, which can be shared by several projects (and machines,
+    on a shared filesystem). Each entry is a file named by its key, in a subfolder
+    named by the first two characters of the key.
+    The entries are written to a temporary file and renamed, so that they appear
+    atomically, and their modification time is updated when they are used: the least
+    recently used entries are evicted when the cache is larger than *max_size* bytes.
+    """
+    # the eviction leaves some room for the next entries
+    evict_ratio = 0.9
+    # temporary files older than this (seconds) were left by interrupted writes
+    stale_age = 3600
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def get_key(data, export_type, dpi, extra, version):
+        """
+        Returns the key of an export of the normalized svg content *data* (see get_render_data).
+        """
+        options = repr((export_type, dpi, shlex.split(extra or ''), str(version)))
+        return hashlib.sha256(data + options.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def fetch(self, key, dest):
+        """
+        Copies the entry *key* to the file *dest*. Returns False if it is not cached.
+        """
+        path = self.entry_path(key)
+        try:
+            shutil.copyfile(path, dest)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return False
+        try:
+            os.utime(path)
+        except OSError:
+            # read-only cache
+            pass
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += os.path.getsize(dest)
+        return True
+
+    def store(self, key, source):
+        """
+        Adds the file *source* to the cache as the entry *key*.
+        """
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.tmp-%d-%d' % (path, os.getpid(), threading.get_ident())
+        try:
+            shutil.copyfile(source, tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        with self.lock:
+            self.stored += 1
+
+    def get_entries(self):
+        """
+        Returns the (modification time, size, path) of the entries.
+        Temporary files left by interrupted writes are removed.
+        """
+        entries = []
+        now = time.time()
+        for folder in glob.glob(os.path.join(glob.escape(self.path), '??')):
+            for entry in os.scandir(folder):
+                try:
+                    st = entry.stat()
+                    if '.tmp-' in entry.name:
+                        if now - st.st_mtime > self.stale_age:
+                            os.remove(entry.path)
+                        continue
+                except FileNotFoundError:
+                    # removed by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used entries if the cache is larger than its size.
+        Returns the number of entries removed.
+        """
+        entries = sorted(self.get_entries())
+        total = sum(size for mtime, size, path in entries)
+        if total <= self.max_size:
+            return 0
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= self.max_size * self.evict_ratio:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def format_stats(self):
+        """
+        Returns the lines reporting the use of the cache and its content.
+        """
+        entries = self.get_entries()
+        return ['Render cache: %d hits, %d misses, %s not rendered' %
+                (self.hits, self.misses, format_size(self.bytes_saved)),
+                'Render cache %s: %d entries, %s of %s' %
+                (self.path, len(entries), format_size(sum(e[1] for e in entries)), format_size(self.max_size))]
+
+
+def format_size(size):
+    for unit in ['bytes', 'KiB', 'MiB', 'GiB']:
+        if size < 1024 or unit == 'GiB':
+            return ('%d %s' if unit == 'bytes' else '%.1f %s') % (size, unit)
+        size /= 1024
+
+
+class TimingDatabase:
+    """
+    Durations of the previous exports of the slides, kept in a SQLite database
+    and keyed by the hash of the slide content and of its export options.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        import sqlite3
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS timings '
+                                    '(key TEXT PRIMARY KEY, wall REAL NOT NULL, updated REAL NOT NULL)')
+
+    def get(self, key):
+        """
+        Returns the last measured duration of the export *key* (seconds), None if unknown.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT wall FROM timings WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, durations):
+        """
+        Stores the *durations* {key: seconds}.
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO timings (key, wall, updated) VALUES (?, ?, ?)',
+                                        [(key, wall, now) for key, wall in durations.items()])
+
+    def close(self):
+        self.connection.close()
+
+
+class RasterCache(RenderCache):
+    """
+    Cache of the bitmaps of the rasterized layers (see InklayersShell.rasterize_layers).
+    The slides reference the entries, which have the .png extension.
+    """
+    def entry_path(self, key):
+        return RenderCache.entry_path(self, key) + '.png'
+
+    def use(self, key):
+        """
+        Returns the path of the entry *key*, marked as used, or None if it is not cached.
+        """
+        path = self.entry_path(key)
+        if not os.path.isfile(path):
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # read-only cache
+            pass
+        with self.lock:
+            self.hits += 1
+        return path
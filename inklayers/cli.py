@@ -0,0 +1,150 @@
+"""
+Command line of inklayers.
+
+Only the modules needed to parse the command line are imported at startup:
+the export machinery is imported once the arguments are parsed, so that
+--help and --version answer quickly.
+"""
+import argparse
+import os
+import sys
+
+from .version import __version__
+
+
+def export_types(value):
+    """
+    Parses the export types of the command line (e.g. "pdf,png").
+    """
+    from .inklayers import StringParser
+    types = StringParser.parse_types(value)
+    for export_type in types:
+        if export_type not in ['png', 'ps', 'eps', 'pdf', 'svg', 'svgz']:
+            raise argparse.ArgumentTypeError("invalid export type: '%s' (choose from png, ps, eps, pdf, svg, svgz)" % export_type)
+    return types
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='''Exports combinations of layers from an SVG file to various formats (PDF, PNG, etc.).''',
+                                     usage="%(prog)s [-h] infiles+ [options]",
+    )
+
+    p_add = parser.add_argument
+    p_add('--version', action='version', version='%(prog)s ' + __version__)
+    p_add('infiles', nargs='+',
+          help='SVG, JSON or TOML file, wildcards supported')
+    p_add('-a', '--add', action='append', default=None,
+          help='Add layers to export. Use labels or indexes.')
+    p_add('-e', '--exclude', action='append', default=None,
+          help='Use label or index to determine which objects to exclude from export')
+    p_add('-o', '--outfile', action='store', default='%b-%n.%e',
+          help='Output file format. See documentation for possible formats.')
+    p_add('-i', '--inkscape', action='store', default='Default',
+          help='Path to inkscape command line executable')
+    p_add('-t', '--type', action='store', default=None, type=export_types,
+          help='Export type (and suffix): png, ps, eps or pdf, or several comma separated types exported together (e.g. "pdf,png"). '
+               'svg and svgz are written without inkscape. See Inkscape --help for supported formats.')
+    p_add('-r', '--resolutions', action='store', default=None,
+          help='PNG resolutions as suffix:dpi pairs (e.g. "@1x:96,@2x:192"). Rendered once at the highest one.')
+    p_add('-X', '--extra', action='store', metavar='Inkscape_Export_Options', default=' ',
+          help='Extra options passed through (literally) to inkscape for export. See Inkscape --help for more.')
+    p_add('-D', '--debug', action='store_true', default=False,
+          help='Generates (very) verbose output.')
+    p_add('--crop', action='store', default=None, choices=['slide', 'deck'],
+          help='Crop the PNG exports to the bounding box of the layers of each slide, or of all the slides of the deck.')
+    p_add('--tile-size', action='store', type=int, default=None, metavar='PIXELS',
+          help='Render the PNG exports larger than PIXELS x PIXELS in bands of about that size, in parallel (see -j), and stitch them.')
+    p_add('--rasterize', action='store', default=None, metavar='LAYERS',
+          help='Render the static layers LAYERS (labels or selectors, comma separated) once to a bitmap, used by all the slides.')
+    p_add('--rasterize-filters', action='store_true', default=False,
+          help='Render once to a bitmap the layers using filters (blurs, shadows, ...).')
+    p_add('--rasterize-dpi', action='store', type=float, default=None, metavar='DPI',
+          help='Resolution of the bitmaps of the rasterized layers (default 300).')
+    p_add('--raster-cache-size', action='store', default='1G', metavar='SIZE',
+          help='Maximum size of the cache of the bitmaps of the rasterized layers (e.g. 500M, 1G). '
+               'The least recently used bitmaps are evicted.')
+    p_add('-p', '--prune', action='store_true', default=False,
+          help='Remove the unused definitions, the hidden content and the editor data from the slides.')
+    p_add('--minify', action='store_true', default=False,
+          help='Remove the editor data (Inkscape and Sodipodi attributes, metadata) from the svg and svgz slides.')
+    p_add('--precision', action='store', type=int, default=None, metavar='DIGITS',
+          help='Round the decimal numbers of the svg and svgz slides to DIGITS decimal places.')
+    p_add('--optimize', action='store_true', default=False,
+          help='Losslessly optimize the exported PNG files: no metadata, better compression, palette when possible.')
+    p_add('-l', '--list', action='store_true', default=False,
+          help='List the available layers.')
+    p_add('--report-layers', nargs='?', const='table', default=None, choices=['table', 'json'],
+          help='Print the statistics of the layers (elements, size, images, filters, masks, texts, slides using them) as a table or JSON.')
+    p_add('--measure', action='store_true', default=False,
+          help='With --report-layers, render each layer alone and report its time.')
+    p_add('-v', '--verbosity', action='count', default=0,
+          help='Verbosity level.')
+    p_add('-out', '--outfolder', action='store', default=None)
+    p_add('--archive', action='store', default=None, metavar='ARCHIVE',
+          help='Write all the output files to a .zip, .tar or .tar.gz archive instead of the output folder ("-" for a tar stream on stdout).')
+    p_add('--slideshow', action='store', default=None, choices=['svg', 'html'],
+          help='Write all the slides to a single SVG or HTML slideshow, with each layer included once.')
+    p_add('--single-run', action='store_true', default=False,
+          help='Export all the slides of an input file with one inkscape run, which loads the input file once and '
+               'shows the layers of each slide with actions (Inkscape 1.2 or later).')
+    p_add('-j', '--jobs', action='store', default='1',
+          help='Number of parallel exports, or "auto" to adapt it to the memory used by the exports.')
+    p_add('--emit-ninja', action='store', default=None, metavar='FILE',
+          help='Write a Ninja build file with one edge per slide instead of exporting the slides.')
+    p_add('--emit-make', action='store', default=None, metavar='FILE',
+          help='Write a makefile with one rule per slide instead of exporting the slides.')
+    p_add('--materialize', action='store', default=None, metavar='SLIDE',
+          help='Save and export only the slide SLIDE (index from 0), or the LaTeX code with "latex". See "%(prog)s materialize".')
+    p_add('--rebuild', action='store_true', default=False,
+          help='Export all the slides, even the ones whose files can be reused from the previous run.')
+    p_add('--render-cache', action='store', default=os.environ.get('INKLAYERS_RENDER_CACHE'), metavar='DIR',
+          help='Folder of the cache of the exported files, which can be shared by several projects '
+               '(default: $INKLAYERS_RENDER_CACHE, if set).')
+    p_add('--render-cache-size', action='store', default='5G', metavar='SIZE',
+          help='Maximum size of the render cache (e.g. 500M, 5G). The least recently used files are evicted.')
+    p_add('--cache-stats', action='store_true', default=False,
+          help='Print the hits and misses of the render cache and its size.')
+    p_add('--preview', action='store', type=int, default=0, metavar='N',
+          help='Export the first N slides before the others. The others are exported longest first.')
+    p_add('--estimate', action='store_true', default=False,
+          help='Print the export time estimated from the previous exports, without exporting.')
+    p_add('--client', action='store_true', default=False,
+          help='Send the command to a running render server (started with "%(prog)s serve").')
+    p_add('--address', action='store', default=None,
+          help='Address of the render server: Unix socket path, port or host:port.')
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-s', '--stack', action='store_true', default=False,
+                       help='Export all layers in stacked mode. Use -e to exclude some layers.')
+    group.add_argument('-S', '--split', action='store_true', default=False,
+                       help='Export all layers, split one layer per output file. Use -e to exclude some layers.')
+    return parser
+
+
+def get_commandLine():
+    c_line = get_parser().parse_args()
+    d = vars(c_line)
+    return d
+
+
+def main():
+    # the render server has its own command line
+    if sys.argv[1:2] == ['serve']:
+        from .server import serve_main
+        serve_main(sys.argv[2:])
+        return
+    # 'inklayers materialize FILE SLIDE [options]' is used by the build files
+    if sys.argv[1:2] == ['materialize']:
+        sys.argv[1:] = sys.argv[2:3] + ['--materialize'] + sys.argv[3:]
+    # load command line arguments, initialize system
+    args = get_commandLine()
+    if args.get('client'):
+        from .server import run_client
+        sys.exit(run_client(args))
+    from .inklayers import InklayersShell
+    prog = InklayersShell(args)
+    prog.fix_wildcard_names()
+    # process input files & export/save
+    prog.process_files()
+
@@ -9,60 +9,65 @@ Export any combination of SVG layers to files.
 import subprocess
 import sys
 import os
+import shlex
 from lxml import etree
-import argparse
-import pathlib
-import semantic_version
 import glob
+import gzip
 import re
 import json
-import pytoml as toml
-import configparser
+import fnmatch
+import hashlib
+import html
+import importlib.util
+import tempfile
+import threading
+from collections import Counter
 from copy import deepcopy
+from functools import lru_cache, partial
 from math import log10
 
+# the names of the modules split from this one are still available here
+from .buildgraph import BuildGraph, make_escape, ninja_escape
+from .cache import RasterCache, RenderCache, TimingDatabase, format_size, get_cache_dir, get_file_digest, \
+    get_linked_file_digest, parse_size
+from .png import downsample_png, optimize_png, optimize_png_data, palette_png, read_png_chunks, recompress_png, \
+    stitch_png_bands, write_png_chunks
+from .scheduler import ExportScheduler, ResourceUsage, estimate_wall_time, get_available_memory, \
+    order_longest_first, run_measured
+from .sinks import ArchiveSink, DirectorySink, MemorySink, OutputManifest, StagingSink, replace_if_changed, \
+    same_content
+
 
 # The subfolder used to save/export files. It's relative to the input file.
 output_subfolder = '/output/'
 
-def get_commandLine():
-    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
-                                     description='''Exports combinations of layers from an SVG file to various formats (PDF, PNG, etc.).''',
-                                     usage="%(prog)s [-h] infiles+ [options]",
-    )
-
-    p_add = parser.add_argument
-    p_add('infiles', nargs='+',
-          help='SVG, JSON or TOML file, wildcards supported')
-    p_add('-a', '--add', action='append', default=None,
-          help='Add layers to export. Use labels or indexes.')
-    p_add('-e', '--exclude', action='append', default=None,
-          help='Use label or index to determine which objects to exclude from export')
-    p_add('-o', '--outfile', action='store', default='%b-%n.%e',
-          help='Output file format. See documentation for possible formats.')
-    p_add('-i', '--inkscape', action='store', default='Default',
-          help='Path to inkscape command line executable')
-    p_add('-t', '--type', action='store', default=None, choices=['png', 'ps', 'eps', 'pdf'],
-          help='Export type (and suffix). pdf by default. See Inkscape --help for supported formats.')
-    p_add('-X', '--extra', action='store', metavar='Inkscape_Export_Options', default=' ',
-          help='Extra options passed through (literally) to inkscape for export. See Inkscape --help for more.')
-    p_add('-D', '--debug', action='store_true', default=False,
-          help='Generates (very) verbose output.')
-    p_add('-l', '--list', action='store_true', default=False,
-          help='List the available layers.')
-    p_add('-v', '--verbosity', action='count', default=0,
-          help='Verbosity level.')
-    p_add('-out', '--outfolder', action='store', default=None)
-
-    group = parser.add_mutually_exclusive_group()
-    group.add_argument('-s', '--stack', action='store_true', default=False,
-                       help='Export all layers in stacked mode. Use -e to exclude some layers.')
-    group.add_argument('-S', '--split', action='store_true', default=False,
-                       help='Export all layers, split one layer per output file. Use -e to exclude some layers.')
-    c_line = parser.parse_args()
-    d = vars(c_line)
-    return d
-
+# Shows one slide of a slideshow at a time (arrow keys, page keys, space or click).
+# The slides are interval strings of the indexes of the layers (data-inklayer attribute) they show.
+slideshow_script = """(function () {
+  var slides = %s, current = 0;
+  var layers = document.querySelectorAll('[data-inklayer]');
+  function show(n) {
+    current = Math.max(0, Math.min(slides.length - 1, n));
+    var on = {};
+    slides[current].split(',').forEach(function (s) {
+      if (!s) return;
+      var r = s.split('-'), b = +(r[1] || r[0]).slice(1);
+      for (var i = +r[0].slice(1); i <= b; i++) on[i] = true;
+    });
+    for (var i = 0; i < layers.length; i++)
+      layers[i].classList.toggle('inklayers-off', !on[layers[i].getAttribute('data-inklayer')]);
+    history.replaceState(null, '', '#' + current);
+  }
+  document.addEventListener('keydown', function (e) {
+    if (['ArrowRight', 'ArrowDown', 'PageDown', ' '].indexOf(e.key) >= 0) show(current + 1);
+    if (['ArrowLeft', 'ArrowUp', 'PageUp'].indexOf(e.key) >= 0) show(current - 1);
+    if (e.key == 'Home') show(0);
+    if (e.key == 'End') show(slides.length - 1);
+  });
+  document.addEventListener('click', function () { show(current + 1); });
+  show(parseInt(location.hash.slice(1)) || 0);
+})();
+"""
 
 class StringParser:
     """
@@ -106,7 +111,7 @@ class StringParser:
             tokens = i.split('-')
             tokens = [x.strip() for x in tokens]
             for x in tokens:
-                if x[0] != '#':
+                if x == '' or x[0] != '#':
                     return None
             try:
                 intvals = [int(x[1:]) for x in tokens]
@@ -120,6 +125,26 @@ class StringParser:
                 return None
         return intervals
 
+    @staticmethod
+    def format_interval_string(indexes):
+        """Format layer indexes as a layer indexing string.
+
+        Consecutive indexes are joined in intervals.
+        It is the inverse of parse_interval_string.
+
+        Examples:
+          [0, 1, 2, 3] -> "#0-#3"
+          [0, 2, 3, 7] -> "#0,#2-#3,#7"
+        """
+        intervals = []
+        for n in sorted(indexes):
+            if intervals and intervals[-1][1] == n - 1:
+                intervals[-1][1] = n
+            else:
+                intervals.append([n, n])
+        return ','.join('#%d' % lower if lower == upper else '#%d-#%d' % (lower, upper)
+                        for lower, upper in intervals)
+
     @staticmethod
     def is_number_in_intervals(n, intervals):
         """
@@ -157,33 +182,53 @@ class StringParser:
         Returns the list of layer's labels by filtering the list
         *labels* by including and excluding the elements specified
         in the *filters* dict.
-        The intermediate filters corresponds to numerical intervals.
-        """
-        # add filters specified by intervals
-        include = StringParser.get_filters(filters, 'include')
-        exclude = StringParser.get_filters(filters, 'exclude')
-        # add intervals corresponding to labels
-        def get_filters_by_label(labels, filters, keyword):
-            filt = []
-            if keyword in filters:
-                for x in filters[keyword]:
-                    if x in labels:
-                        index = labels.index(x)
-                        filt.append((index, index))
-            return filt
-        include.extend(get_filters_by_label(labels, filters, 'include'))
-        exclude.extend(get_filters_by_label(labels, filters, 'exclude'))
-        # filters labels
-        for i, label in enumerate(labels):
-            # exclude those elements that are not included
-            if not StringParser.is_number_in_intervals(i, include):
-                labels[i] = None
-            # exclude those elements that are explicitly excluded
-            if StringParser.is_number_in_intervals(i, exclude):
-                labels[i] = None
-        # remove None values
-        l = [x for x in labels if x is not None]
-        return l
+        The filters are layer selectors (see LayerIndex).
+        The *labels* list is not modified.
+        """
+        return LayerIndex(labels).filter(filters)
+
+    @staticmethod
+    def parse_resolutions(value):
+        """Parse the resolutions setting.
+
+        The setting is a dictionary {suffix: dpi}, a list of 'suffix:dpi' strings
+        or a comma separated string of them. A number alone has no suffix.
+        Returns a dictionary {suffix: dpi}, or None if no resolution is set.
+
+        Examples:
+          "@1x:96,@2x:192" -> {'@1x': 96.0, '@2x': 192.0}
+          300 -> {'': 300.0}
+        """
+        if value is None or value == '':
+            return None
+        if isinstance(value, dict):
+            return {suffix: float(dpi) for suffix, dpi in value.items()}
+        if isinstance(value, (int, float)):
+            return {'': float(value)}
+        if isinstance(value, str):
+            value = StringParser.filter_slide_data(value)
+        resolutions = {}
+        for item in value:
+            suffix, sep, dpi = str(item).rpartition(':')
+            resolutions[suffix.strip()] = float(dpi)
+        return resolutions
+
+    @staticmethod
+    def parse_types(value):
+        """Parse the type setting.
+
+        The setting is a type, a list of types or a comma separated string of them.
+        Returns a list of types.
+
+        Examples:
+          "pdf" -> ['pdf']
+          "pdf,png" -> ['pdf', 'png']
+        """
+        if value is None:
+            return [None]
+        if isinstance(value, str):
+            value = StringParser.filter_slide_data(value)
+        return [x.strip() for x in value]
 
     @staticmethod
     def filter_slide_data(layers_data):
@@ -197,6 +242,97 @@ class StringParser:
         return results
 
 
+class LayerIndex:
+    """
+    Resolves the layer selectors to the set of indexes of the matching layers.
+
+    Supported selectors:
+      L1               exact layer label
+      #0-#10,#12       layer indexes and intervals
+      msg:*            glob pattern matched with the labels (*, ?, [...])
+      re:^step\\d+$    regular expression searched in the labels
+      @id=layer1*      glob pattern matched with a layer attribute (namespace prefixes allowed)
+      @attr            layers having the attribute
+
+    An exact label always has precedence over the other interpretations.
+    Each selector is resolved once: later uses return the cached set of indexes.
+    """
+    glob_chars = re.compile(r'[*?\[]')
+
+    def __init__(self, labels, attribs=None, nsmap=None):
+        self.labels = list(labels)
+        self.attribs = attribs if attribs is not None else [{} for x in self.labels]
+        self.nsmap = nsmap or {}
+        self.positions = {}
+        for i, label in enumerate(self.labels):
+            self.positions.setdefault(label, i)
+        self.cache = {}
+
+    def select(self, selector):
+        """
+        Returns: the frozenset of indexes of the layers matching the selector.
+        """
+        indexes = self.cache.get(selector)
+        if indexes is None:
+            indexes = frozenset(self._resolve(selector))
+            self.cache[selector] = indexes
+        return indexes
+
+    def select_any(self, selectors):
+        """
+        Returns: the set of indexes of the layers matching any of the selectors.
+        """
+        if isinstance(selectors, str):
+            selectors = [selectors]
+        indexes = set()
+        for selector in selectors:
+            indexes |= self.select(selector)
+        return indexes
+
+    def filter(self, filters):
+        """
+        Returns the labels of the layers selected by the 'include' selectors
+        and not by the 'exclude' selectors of the *filters* dict, in layer order.
+        """
+        include = self.select_any(filters.get('include', []))
+        exclude = self.select_any(filters.get('exclude', []))
+        return [self.labels[i] for i in sorted(include - exclude)]
+
+    def _resolve(self, selector):
+        indexes = set()
+        intervals = StringParser.parse_interval_string(selector)
+        if intervals is not None:
+            for lower, upper in intervals:
+                indexes.update(range(max(lower, 0), min(upper, len(self.labels) - 1) + 1))
+        if selector in self.positions:
+            indexes.add(self.positions[selector])
+        elif selector.startswith('re:'):
+            try:
+                pattern = re.compile(selector[3:])
+            except re.error as e:
+                raise Exception("Config file format error: invalid regular expression '%s': %s." % (selector[3:], e)) from None
+            indexes.update(i for i, label in enumerate(self.labels)
+                           if label is not None and pattern.search(label))
+        elif selector.startswith('@'):
+            indexes.update(self._resolve_attribute(selector[1:]))
+        elif self.glob_chars.search(selector):
+            indexes.update(i for i, label in enumerate(self.labels)
+                           if label is not None and fnmatch.fnmatchcase(label, selector))
+        return indexes
+
+    def _resolve_attribute(self, spec):
+        name, sep, pattern = spec.partition('=')
+        prefix, colon, local = name.strip().partition(':')
+        if colon and prefix in self.nsmap:
+            name = '{%s}%s' % (self.nsmap[prefix], local)
+        else:
+            name = name.strip()
+        for i, attrib in enumerate(self.attribs):
+            value = attrib.get(name)
+            if value is not None and (not sep or fnmatch.fnmatchcase(value, pattern.strip())):
+                yield i
+
+
 class FileHandler:
     """
     Handles the loading of slide configuration from input files and the creation of
@@ -228,6 +364,23 @@ class FileHandler:
         """
         Returns an svg file object instance and a dictionary containing the slide configuration.
         """
+        svg_name, conf = self.load_config(filename)
+        svg_base_name = self.get_basename(svg_name)
+        return self.get_svg_file(self.get_svg_path(filename, svg_name), svg_base_name), conf
+
+    def get_svg_path(self, filename, svg_name):
+        """
+        Returns the path of the svg file *svg_name* referenced by the input file *filename*.
+        """
+        if os.path.dirname(svg_name) == '':
+            return os.path.dirname(filename) + '/' + svg_name
+        return svg_name
+
+    def load_config(self, filename):
+        """
+        Returns the name of the svg file and a dictionary containing the slide configuration,
+        without loading the svg file.
+        """
         # disp("Loading " + ext.upper() + " file...", args, 2)
         svg_name = ''
         conf = None
@@ -244,6 +397,7 @@ class FileHandler:
                 conf = json.load(infile)
                 svg_name = conf['input']['filename']
             if ext == '.toml':
+                import pytoml as toml
                 conf = toml.load(infile)
                 svg_name = conf['input']['filename']
             if ext == '.ini':
@@ -251,14 +405,13 @@ class FileHandler:
                 svg_name = conf['input']['filename']
             elif ext not in ['.svg', '.json', '.toml', '.ini']:
                 raise Exception('File type "{}" not supported'.format(ext))
+        return svg_name, conf
 
-        if os.path.dirname(svg_name) == '':
-            full_svg_name = os.path.dirname(filename) + '/' + svg_name
-        else:
-            full_svg_name = svg_name
-        svg_tree = self.get_etree(full_svg_name)
-        svg_base_name = self.get_basename(svg_name)
-        return SVGFile(svg_base_name, svg_tree), conf
+    def get_svg_file(self, filename, basename):
+        """
+        Returns the svg file object of the file *filename*.
+        """
+        return SVGFile(basename, self.get_etree(filename))
 
 
     def _load_conf_from_ini(self, infile):
@@ -266,6 +419,7 @@ class FileHandler:
         Retrieves the configuration from the ini file. Supports different versions of Python.
         """
         try:
+            import configparser
             config = configparser.ConfigParser()
         except:
             config = ConfigParser.ConfigParser()
@@ -283,6 +437,24 @@ class FileHandler:
         conf['input']['filename'] = config.get('input', 'filename')
         conf['output']['type'] = config.get('output', 'type')
         conf['output']['filename'] = config.get('output', 'filename', raw=True)
+        if config.has_option('output', 'prune'):
+            conf['output']['prune'] = config.getboolean('output', 'prune')
+        if config.has_option('output', 'crop'):
+            conf['output']['crop'] = config.get('output', 'crop')
+        if config.has_option('output', 'optimize'):
+            conf['output']['optimize'] = config.getboolean('output', 'optimize')
+        if config.has_option('output', 'minify'):
+            conf['output']['minify'] = config.getboolean('output', 'minify')
+        if config.has_option('output', 'precision'):
+            conf['output']['precision'] = config.getint('output', 'precision')
+        if config.has_option('output', 'rasterize'):
+            conf['output']['rasterize'] = StringParser.filter_slide_data(config.get('output', 'rasterize'))
+        if config.has_option('output', 'rasterize_filters'):
+            conf['output']['rasterize_filters'] = config.getboolean('output', 'rasterize_filters')
+        if config.has_option('output', 'rasterize_dpi'):
+            conf['output']['rasterize_dpi'] = config.getfloat('output', 'rasterize_dpi')
+        if config.has_option('output', 'resolutions'):
+            conf['output']['resolutions'] = config.get('output', 'resolutions', raw=True)
         slide_sections = [section for section in config.sections() if str(section).startswith('slide_')]
         slide_sections = sorted(slide_sections)
 
@@ -293,6 +465,10 @@ class FileHandler:
                 slide_data['include'] = StringParser.filter_slide_data(slide_data.get('include'))
             if 'exclude' in slide_data:
                 slide_data['exclude'] = StringParser.filter_slide_data(slide_data.get('exclude'))
+            if 'stack' in slide_data:
+                slide_data['stack'] = StringParser.filter_slide_data(slide_data.get('stack'))
+            if 'base' in slide_data:
+                slide_data['base'] = StringParser.filter_slide_data(slide_data.get('base'))
             conf['output']['slides'].append(slide_data)
         return conf
 
@@ -304,6 +480,7 @@ class Layer():
     def __init__(self, obj):
         self.id = obj.get('id')
         self.label = Layer.get_label_from_obj(obj)
+        self.attrib = dict(obj.attrib)
 
     @staticmethod
     def is_layer(e):
@@ -340,14 +517,32 @@ class Slide:
     """
     Contains everything related to a slide: id, filename, label, type, layers, elementTree data
     """
-    def __init__(self, id, fname_fmt, label, type, layers, root):
+    # preferred order of the exported types included in LaTeX documents
+    latex_types = ['pdf', 'png', 'eps', 'ps']
+    # types written from the slide tree, without inkscape
+    native_types = ['svg', 'svgz']
+
+    def __init__(self, id, fname_fmt, label, type, layers, root, resolutions=None):
         self.id = id
         self.filename = ''
         self.fname_fmt = fname_fmt
         self.name = label
-        self.type = type # exported file extension
+        self.types = list(type) if isinstance(type, (list, tuple)) else [type] # exported file extensions
+        self.type = self.types[0]
         self.layers = layers
-        self.root = root
+        self._root = root
+        self.resolutions = resolutions # {suffix: dpi} of raster exports
+        self.area = None # (x0, y0, x1, y1) export area of raster exports, the page if None
+
+    @property
+    def root(self):
+        """
+        The elementTree object of the slide.
+        It can be given as a callable, in that case it is built the first time it is used.
+        """
+        if callable(self._root):
+            self._root = self._root()
+        return self._root
 
     def get_layers(self):
         """
@@ -361,12 +556,40 @@ class Slide:
         """
         return [layer.get_label() for layer in self.layers]
 
+    def get_latex_type(self):
+        """
+        Returns: the exported type included in LaTeX documents.
+        """
+        for export_type in self.latex_types:
+            if export_type in self.types:
+                return export_type
+        return self.type
+
+    def get_resolution_suffixes(self, export_type=None):
+        """
+        Returns: the suffixes of the files exported to *export_type* (the first type by default),
+        one for each resolution of PNG slides.
+        The suffix of the highest resolution comes first.
+        """
+        if (export_type or self.type) != 'png' or not self.resolutions:
+            return ['']
+        return sorted(self.resolutions, key=self.resolutions.get, reverse=True)
+
+    def get_export_names(self, base_name):
+        """
+        Returns: the names of the files exported by inkscape from *base_name* (the file name
+        without extension), for all the types and resolutions of the slide.
+        """
+        return [base_name + suffix + '.' + export_type for export_type in self.types
+                if export_type not in self.native_types
+                for suffix in self.get_resolution_suffixes(export_type)]
+
     def update_layers(self, layers, root):
         """
         Updates the layer objects included in the slide
         """
         self.layers = layers
-        self.root = root
+        self._root = root
 
 
 
@@ -381,9 +604,43 @@ class SlideConfiguration:
         self.svg_file = svg_file
         self.fname_fmt = self.load_element(config, 'output', 'filename')
         self.type = self.load_element(config, 'output', 'type')
+        self.resolutions = config['output'].get('resolutions')
+        self.prune = bool(options.get('prune') or config['output'].get('prune'))
+        self.optimize = bool(options.get('optimize') or config['output'].get('optimize'))
+        # applied to the svg and svgz slides (see minify_svg)
+        self.minify = bool(options.get('minify') or config['output'].get('minify'))
+        self.precision = options.get('precision')
+        if self.precision is None:
+            self.precision = config['output'].get('precision')
+        self.crop = options.get('crop') or config['output'].get('crop')
+        if self.crop not in (None, 'slide', 'deck'):
+            raise Exception("Config file format error: crop must be 'slide' or 'deck'.")
+        # layers rendered once to a bitmap, used by the slides instead of the layer
+        rasterize = options.get('rasterize') or config['output'].get('rasterize') or []
+        self.rasterize = [rasterize] if isinstance(rasterize, str) else list(rasterize)
+        self.rasterize_filters = bool(options.get('rasterize_filters') or config['output'].get('rasterize_filters'))
+        self.rasterize_dpi = float(options.get('rasterize_dpi') or config['output'].get('rasterize_dpi') or 300)
+        self.rasters = {} # {label: href}, set by the exporter (see InklayersShell.rasterize_layers)
         self.slides = []
+        self.named_slides = {}
         self.load_slides(self.load_element(config, 'output', 'slides'))
 
+    def get_rasterized_labels(self):
+        """
+        Returns the labels of the layers to render once to a bitmap: the ones selected by
+        'rasterize' and, with 'rasterize_filters', the ones using filters (blurs, shadows, ...).
+        Hidden layers are not rendered.
+        """
+        indexes = self.svg_file.index.select_any(self.rasterize)
+        if self.rasterize_filters:
+            indexes |= {x['index'] for x in self.svg_file.get_layer_stats() if x['filters']}
+        labels = []
+        for i in sorted(indexes):
+            layer = self.svg_file.layers[i]
+            if not SVGFile.display_none.search(layer.attrib.get('style', '')):
+                labels.append(layer.get_label())
+        return labels
+
     def load_element(self, conf, key1, key2):
         """Loads the settings found in the config file
         using the keys provided.
@@ -399,9 +656,11 @@ class SlideConfiguration:
         Uses a specific method for stacked mode if required and proceeds by adding an id
         to each slide and by processing the slides.
         """
-        self.check_unique_slide_names(slides)
         if self.options.get('stack'):
             slides = self.load_stacked_slides()
+        # work on copies: the config dictionary may be shared (e.g. by concurrent library calls)
+        slides = [dict(slide) for slide in self.expand_slides(slides)]
+        self.check_unique_slide_names(slides)
         for index, slide in enumerate(slides):
             slide['id'] = index
         self.process_slides(slides)
@@ -417,50 +676,79 @@ class SlideConfiguration:
                 fnumber = None
             slide.filename = StringParser.get_filename(slide.fname_fmt, basename=bn, extension='svg', index=fnumber)
 
+    def expand_slides(self, slides):
+        """
+        Yields the slides of the config file, expanding the generator entries.
+        A generator entry reveals the layers selected by 'stack' one by one, on top of
+        the 'base' layers, and yields one slide per step. An 'include' of the entry is
+        added to the base layers. The other settings of the entry ('exclude', 'type', ...)
+        are copied to each slide; a 'name' is numbered from 0. Example:
+          {"stack": "#3-#40", "base": ["L0"], "exclude": ["L5 msg:greetings"]}
+        Each slide includes a single interval, from the first stacked layer to the last
+        one revealed, so that the layer index resolves the steps quickly. The layers of
+        the interval that are not stacked (nor base ones) are excluded.
+        """
+        def as_list(value):
+            return [value] if isinstance(value, str) else list(value)
+
+        for slide in slides:
+            if 'stack' not in slide:
+                yield slide
+                continue
+            index = self.svg_file.index
+            stacked = sorted(index.select_any(slide['stack']))
+            base = as_list(slide.get('base', [])) + as_list(slide.get('include', []))
+            exclude = as_list(slide.get('exclude', []))
+            if stacked:
+                gaps = set(range(stacked[0], stacked[-1] + 1)) - set(stacked) - index.select_any(base)
+                if gaps:
+                    exclude.append(StringParser.format_interval_string(gaps))
+            settings = {key: value for key, value in slide.items() if key not in ('stack', 'base', 'include', 'name')}
+            for count, last in enumerate(stacked, 1):
+                generated = dict(settings)
+                generated['include'] = base + ['#%d-#%d' % (stacked[0], last)]
+                if exclude:
+                    generated['exclude'] = list(exclude)
+                if 'name' in slide:
+                    generated['name'] = '{}-{}'.format(slide['name'], count - 1)
+                yield generated
+
     def check_unique_slide_names(self, slides):
         """
         Verifies if a slide name is repeated more than once
         (That would cause a problem with based-on slides)
         """
-        names = [slide.get('name') for slide in slides if slide.get('name') != None]
-        if names == []:
-            return
-        count = [names.count(name) for name in set(names)]
-        for x in count:
-            if x > 1:
-                raise Exception("Error in slide configuration: two slides with the same name found.")
+        names = Counter(slide.get('name') for slide in slides if slide.get('name') != None)
+        if any(x > 1 for x in names.values()):
+            raise Exception("Error in slide configuration: two slides with the same name found.")
 
     def process_slides(self, slides):
         """
         Process and make the slides adding them to a list in the slide configuration object.
-        This method may be executed more than once depending on the number of 'based-on' slides.
-        """
-        old_count = len(slides)
-        def madeNames(): # Returns the names of the slides already created (required by the based-on slides)
-            return [slide.name for slide in self.slides if slide.name != '']
-
-        for slide in slides:
-            # If a slide is not based on another one or it is but the other was already created then make it now
-            # (otherwise wait the next execution of this method)
-            if 'based-on' not in slide or ('based-on' in slide and slide.get('based-on') in madeNames()):
-                createdSlide = self.make_slide(slide)
-                self.slides.append(createdSlide)
-
-        madeIDs = [slide.id for slide in self.slides] # the IDs of the already created slides
-        slides = [slide for slide in slides if slide['id'] not in madeIDs] # the slides remaining to be created
-        new_count = len(slides)
-
-        if new_count != 0 and new_count != old_count: # if there are slides remaining execute the method again
-            self.process_slides(slides)
-        # if there are slides left and no more slides were created in this iteration then there must be an error
-        if new_count == old_count:
-            raise Exception('Error in slide configuration. Wrong based-on names or circular based-on detected.')
+        The slides are processed in more than one pass depending on the number of 'based-on' slides.
+        """
+        while slides:
+            old_count = len(slides)
+            for slide in slides:
+                # If a slide is not based on another one or it is but the other was already created then make it now
+                # (otherwise wait the next pass)
+                if 'based-on' not in slide or slide.get('based-on') in self.named_slides:
+                    createdSlide = self.make_slide(slide)
+                    self.slides.append(createdSlide)
+                    if createdSlide.name != '':
+                        self.named_slides[createdSlide.name] = createdSlide
+
+            madeIDs = set(slide.id for slide in self.slides) # the IDs of the already created slides
+            slides = [slide for slide in slides if slide['id'] not in madeIDs] # the slides remaining to be created
+            # if there are slides left and no more slides were created in this pass then there must be an error
+            if len(slides) == old_count:
+                raise Exception('Error in slide configuration. Wrong based-on names or circular based-on detected.')
         # Filter the slides using global parameters (specified by command line or gui)
         def filter_with_globals(param, action):
             for slide in self.slides:
                 layers = slide.get_labels()
                 self.filter_layers(param, action, layers)
-                root = self.svg_file.get_filtered_obj(layers)
+                root = partial(self.svg_file.get_filtered_obj, layers, self.prune, self.rasters)
                 layer_objs = self.svg_file.get_filtered_layer_objs(layers)
                 slide.update_layers(layer_objs, root)
         if self.options.get('add') is not None:
@@ -474,50 +762,46 @@ class SlideConfiguration:
         """
         # Check if the slide has specific settings (a different file name/format or type/extension)
         fname_fmt = self.get_slide_specific_setting(slide, self.options.get('outfile'), self.fname_fmt, 'filename')
-        type = self.get_slide_specific_setting(slide, self.options.get('type'), self.type, 'type')
+        type = StringParser.parse_types(self.get_slide_specific_setting(slide, self.options.get('type'), self.type, 'type'))
+        resolutions = StringParser.parse_resolutions(
+            self.get_slide_specific_setting(slide, self.options.get('resolutions'), self.resolutions, 'resolutions'))
         # Set the slide label
         slide_label = slide.get('name') if 'name' in slide else ''
 
-        labels = self.svg_file.get_labels()
         layers = []
         # Load the layers. If a slide is based-on another do the appropriate filtering.
         if 'based-on' in slide:
-            for madeSlide in self.slides:
-                if slide.get('based-on') == madeSlide.name:
-                    for layer in madeSlide.layers:
-                        layers.append(layer.get_label())
-                    if 'include' in slide:
-                        slide_inc = [elem for elem in slide.get('include')]
-                        self.filter_layers(slide_inc, 'add', layers)
-                    if 'exclude' in slide:
-                        slide_exc = [elem for elem in slide.get('exclude')]
-                        self.filter_layers(slide_exc, 'exclude', layers)
+            madeSlide = self.named_slides.get(slide.get('based-on'))
+            if madeSlide is not None:
+                layers = madeSlide.get_labels()
+                if 'include' in slide:
+                    self.filter_layers(slide.get('include'), 'add', layers)
+                if 'exclude' in slide:
+                    self.filter_layers(slide.get('exclude'), 'exclude', layers)
         else:
-            layers = StringParser.get_filtered_layer_labels(labels, slide)
+            layers = self.svg_file.get_filtered_labels(slide)
 
-        root = self.svg_file.get_filtered_obj(layers)
+        # the slide tree is built only when it is needed
+        root = partial(self.svg_file.get_filtered_obj, layers, self.prune, self.rasters)
         layer_objs = self.svg_file.get_filtered_layer_objs(layers)
-        return Slide(slide.get('id'), fname_fmt, slide_label, type, layer_objs, root)
+        return Slide(slide.get('id'), fname_fmt, slide_label, type, layer_objs, root, resolutions)
 
     def filter_layers(self, filter, action, layers):
         """
         Filter a list of layers using include and exclude.
         Required for global parameters and based-on mechanism.
         """
-        # get all the labels in the file
-        labels_fil = self.svg_file.get_labels()
-        # creates a slide with the layers to include or exclude
-        slide_fil = {'include': filter}
-        # get the layers as labels from slide_fil
-        layers_fil = StringParser.get_filtered_layer_labels(labels_fil, slide_fil)
+        # get the layers to include or exclude as labels
+        layers_fil = self.svg_file.get_filtered_labels({'include': filter})
         if action == 'add':
+            present = set(layers)
             for layer in layers_fil:
-                if layer not in layers:
+                if layer not in present:
                     layers.append(layer)
+                    present.add(layer)
         if action == 'exclude':
-            for layer in layers_fil:
-                if layer in layers:
-                    layers.remove(layer)
+            removed = set(layers_fil)
+            layers[:] = [layer for layer in layers if layer not in removed]
 
     def get_slide_specific_setting(self, slide, global_setting, config_setting, slide_setting):
         """
@@ -559,10 +843,26 @@ class SVGFile():
     """
     Represents the SVG file object used for slide configurations.
     """
+    defs_tag = '{http://www.w3.org/2000/svg}defs'
+    # elements used only by the editor, dropped when the slides are pruned
+    editor_tags = {'{http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd}namedview',
+                   '{http://www.w3.org/2000/svg}metadata'}
+    href_attributes = ['{http://www.w3.org/1999/xlink}href', 'href']
+    url_reference = re.compile(r'url\(\s*[\'"]?#([^)\'"\s]+)')
+    display_none = re.compile(r'(^|;)\s*display\s*:\s*none')
+    # filter, mask and clip-path properties set in the style attribute
+    style_effect = re.compile(r'(?:^|;)\s*(filter|mask|clip-path)\s*:\s*url\(\s*[\'"]?#([^)\'"\s]+)')
+
     def __init__(self, basefilename, tree):
         self.basefilename = basefilename
         self.tree = tree
+        self._references = None
         self.layers = self._load_layers()
+        self.layers_by_label = {}
+        for layer in self.layers:
+            self.layers_by_label.setdefault(layer.get_label(), layer)
+        # selectors are resolved once per file
+        self.index = LayerIndex(self.get_labels(), [layer.attrib for layer in self.layers], tree.getroot().nsmap)
 
     def _load_layers(self):
         """
@@ -586,24 +886,560 @@ class SVGFile():
         """
         Returns: the layer objects corresponding to the labels passed as argument.
         """
-        layer_objs = []
-        for label in labels:
-            for layer in self.layers:
-                if layer.get_label() == label:
-                    layer_objs.append(layer)
-                    break
-        return layer_objs
+        return [self.layers_by_label[label] for label in labels if label in self.layers_by_label]
+
+    def get_filtered_labels(self, filters):
+        """
+        Returns: the labels of the layers selected by the 'include' and 'exclude'
+        selectors of the *filters* dict.
+        """
+        return self.index.filter(filters)
 
-    def get_filtered_obj(self, layers):
+    def get_filtered_obj(self, layers, prune=False, rasters=None):
         """
         Returns: the elementTree object that includes the layers passed as argument.
+        The layers argument is a list of labels, matched exactly.
+        Only the non-layer content and the selected layers are copied, so the
+        layers left out are never duplicated.
+        If *prune* is true, the definitions not used by the selected content,
+        the hidden content and the editor-only elements are left out too.
+        The layers in *rasters* ({label: href}) are replaced by their image.
         """
-        mytree = deepcopy(self.tree)
-        root = mytree.getroot()
+        root = self.tree.getroot()
+        new_root = etree.Element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap)
+        new_root.text = root.text
+        children = [x for x in root if not (Layer.is_layer(x) and not Layer.match_label(x, layers))]
+        if rasters:
+            for i, x in enumerate(children):
+                if Layer.is_layer(x) and Layer.get_label_from_obj(x) in rasters:
+                    children[i] = self.get_raster_layer_obj(x, rasters[Layer.get_label_from_obj(x)])
+        if not prune:
+            for x in children:
+                new_root.append(deepcopy(x))
+            return new_root
+        references = self._load_references()
+        needed_defs = self._get_needed_defs(children, references)
+        for x in children:
+            if x.tag in self.editor_tags:
+                continue
+            if x.tag == self.defs_tag:
+                defs = etree.SubElement(new_root, x.tag, attrib=dict(x.attrib))
+                defs.text = x.text
+                for d in x:
+                    if d in needed_defs or d not in references['defs_refs']:
+                        defs.append(deepcopy(d))
+                continue
+            if x in references['hidden']:
+                # the hidden element itself is not referenced, otherwise it would not be in the set
+                continue
+            copy = deepcopy(x)
+            if x in references['with_hidden']:
+                self._remove_hidden(copy, references['referenced'])
+            new_root.append(copy)
+        return new_root
+
+    def get_layer_obj(self, label):
+        """
+        Returns the elementTree object including only the layer *label* and the
+        definitions and style sheets, to render the layer alone.
+        """
+        root = self.tree.getroot()
+        new_root = etree.Element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap)
         for x in root:
-            if Layer.is_layer(x) and not Layer.match_label(x, layers):
-                root.remove(x)
-        return root
+            if x.tag in (self.defs_tag, '{http://www.w3.org/2000/svg}style') or \
+                    (Layer.is_layer(x) and Layer.get_label_from_obj(x) == label):
+                new_root.append(deepcopy(x))
+        return new_root
+
+    def get_raster_layer_obj(self, layer, href):
+        """
+        Returns a layer replacing *layer*, showing its image *href*, rendered on the whole page.
+        """
+        raster = etree.Element(layer.tag, nsmap=layer.nsmap)
+        for name in ['id', '{http://www.inkscape.org/namespaces/inkscape}groupmode',
+                     '{http://www.inkscape.org/namespaces/inkscape}label']:
+            if layer.get(name) is not None:
+                raster.set(name, layer.get(name))
+        x, y, width, height = get_page_box(self.tree.getroot())
+        etree.SubElement(raster, '{http://www.w3.org/2000/svg}image',
+                         {'x': '%g' % x, 'y': '%g' % y, 'width': '%g' % width, 'height': '%g' % height,
+                          'preserveAspectRatio': 'none', '{http://www.w3.org/1999/xlink}href': href})
+        return raster
+
+    def get_layer_stats(self):
+        """
+        Returns the statistics of the content of each layer, in layer order, collected
+        in a single pass over the layers. Each one is a dict with the number of elements,
+        the serialized size, the size of the embedded images (bytes), the number of elements
+        using filters, blur filters and masks (or clipping paths), and the number of texts.
+        """
+        svg = '{http://www.w3.org/2000/svg}'
+        root = self.tree.getroot()
+        blurs = {f.get('id') for f in root.iter(svg + 'filter')
+                 if next(f.iter(svg + 'feGaussianBlur'), None) is not None}
+        stats = []
+        for obj in root:
+            if not Layer.is_layer(obj):
+                continue
+            layer = {'index': len(stats), 'label': Layer.get_label_from_obj(obj), 'elements': 0, 'bytes': len(etree.tostring(obj)),
+                     'image_bytes': 0, 'filters': 0, 'blurs': 0, 'masks': 0, 'texts': 0}
+            for e in obj.iter(tag=etree.Element):
+                layer['elements'] += 1
+                if e.tag == svg + 'text':
+                    layer['texts'] += 1
+                elif e.tag == svg + 'image':
+                    href = next((e.get(a) for a in self.href_attributes if e.get(a)), '')
+                    if href.startswith('data:'):
+                        # size of the base64 data
+                        layer['image_bytes'] += (len(href) - href.find(',') - 1) * 3 // 4
+                effects = self.style_effect.findall(e.get('style', ''))
+                for name in ['filter', 'mask', 'clip-path']:
+                    refs = self.url_reference.findall(e.get(name, ''))
+                    effects += [(name, ref) for ref in refs]
+                names = {name for name, ref in effects}
+                if 'filter' in names:
+                    layer['filters'] += 1
+                    if any(name == 'filter' and ref in blurs for name, ref in effects):
+                        layer['blurs'] += 1
+                if 'mask' in names or 'clip-path' in names:
+                    layer['masks'] += 1
+            stats.append(layer)
+        return stats
+
+    def get_visible_layer_ids(self):
+        """
+        Returns: the ids of the layers that are not hidden in the document.
+        """
+        return [x.get('id') for x in self.tree.getroot() if Layer.is_layer(x) and not self._is_hidden(x)]
+
+    def get_slideshow_obj(self, slides, prune=False):
+        """
+        Returns: the elementTree object of a slideshow of the *slides* and the list
+        of the slides as interval strings of layer indexes.
+        Each layer used by the slides is included once and gets a 'data-inklayer'
+        attribute with its index. The layers not shown by the first slide get the
+        'inklayers-off' class, hidden by the style added to the document. The rule
+        is important, so that it wins over the inline 'display:inline' of the layers.
+        """
+        labels = []
+        for slide in slides:
+            labels.extend(label for label in slide.get_labels() if label not in labels)
+        root = self.get_filtered_obj(labels, prune)
+        layers = [x for x in root if Layer.is_layer(x)]
+        visible = []
+        for slide in slides:
+            shown = set(slide.get_labels())
+            visible.append([i for i, layer in enumerate(layers) if Layer.get_label_from_obj(layer) in shown])
+        first = set(visible[0]) if visible else set()
+        for i, layer in enumerate(layers):
+            layer.set('data-inklayer', str(i))
+            if i not in first:
+                classes = layer.get('class')
+                layer.set('class', 'inklayers-off' if classes is None else classes + ' inklayers-off')
+        style = etree.Element('{http://www.w3.org/2000/svg}style')
+        style.text = '.inklayers-off { display: none !important; }'
+        root.insert(0, style)
+        return root, [StringParser.format_interval_string(indexes) for indexes in visible]
+
+    def _is_hidden(self, e):
+        if e.get('display') == 'none':
+            return True
+        style = e.get('style')
+        return style is not None and self.display_none.search(style) is not None
+
+    def _has_referenced_id(self, e, referenced):
+        return any(x.get('id') in referenced for x in e.iter() if x.get('id') is not None)
+
+    def _remove_hidden(self, element, referenced):
+        """
+        Removes from the subtree the hidden elements that are not referenced by id.
+        """
+        hidden = [e for e in element.iter() if e is not element and self._is_hidden(e)
+                  and not self._has_referenced_id(e, referenced)]
+        for e in hidden:
+            parent = e.getparent()
+            if parent is not None:
+                parent.remove(e)
+
+    def _get_element_references(self, element, skip):
+        """
+        Returns the set of ids referenced in the subtree of *element*,
+        ignoring the subtrees rooted in the elements of *skip*.
+        """
+        refs = set()
+        stack = [element]
+        while stack:
+            e = stack.pop()
+            if e in skip or not isinstance(e.tag, str):
+                continue
+            for name, value in e.attrib.items():
+                if name in self.href_attributes and value.startswith('#'):
+                    refs.add(value[1:])
+                elif 'url(' in value:
+                    refs.update(self.url_reference.findall(value))
+            if e.text and 'url(' in e.text:
+                refs.update(self.url_reference.findall(e.text))
+            stack.extend(e)
+        return refs
+
+    def _load_references(self):
+        """
+        Builds the reference graph of the document (url(#id) and href references).
+        It is built once and used to prune all the slides.
+        """
+        if self._references is not None:
+            return self._references
+        root = self.tree.getroot()
+        # all the ids referenced anywhere: hidden content referenced by id is kept
+        referenced = self._get_element_references(root, set())
+        # hidden subtrees that can be dropped, and the top-level elements containing them
+        hidden = set()
+        with_hidden = set()
+        for child in root:
+            if child.tag == self.defs_tag or not isinstance(child.tag, str):
+                continue
+            for e in child.iter():
+                if self._is_hidden(e) and not self._has_referenced_id(e, referenced):
+                    hidden.add(e)
+                    with_hidden.add(child)
+        defs_owner = {}  # id -> child of a defs element including it
+        defs_refs = {}   # child of a defs element -> ids referenced by it
+        child_refs = {}  # other top-level element -> ids referenced by its visible content
+        for child in root:
+            if child.tag == self.defs_tag:
+                for d in child:
+                    if not isinstance(d.tag, str):
+                        continue
+                    defs_refs[d] = self._get_element_references(d, set())
+                    for e in d.iter():
+                        if e.get('id') is not None:
+                            defs_owner[e.get('id')] = d
+            else:
+                child_refs[child] = self._get_element_references(child, hidden)
+        self._references = {'referenced': referenced, 'hidden': hidden, 'with_hidden': with_hidden,
+                            'defs_owner': defs_owner, 'defs_refs': defs_refs, 'child_refs': child_refs}
+        return self._references
+
+    def _get_needed_defs(self, children, references):
+        """
+        Returns the set of definitions reachable from the content in *children*.
+        """
+        defs_owner = references['defs_owner']
+        stack = []
+        for x in children:
+            if x.tag not in self.editor_tags:
+                stack.extend(references['child_refs'].get(x, ()))
+        needed = set()
+        while stack:
+            d = defs_owner.get(stack.pop())
+            if d is None or d in needed:
+                continue
+            needed.add(d)
+            stack.extend(references['defs_refs'][d])
+        return needed
+
+
+def get_inkscape_path(inkPath='Default'):
+    """
+    Returns the path of the inkscape executable, fixing the default one.
+    """
+    if inkPath == 'Default':
+        if (sys.platform == 'win32'):
+            inkPath = 'C:\Progra~1\Inkscape\inkscape.com'
+        else:
+            inkPath = 'inkscape'
+    return inkPath
+
+
+@lru_cache(maxsize=None)
+def get_inkscape(inkPath='Default'):
+    """
+    Executes inkscape to verify it and to read its version.
+    Returns the executable path and the version.
+    The result is cached, so the executable is probed once per path.
+    """
+    inkPath = get_inkscape_path(inkPath)
+    try:
+        output = subprocess.check_output([inkPath, '-V'])
+    except FileNotFoundError:
+        raise FileNotFoundError('Inkscape command line executable not found.\nSet --inkscape option accordingly.')
+    version_str = str(output).split(' ')[1]
+    numbers = version_str.split('.')
+    import semantic_version
+    # handle version format such as 1.2 (wrong semantic versioning format)
+    if len(numbers) >= 3:
+        version = semantic_version.Version(version_str)
+    else:
+        if len(numbers) == 2:
+            version = semantic_version.Version(major=int(numbers[0]), minor=int(numbers[1]), patch=0)
+        elif len(numbers) == 1:
+            version = semantic_version.Version(major=int(numbers[0]), minor=0, patch=0)
+    return inkPath, version
+
+
+def format_inkscape_command(inkPath, version, slide_type, svg_file, outfile, extra_args=''):
+    """
+    Builds the command to call inkscape depending on its version, as a list of arguments.
+    *extra_args* is split like a shell does, but no shell runs the command.
+    """
+    extra = shlex.split(extra_args or '')
+    if version.major == 0 and version.minor > 91:
+        command = [inkPath, '--export-' + slide_type, outfile] + extra + [svg_file]
+    elif version.major >= 1:
+        command = [inkPath, '--export-type=' + slide_type, svg_file, '-o', outfile] + extra
+    return command
+
+
+def format_inkscape_exports_command(inkPath, version, svg_file, exports, extra_args=''):
+    """
+    Builds the command exporting *svg_file* to several files with one inkscape run.
+    *exports* is a list of (type, outfile, dpi) tuples; dpi can be None for the
+    default one (the --export-dpi of *extra_args*, or 96).
+    The dpi of an export action persists for the following ones, so it is set
+    whenever it changes. Inkscape 0.92 supports one export per type and a single dpi.
+    """
+    if version.major >= 1:
+        default = re.search(r'--export-dpi[= ]([0-9.]+)', extra_args or '')
+        default = float(default.group(1)) if default else 96
+        dpi_before = default
+        actions = []
+        for export_type, outfile, dpi in exports:
+            actions.append('export-type:' + export_type)
+            dpi = default if dpi is None else dpi
+            if dpi != dpi_before:
+                actions.append('export-dpi:%g' % dpi)
+                dpi_before = dpi
+            actions += ['export-filename:' + outfile, 'export-do']
+        return [inkPath, svg_file, '--actions=' + ';'.join(actions)] + shlex.split(extra_args or '')
+    options = []
+    for export_type, outfile, dpi in exports:
+        options += ['--export-' + export_type, outfile]
+    options += ['--export-dpi=%g' % dpi for dpi in sorted(set(dpi for t, o, dpi in exports if dpi is not None))]
+    return [inkPath] + options + shlex.split(extra_args or '') + [svg_file]
+
+
+# the numbers of the SVG attributes: an exponent is part of its number
+svg_number = re.compile(r'[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?')
+
+# the attributes whose numbers are rounded by minify_svg: coordinates and sizes,
+# and not the ones where small values matter (opacity, stop offsets, stroke widths)
+geometry_attributes = {
+    'd', 'points', 'transform', 'gradientTransform', 'patternTransform', 'viewBox',
+    'x', 'y', 'x1', 'y1', 'x2', 'y2', 'cx', 'cy', 'fx', 'fy', 'r', 'rx', 'ry', 'dx', 'dy', 'width', 'height',
+}
+
+
+def round_decimals(value, digits):
+    """
+    Returns the string *value* with its decimal numbers rounded to *digits* decimal places.
+    The numbers without a decimal point (e.g. '12', '1e-7') are left as they are.
+    A space is added between a number and the previous one when the rounding joins them
+    (e.g. '1.5.96' in path data).
+    """
+    def replace(match):
+        if '.' not in match.group(0):
+            return match.group(0)
+        number = ('%.*f' % (digits, float(match.group(0))))
+        if '.' in number:
+            number = number.rstrip('0').rstrip('.')
+        if number == '-0':
+            number = '0'
+        if match.start() > 0 and value[match.start() - 1] in '0123456789.':
+            number = ' ' + number
+        return number
+    return svg_number.sub(replace, value)
+
+
+def minify_svg(root, strip=True, precision=None):
+    """
+    Returns the slide tree *root* made smaller (its content is moved to the new tree).
+    With *strip* the metadata, the comments, the whitespace between the elements (outside
+    texts) and the elements and attributes in the Inkscape and Sodipodi namespaces are
+    removed, and the SVG namespace is made the default one.
+    With *precision* the decimal numbers of the geometry attributes (see geometry_attributes) are rounded.
+    """
+    svg = 'http://www.w3.org/2000/svg'
+    editor_namespaces = ('http://www.inkscape.org/namespaces/inkscape', 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd')
+    if strip:
+        etree.strip_elements(root, etree.Comment, *(['{%s}*' % x for x in editor_namespaces] + list(SVGFile.editor_tags)),
+                             with_tail=False)
+        text_tags = {'{%s}text' % svg, '{%s}flowRoot' % svg}
+        def strip_space(e):
+            if e.tag in text_tags:
+                return
+            if e.text is not None and not e.text.strip():
+                e.text = None
+            for child in e:
+                if child.tail is not None and not child.tail.strip():
+                    child.tail = None
+                strip_space(child)
+        strip_space(root)
+        nsmap = {k: v for k, v in root.nsmap.items() if k is not None and v != svg and v not in editor_namespaces}
+        nsmap[None] = svg
+        new_root = etree.Element(root.tag, attrib=dict(root.attrib), nsmap=nsmap)
+        new_root.text = root.text
+        new_root.extend(list(root))
+        root = new_root
+    for e in root.iter(etree.Element):
+        for name in list(e.attrib):
+            if strip and name.startswith(tuple('{%s}' % x for x in editor_namespaces)):
+                del e.attrib[name]
+            elif precision is not None and name in geometry_attributes:
+                e.set(name, round_decimals(e.get(name), precision))
+    if strip:
+        etree.cleanup_namespaces(root)
+    return root
+
+
+def format_slide_actions(layer_ids, slides, dpi=96):
+    """
+    Returns the inkscape action script exporting several slides from the whole document,
+    one line for each slide.
+    *layer_ids* are the ids of the layers visible in the document, *slides* a list of
+    (shown, area, exports) tuples: the ids of the layers of the slide, its export area
+    ('x0:y0:x1:y1', None for the page) and its (type, outfile, dpi) exports.
+    Only the layers changing visibility from a slide to the next one are shown or hidden,
+    and the export area and dpi (*dpi* if not given) are set when they change.
+    """
+    lines = []
+    shown_before = set(layer_ids)
+    area_before = None
+    dpi_before = dpi
+    for shown, area, exports in slides:
+        shown = set(shown) & set(layer_ids)
+        actions = []
+        for changed, display in [(shown_before - shown, 'none'), (shown - shown_before, 'inline')]:
+            if changed:
+                ids = [x for x in layer_ids if x in changed]
+                actions += ['select-by-id:' + ','.join(ids), 'object-set-property:display,' + display, 'select-clear']
+        shown_before = shown
+        if area != area_before:
+            actions.append('export-area:' + area if area else 'export-area-page')
+            area_before = area
+        for export_type, outfile, export_dpi in exports:
+            export_dpi = export_dpi or dpi
+            if export_dpi != dpi_before:
+                actions.append('export-dpi:%g' % export_dpi)
+                dpi_before = export_dpi
+            actions += ['export-type:' + export_type, 'export-filename:' + outfile, 'export-do']
+        lines.append(';'.join(actions) + ';')
+    return '\n'.join(lines) + '\n'
+
+
+def get_tile_bands(area, width, height, tile_pixels):
+    """
+    Splits the export *area* (x0, y0, x1, y1), exported to *width* x *height* pixels,
+    into horizontal bands of about *tile_pixels* pixels each.
+    Returns the list of (area, pixel height) of the bands, from top to bottom.
+    """
+    rows = max(1, tile_pixels // width)
+    scale = (area[3] - area[1]) / height
+    bands = []
+    for y in range(0, height, rows):
+        h = min(rows, height - y)
+        bands.append(((area[0], area[1] + y * scale, area[2], area[1] + (y + h) * scale), h))
+    return bands
+
+
+def query_bboxes(inkPath, version, data):
+    """
+    Returns the bounding boxes {id: (x0, y0, x1, y1)} of the objects of the SVG
+    document *data* (bytes), from a single 'inkscape --query-all' run.
+    The results are cached on disk, keyed by the hash of the document and the inkscape version.
+    """
+    key = hashlib.sha256(data + str(version).encode('utf-8')).hexdigest()
+    cache_file = os.path.join(get_cache_dir('bbox'), key + '.json')
+    try:
+        with open(cache_file) as f:
+            return {id: tuple(box) for id, box in json.load(f).items()}
+    except (OSError, ValueError):
+        pass
+    with tempfile.TemporaryDirectory() as tmpdir:
+        svg_file = os.path.join(tmpdir, 'query.svg')
+        with open(svg_file, 'wb') as f:
+            f.write(data)
+        output = subprocess.run([inkPath, '--query-all', svg_file], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True).stdout
+    boxes = {}
+    for line in output.decode('utf-8', 'replace').splitlines():
+        # id,x,y,width,height
+        fields = line.strip().rsplit(',', 4)
+        try:
+            x, y, width, height = [float(v) for v in fields[1:]]
+        except ValueError:
+            continue
+        boxes[fields[0]] = (x, y, x + width, y + height)
+    tmp = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(boxes, f)
+    os.replace(tmp, cache_file)
+    return boxes
+
+
+def union_bbox(boxes):
+    """
+    Returns the bounding box (x0, y0, x1, y1) including all the *boxes*, or None if there are none.
+    """
+    boxes = list(boxes)
+    if not boxes:
+        return None
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def get_page_size(root, name):
+    """
+    Returns the 'width' or the 'height' (*name*) of the page of the SVG document
+    *root* in px (96 dpi), or None if it can not be found.
+    """
+    units = {'': 1.0, 'px': 1.0, 'pt': 96 / 72, 'pc': 16.0, 'mm': 96 / 25.4, 'cm': 96 / 2.54, 'in': 96.0}
+    match = re.match(r'\s*([0-9.eE+-]+)\s*([a-z]*)\s*$', root.get(name, ''))
+    if match and match.group(2) in units:
+        return float(match.group(1)) * units[match.group(2)]
+    viewbox = root.get('viewBox', '').replace(',', ' ').split()
+    if len(viewbox) == 4:
+        return float(viewbox[2 if name == 'width' else 3])
+    return None
+
+
+def get_page_box(root):
+    """
+    Returns the page of the SVG document *root* in user units, as (x, y, width, height).
+    """
+    viewbox = root.get('viewBox', '').replace(',', ' ').split()
+    if len(viewbox) == 4:
+        return tuple(float(v) for v in viewbox)
+    return (0.0, 0.0, get_page_width(root) or 0.0, get_page_height(root) or 0.0)
+
+
+def get_page_width(root):
+    return get_page_size(root, 'width')
+
+
+def get_page_height(root):
+    return get_page_size(root, 'height')
+
+
+def get_render_data(svg_file):
+    """
+    Returns the normalized content of the svg file *svg_file*, used for the keys of
+    the render cache: the canonical XML of the document, followed by the hashes of
+    the files it links (images), as they are rendered too.
+    """
+    tree = etree.parse(svg_file)
+    data = [etree.tostring(tree, method='c14n')]
+    folder = os.path.dirname(svg_file)
+    for element in tree.iter(tag=etree.Element):
+        for attribute in SVGFile.href_attributes:
+            href = element.get(attribute)
+            if href and not href.startswith(('#', 'data:')):
+                path = os.path.join(folder, href[7:] if href.startswith('file://') else href)
+                try:
+                    st = os.stat(path)
+                    digest = get_linked_file_digest(path, st.st_size, st.st_mtime_ns)
+                except OSError:
+                    digest = ''
+                data.append(('\n%s %s' % (href, digest)).encode('utf-8'))
+    return b''.join(data)
 
 
 class InklayersSystem():
@@ -612,8 +1448,29 @@ class InklayersSystem():
         self.args = args
         self.set_verbosity()
         self.run = self.set_subprocess()
-        self.inkPath, self.version = self.verify_inkscape()
+        # (path, version) of inkscape, verified when first used (see get_verified_inkscape)
+        self._inkscape = None
         self.fileHandler = FileHandler()
+        # the sink used for all the output files, if set; otherwise see get_sink()
+        self.output_sink = None
+        self.sink = None
+
+    @property
+    def inkPath(self):
+        return self.get_verified_inkscape()[0]
+
+    @property
+    def version(self):
+        return self.get_verified_inkscape()[1]
+
+    def get_verified_inkscape(self):
+        """
+        Returns the path and the version of inkscape, verified the first time they are used:
+        the slides written without inkscape (svg, svgz) do not need it.
+        """
+        if self._inkscape is None:
+            self._inkscape = self.verify_inkscape()
+        return self._inkscape
 
     def set_verbosity(self):
         if self.args.get('debug'):
@@ -621,7 +1478,8 @@ class InklayersSystem():
 
     def set_subprocess(self):
         if self.args.get('verbosity') >= 1:
-            run = subprocess.check_call
+            # stdout is reserved for the archive when it is streamed
+            run = partial(subprocess.check_call, stdout=sys.stderr) if self.args.get('archive') == '-' else subprocess.check_call
         else:
             run = subprocess.check_output
         return run
@@ -630,28 +1488,12 @@ class InklayersSystem():
         """
         Fix inkscape path and attempt to execute to verify it.
         """
-        inkPath = self.args.get('inkscape')
-        if inkPath == 'Default':
-            if (sys.platform == 'win32'):
-                inkPath = 'C:\Progra~1\Inkscape\inkscape.com'
-            else:
-                inkPath = 'inkscape'
+        inkPath = get_inkscape_path(self.args.get('inkscape'))
         try:
             self.run([inkPath, "-V"])
-            output = subprocess.check_output([inkPath, '-V'])
         except FileNotFoundError:
             raise FileNotFoundError('Inkscape command line executable not found.\nSet --inkscape option accordingly.')
-        version_str = str(output).split(' ')[1]
-        numbers = version_str.split('.')
-        # handle version format such as 1.2 (wrong semantic versioning format)
-        if len(numbers) >= 3:
-            version = semantic_version.Version(version_str)
-        else:
-            if len(numbers) == 2:
-                version = semantic_version.Version(major=int(numbers[0]), minor=int(numbers[1]), patch=0)
-            elif len(numbers) == 1:
-                version = semantic_version.Version(major=int(numbers[0]), minor=0, patch=0)
-        return inkPath, version
+        return get_inkscape(inkPath)
 
 
     def process_input_file(self, infile):
@@ -664,6 +1506,44 @@ class InklayersSystem():
         self.slideConf = SlideConfiguration(svg_file, configFile, self.filtered_arguments())
 
 
+    def get_sink(self):
+        """
+        Returns the output sink of the current input file: the output folder of the
+        input file, or the archive if one was requested.
+        """
+        if self.output_sink is None and self.args.get('archive'):
+            self.output_sink = ArchiveSink(self.args.get('archive'))
+        if self.output_sink is not None:
+            return self.output_sink
+        path = self.infile_path + output_subfolder
+        if self.sink is None or self.sink.path != path:
+            self.sink = DirectorySink(path)
+        return self.sink
+
+    def get_svg_data(self, root, types=()):
+        """
+        Returns the content of the .svg file of the slide *root*: minified if requested
+        (see minify_svg) when the slide is exported to svg or svgz (*types*).
+        """
+        conf = self.slideConf
+        minify = set(types) & set(Slide.native_types) and (conf.minify or conf.precision is not None)
+        if minify:
+            root = minify_svg(root, conf.minify, conf.precision)
+        return etree.tostring(root, encoding='utf-8', pretty_print=not minify)
+
+    def save_svg(self, name, root, types=()):
+        """
+        Saves the slide to a .svg file with an appropriate name (see get_svg_data).
+        When the slide is exported to svgz (*types*), the .svgz file is written too.
+        Returns the content of the file.
+        """
+        data = self.get_svg_data(root, types)
+        self.get_sink().write(name, data)
+        if 'svgz' in types:
+            # no time stamp, so that the unchanged files are not replaced
+            self.get_sink().write(os.path.splitext(name)[0] + '.svgz', gzip.compress(data, mtime=0))
+        return data
+
     def filtered_arguments(self):
         """
         Filters the arguments and returns only the ones needed for the slide configuration
@@ -675,6 +1555,16 @@ class InklayersSystem():
         options['exclude'] = StringParser.filter_slide_data(exclude[0]) if exclude is not None else exclude
         options['outfile'] = self.args.get('outfile')
         options['type'] = self.args.get('type')
+        options['resolutions'] = self.args.get('resolutions')
+        options['prune'] = self.args.get('prune')
+        options['optimize'] = self.args.get('optimize')
+        options['minify'] = self.args.get('minify')
+        options['precision'] = self.args.get('precision')
+        options['crop'] = self.args.get('crop')
+        rasterize = self.args.get('rasterize')
+        options['rasterize'] = StringParser.filter_slide_data(rasterize) if rasterize else None
+        options['rasterize_filters'] = self.args.get('rasterize_filters')
+        options['rasterize_dpi'] = self.args.get('rasterize_dpi')
         options['split'] = self.args.get('split')
         options['stack'] = self.args.get('stack')
         return options
@@ -684,6 +1574,18 @@ class InklayersShell(InklayersSystem):
 
     def __init__(self, args):
         InklayersSystem.__init__(self, args)
+        self.scheduler = ExportScheduler(self.args.get('jobs') or '1', self.disp)
+        # (before, after) sizes of the optimized PNG files
+        self.optimized = []
+        # exported files shared between projects, if requested (see get_render_cache)
+        self.render_cache = None
+        # durations of the previous exports (see get_timings), and the slide being exported
+        self.timings = None
+        self.timing_key = None
+        # edges of the build files, if requested
+        self.build_graph = None
+        if self.args.get('emit_ninja') or self.args.get('emit_make'):
+            self.build_graph = BuildGraph()
 
     def fix_wildcard_names(self):
         """
@@ -707,17 +1609,143 @@ class InklayersShell(InklayersSystem):
         to the next file.
         """
         self.disp('**Processing input files', 2)
-        for infile in self.args.get('infiles'):
-            self.disp('\n**Processing: %s' %infile, 1)
-            self.process_input_file(infile)
-            self.disp('Processing done successfully', 1)
-            if not self.args.get('list'):
+        try:
+            for infile in self.args.get('infiles'):
+                self.disp('\n**Processing: %s' %infile, 1)
+                self.process_input_file(infile)
+                self.disp('Processing done successfully', 1)
+                if self.args.get('list'):
+                    continue
+                if self.args.get('report_layers'):
+                    for line in self.report_layer_costs(self.slideConf.svg_file, self.args.get('report_layers')):
+                        self.disp(line, 0)
+                    continue
+                if self.build_graph is not None:
+                    self.add_build_edges(infile)
+                    continue
+                if self.args.get('materialize') is not None:
+                    self.materialize(infile, self.args.get('materialize'))
+                    continue
+                if self.args.get('estimate'):
+                    self.print_estimate(infile)
+                    continue
                 self.disp('**Saving: %s' % infile, 1)
+                if self.args.get('slideshow'):
+                    self.save_slideshow(self.args.get('slideshow'))
+                    continue
                 self.save_files()
                 self.disp('**Printing latex code: ', 1)
                 self.print_latex_code(infile)
+            if self.build_graph is not None:
+                self.write_build_files()
+            if self.get_render_cache() is not None:
+                self.update_render_cache()
+            elif self.args.get('cache_stats'):
+                self.disp('Render cache not used: set --render-cache or $INKLAYERS_RENDER_CACHE.', 0)
+        finally:
+            if self.args.get('archive') and self.output_sink is not None:
+                self.output_sink.close()
+                self.output_sink = None
+            if self.timings:
+                self.timings.close()
+                self.timings = None
         self.disp('\nProcessing completed.', 1)
 
+    def materialize(self, infile, which):
+        """
+        Saves and exports only one slide of the input file (index from 0),
+        or only the LaTeX code if *which* is 'latex'.
+        """
+        if which == 'latex':
+            self.print_latex_code(infile)
+            return
+        slides = self.slideConf.slides
+        try:
+            slide = slides[int(which)]
+        except (ValueError, IndexError):
+            raise Exception("Slide '{}' not found: use an index from 0 to {}, or 'latex'.".format(which, len(slides) - 1))
+        if self.slideConf.crop:
+            self.set_export_areas()
+        self.rasterize_layers()
+        data = self.save_svg(slide.filename, slide.root, slide.types)
+        self.timing_key = self.get_timing_key(slide, data)
+        self.svg2file(slide)
+        self.timing_key = None
+        self.scheduler.wait()
+        self.record_timings()
+
+    def add_build_edges(self, infile):
+        """
+        Adds the edges of the input file to the build files: one per slide, plus the LaTeX code.
+        """
+        if self.args.get('split') or self.args.get('slideshow') or self.args.get('archive'):
+            raise Exception('The build files support neither the split mode, nor the slideshow and archive outputs.')
+        infile = os.path.abspath(infile)
+        svg_name, conf = self.fileHandler.load_config(infile)
+        svg_path = os.path.abspath(self.fileHandler.get_svg_path(infile, svg_name))
+        inputs = [infile] if svg_path == infile else [infile, svg_path]
+        folder = self.infile_path + output_subfolder
+        options = self.get_materialize_options()
+        for i, slide in enumerate(self.slideConf.slides):
+            base_name, ext = os.path.splitext(slide.filename)
+            names = [slide.filename]
+            for export_type in slide.types:
+                names += [base_name + suffix + '.' + export_type for suffix in slide.get_resolution_suffixes(export_type)]
+            outputs = []
+            for name in names:
+                if folder + name not in outputs:
+                    outputs.append(folder + name)
+            self.build_graph.add(outputs, inputs, i, options)
+        latex_name = self.fileHandler.get_basename(os.path.basename(infile)) + '.inc.tex'
+        self.build_graph.add([folder + latex_name], inputs, 'latex', options)
+        self.disp('Added %d build edges' % (len(self.slideConf.slides) + 1), 1)
+
+    def get_materialize_options(self):
+        """
+        Returns the command line options changing the output files, to be passed
+        to the materialize commands of the build files.
+        """
+        options = []
+        for name in ['add', 'exclude']:
+            for value in self.args.get(name) or []:
+                options.append('--%s=%s' % (name, value))
+        if self.args.get('type'):
+            options.append('--type=' + ','.join(self.args.get('type')))
+        for name in ['outfile', 'resolutions', 'crop', 'tile_size', 'rasterize', 'rasterize_dpi', 'precision']:
+            if self.args.get(name):
+                options.append('--%s=%s' % (name.replace('_', '-'), self.args.get(name)))
+        if (self.args.get('extra') or '').strip():
+            options.append('--extra=' + self.args.get('extra'))
+        if self.args.get('inkscape') not in (None, 'Default'):
+            options.append('--inkscape=' + self.args.get('inkscape'))
+        for name in ['stack', 'prune', 'optimize', 'minify', 'rasterize_filters']:
+            if self.args.get(name):
+                options.append('--' + name.replace('_', '-'))
+        return options
+
+    def write_build_files(self):
+        """
+        Writes the requested build files. They are regenerated by the same command.
+        """
+        infiles = [os.path.abspath(x) for x in self.args.get('infiles')]
+        self.build_graph.regenerate = (infiles, self.get_materialize_options())
+        for fmt in ['ninja', 'make']:
+            path = self.args.get('emit_' + fmt)
+            if path:
+                self.build_graph.write(path, fmt)
+                self.disp("Written '%s' (%d edges)" % (path, len(self.build_graph.edges)), 1)
+
+    def update_render_cache(self):
+        """
+        Evicts the least recently used entries of the render cache if needed, and prints its statistics.
+        """
+        cache = self.render_cache
+        removed = cache.evict()
+        if removed:
+            self.disp('Render cache: %d entries evicted' % removed, 1)
+        if self.args.get('cache_stats'):
+            for line in cache.format_stats():
+                self.disp(line, 0)
 
     def process_input_file(self, infile):
         """
@@ -727,11 +1755,12 @@ class InklayersShell(InklayersSystem):
         Otherwise load the slide configuration into a SlideConfiguration object.
         """
         self.infile_path, infile = self.fileHandler.get_path_and_fullname(infile)
+        self.infile_name = infile
         if self.args.get('list'):
             svg_file, configFile = self.fileHandler.load_input_file(infile)
             lines = (self.report_layers_info(svg_file))
             for l in lines:
-                print(l)
+                self.disp(l, 0)
         else:
             svg_file, configFile = self.fileHandler.load_input_file(infile)
             self.slideConf = SlideConfiguration(svg_file, configFile, self.filtered_arguments())
@@ -742,55 +1771,624 @@ class InklayersShell(InklayersSystem):
         If the split option was specified, it saves each slide layer to a different file.
         Otherwise the default method is used: each slide is saved to a single file.
         """
-        for slide in self.slideConf.slides:
-            if self.args.get('split'):
-                self.disp('\n**Saving slide in splitted mode', 1)
-                for i, layer in enumerate(slide.layers):
-                    b = self.fileHandler.get_basename(slide.filename)
-                    filename = b + '-split-' + str(i) + '.svg'
-                    layer_root = self.slideConf.svg_file.get_filtered_obj(layer.get_label())
-                    self.save_svg(filename, layer_root)
-                    self.svg2file(slide, filename)
-            else:
+        if self.slideConf.crop:
+            self.set_export_areas()
+        self.rasterize_layers()
+        if self.args.get('split'):
+            self.save_split_files()
+        else:
+            keys = []
+            for slide in self.slideConf.slides:
                 self.disp('\n**Saving slide in standard mode', 2)
-                self.save_svg(slide.filename, slide.root)
-                self.svg2file(slide)
+                keys.append(self.get_timing_key(slide, self.save_svg(slide.filename, slide.root, slide.types)))
+            exports = list(zip(self.slideConf.slides, keys))
+            manifest = self.get_manifest()
+            if manifest is not None:
+                # the bitmaps of the rasterized layers, not used by any slide in particular
+                manifest.add(None, None, sorted(set(self.slideConf.rasters.values())))
+                exports = self.reuse_exports(manifest, exports)
+            if self.args.get('single_run') and self.can_export_with_actions():
+                self.export_with_actions(exports)
+            else:
+                # the longest exports start first, so that they do not end last
+                for slide, key in self.order_exports(exports):
+                    self.timing_key = key
+                    self.svg2file(slide)
+                self.timing_key = None
+            self.scheduler.wait()
+            self.record_timings()
+            if manifest is not None:
+                self.save_manifest(manifest)
+        for line in self.scheduler.summary():
+            self.disp(line, 1)
+        if self.optimized:
+            before = sum(x[0] for x in self.optimized)
+            saved = before - sum(x[1] for x in self.optimized)
+            self.disp('PNG optimization: %d files, %d bytes saved (%.1f%%)' %
+                      (len(self.optimized), saved, 100.0 * saved / max(before, 1)), 1)
+            self.optimized = []
+        sink = self.get_sink()
+        if sink.unchanged:
+            self.disp('%d files unchanged' % sink.unchanged, 1)
+            sink.unchanged = 0
+
+    def get_manifest(self):
+        """
+        Returns the manifest of the files exported for the current input file (see OutputManifest),
+        or None if the output files are not written to a folder.
+        """
+        sink = self.get_sink()
+        if isinstance(sink, StagingSink):
+            return None
+        # projects sharing the svg file may write to the same folder: one manifest for each input file
+        name = '.%s.inklayers.json' % os.path.basename(self.infile_name)
+        return OutputManifest(sink.path, os.path.join(sink.path, name))
+
+    def get_output_key(self, slide, timing_key):
+        """
+        Returns the key of the files exported from the slide in the manifest: the timing key
+        (slide content and export options) and the options changing the exported files.
+        """
+        return hashlib.sha256((timing_key + repr(self.slideConf.optimize)).encode('utf-8')).hexdigest()
+
+    def reuse_exports(self, manifest, exports):
+        """
+        Gives the files exported in the previous run to the (slide, key) pairs *exports*
+        whose content and settings did not change, under their new names.
+        Returns the pairs of the slides still to export.
+        """
+        sink = self.get_sink()
+        remaining = []
+        links = []
+        for slide, key in exports:
+            names = slide.get_export_names(os.path.splitext(slide.filename)[0])
+            output_key = self.get_output_key(slide, key)
+            manifest.add(output_key, slide.filename, names)
+            previous = None if self.args.get('rebuild') else manifest.find(output_key)
+            if previous is None or len(previous) != len(names):
+                remaining.append((slide, key))
+                continue
+            links += [(source, name) for source, name in zip(previous, names) if source != name]
+            sink.unchanged += sum(1 for source, name in zip(previous, names) if source == name)
+        # the old name of a slide can be the new name of another one:
+        # all the links are made before any file is replaced
+        for source, name in links:
+            sink.link(source, name)
+            self.disp("Reused '%s' as '%s'" % (source, name), 2)
+        sink.collect([name for source, name in links])
+        if len(remaining) < len(exports):
+            self.disp('%d slides unchanged since the previous run' % (len(exports) - len(remaining)), 1)
+        return remaining
+
+    def save_manifest(self, manifest):
+        """
+        Removes the files of the previous run that are not produced any more
+        (e.g. the old names of renamed slides) and saves the manifest.
+        """
+        try:
+            for name in manifest.get_stale():
+                os.remove(os.path.join(manifest.folder, name))
+                self.disp("Removed '%s', not produced any more" % name, 1)
+            manifest.save()
+        except OSError as e:
+            self.disp('Output manifest not updated: %s' % e, 1)
 
-    def save_svg(self, name, root):
+    def get_timings(self):
         """
-        Saves the slide to a .svg file with an appropriate name.
+        Returns the database of the durations of the previous exports, shared by all
+        the input files (in the inklayers cache), or None if it can not be opened.
         """
-        p = pathlib.Path(self.infile_path + output_subfolder)
-        p.mkdir(parents=True, exist_ok=True)
-        filename = self.infile_path + output_subfolder + name
-        command = etree.tostring(root, encoding="unicode", pretty_print=True)
-        with open(filename, 'w') as f:
-            f.write(command)
+        if self.timings is None:
+            import sqlite3
+            try:
+                self.timings = TimingDatabase(os.path.join(get_cache_dir(), 'timings.sqlite'))
+            except (sqlite3.Error, OSError) as e:
+                self.disp('Export durations not available: %s' % e, 1)
+                self.timings = False
+        return self.timings or None
+
+    def get_timing_key(self, slide, data):
+        """
+        Returns the key of the export of the slide in the timing database: the hash of
+        the slide content (*data*) and of the options changing the export duration.
+        """
+        options = [slide.types, sorted((slide.resolutions or {}).items()), slide.area,
+                   self.args.get('extra'), self.args.get('tile_size')]
+        if slide.get_export_names(''):
+            options.append(str(self.version))
+        return hashlib.sha256(data + repr(options).encode('utf-8')).hexdigest()
+
+    def get_durations(self, keys):
+        timings = self.get_timings()
+        return [timings.get(key) if timings else None for key in keys]
+
+    def order_exports(self, exports):
+        """
+        Orders the (slide, key) pairs *exports*, longest export first (see order_longest_first).
+        """
+        durations = self.get_durations([key for slide, key in exports])
+        return order_longest_first(exports, durations, self.args.get('preview') or 0)
+
+    def record_timings(self):
+        """
+        Stores the durations of the slides exported since the last call.
+        """
+        durations, self.scheduler.group_times = self.scheduler.group_times, {}
+        timings = self.get_timings()
+        if durations and timings:
+            import sqlite3
+            try:
+                timings.record(durations)
+            except sqlite3.Error as e:
+                self.disp('Export durations not saved: %s' % e, 1)
+
+    def print_estimate(self, infile):
+        """
+        Prints the export time of the slides, estimated from the durations of their
+        previous exports and the number of parallel exports.
+        """
+        if self.slideConf.crop:
+            self.set_export_areas()
+        self.rasterize_layers(publish=False)
+        keys = []
+        for slide in self.slideConf.slides:
+            keys.append(self.get_timing_key(slide, self.get_svg_data(slide.root, slide.types)))
+        exports = self.order_exports(list(zip(self.slideConf.slides, keys)))
+        durations = self.get_durations([key for slide, key in exports])
+        known = [d for d in durations if d is not None]
+        if not known:
+            self.disp('%s: no previous exports, export time unknown' % infile, 0)
+            return
+        # the slides never exported are assumed to last the average
+        average = sum(known) / len(known)
+        jobs = self.scheduler.max_jobs
+        wall = estimate_wall_time([average if d is None else d for d in durations], jobs)
+        self.disp('%s: estimated export time %.1fs with %d parallel exports (%d slides, %d without previous exports)' %
+                  (infile, wall, jobs, len(durations), len(durations) - len(known)), 0)
+
+    def rasterize_layers(self, publish=True):
+        """
+        Renders the layers to rasterize (see SlideConfiguration.get_rasterized_labels) to
+        PNG bitmaps of the whole page, which the slides reference instead of the layers.
+        The bitmaps are rendered once: they are kept in a cache (see RasterCache), keyed
+        by the hash of the layer content, the resolution and the inkscape version.
+        With *publish* each bitmap is copied (or hard linked) next to the output files, as
+        '<basename>.raster-<hash>.png', so that the slides reference it with a relative path
+        and do not depend on the cache.
+        """
+        conf = self.slideConf
+        labels = conf.get_rasterized_labels()
+        if not labels or conf.rasters:
+            return
+        cache = RasterCache(get_cache_dir('rasters'), parse_size(self.args.get('raster_cache_size') or '1G'))
+        keys = {}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for label in labels:
+                data = etree.tostring(conf.svg_file.get_layer_obj(label))
+                key = hashlib.sha256(data + ('%g %s' % (conf.rasterize_dpi, self.version)).encode('utf-8')).hexdigest()
+                keys[label] = key
+                if cache.use(key) is not None:
+                    continue
+                svg = os.path.join(tmpdir, key + '.svg')
+                with open(svg, 'wb') as f:
+                    f.write(data)
+                png = os.path.join(tmpdir, key + '.png')
+                command = self.format_inkscape_command('png', svg, png, '--export-area-page --export-dpi=%g' % conf.rasterize_dpi)
+                self.disp("Rasterizing layer '%s'" % label, 1)
+                self.scheduler.submit('layer ' + label, command, stdout=subprocess.DEVNULL,
+                                      after=partial(cache.store, key, png))
+            self.scheduler.wait()
+        sink = self.get_sink()
+        for label, key in keys.items():
+            name = '%s.raster-%s.png' % (conf.svg_file.basefilename, key[:16])
+            if publish:
+                sink.link(cache.entry_path(key), name)
+                sink.collect([name])
+            conf.rasters[label] = name
+        # the bitmaps of the slides were used last, they are evicted after the other ones
+        removed = cache.evict()
+        if removed:
+            self.disp('Raster cache: %d bitmaps evicted' % removed, 1)
+
+    def set_export_areas(self):
+        """
+        Sets the export area of the slides from the bounding boxes of their layers,
+        queried once for the whole svg file: each slide is cropped to its own layers
+        ('slide'), or all the slides share the area including all of them ('deck').
+        """
+        svg_file = self.slideConf.svg_file
+        boxes = query_bboxes(self.inkPath, self.version, etree.tostring(svg_file.tree))
+        for slide in self.slideConf.slides:
+            slide.area = union_bbox(boxes[layer.id] for layer in slide.layers if layer.id in boxes)
+        if self.slideConf.crop == 'deck':
+            area = union_bbox(slide.area for slide in self.slideConf.slides if slide.area is not None)
+            for slide in self.slideConf.slides:
+                slide.area = area
+
+    def format_export_area(self, area):
+        """
+        Returns the inkscape option exporting the area (x0, y0, x1, y1), in the coordinates
+        of the bounding boxes (origin at the top left corner).
+        """
+        if self.version.major == 0:
+            # the origin of the export area is at the bottom left corner of the page
+            height = get_page_height(self.slideConf.svg_file.tree.getroot())
+            if height is None:
+                self.disp('Page height not found: the page is exported.', 1)
+                return ''
+            area = (area[0], height - area[3], area[2], height - area[1])
+        return '--export-area=%g:%g:%g:%g' % area
+
+    def save_split_files(self):
+        """
+        Saves each layer of each slide to a different file.
+        Every distinct layer (and export type) is saved and exported only once:
+        the '-split-i' files of the other slides including the same layer
+        are linked to the files already produced.
+        """
+        exported = {}
+        links = []
+        for slide in self.slideConf.slides:
+            self.disp('\n**Saving slide in splitted mode', 1)
+            b = self.fileHandler.get_basename(slide.filename)
+            for i, layer in enumerate(slide.layers):
+                filename = b + '-split-' + str(i) + '.svg'
+                key = (layer.get_label(), tuple(slide.types), tuple(sorted((slide.resolutions or {}).items())))
+                if key in exported:
+                    links.append((exported[key], filename, slide))
+                    continue
+                layer_root = self.slideConf.svg_file.get_filtered_obj([layer.get_label()], rasters=self.slideConf.rasters)
+                self.save_svg(filename, layer_root, slide.types)
+                self.svg2file(slide, filename)
+                exported[key] = filename
+        # the exports may run in parallel: link the files once they are all done
+        self.scheduler.wait()
+        for source, filename, slide in links:
+            self.link_split_files(source, filename, slide)
+
+    def save_slideshow(self, fmt):
+        """
+        Saves all the slides to a single slideshow file: an SVG document with a
+        script, or an HTML page including the SVG document.
+        """
+        root, table = self.slideConf.svg_file.get_slideshow_obj(self.slideConf.slides, self.slideConf.prune)
+        script = slideshow_script % json.dumps(table)
+        basename = self.slideConf.svg_file.basefilename
+        if fmt == 'svg':
+            element = etree.SubElement(root, '{http://www.w3.org/2000/svg}script', type='text/javascript')
+            element.text = etree.CDATA(script)
+            name = basename + '.slideshow.svg'
+            data = etree.tostring(root, xml_declaration=True, encoding='utf-8')
+        else:
+            name = basename + '.html'
+            page = ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>{}</title>\n'
+                    '<style>body {{ margin: 0; }} body > svg {{ display: block; width: 100vw; height: 100vh; }}</style>\n'
+                    '</head>\n<body>\n{}\n<script>\n{}</script>\n</body>\n</html>\n')
+            svg = etree.tostring(root, encoding='unicode')
+            data = page.format(html.escape(basename), svg, script).encode('utf-8')
+        self.get_sink().write(name, data)
+        self.disp("Saved '%s' (%d slides)" % (name, len(table)), 1)
+
+    def link_split_files(self, source, filename, slide):
+        """
+        Makes the svg and exported files of *filename* point to the ones already
+        produced for *source* (see the copy method of the sinks).
+        """
+        src_base = self.fileHandler.get_basename(source)
+        dst_base = self.fileHandler.get_basename(filename)
+        exts = ['.svg'] + (['.svgz'] if 'svgz' in slide.types else [])
+        names = zip([src_base + x for x in exts] + slide.get_export_names(src_base),
+                    [dst_base + x for x in exts] + slide.get_export_names(dst_base))
+        for source, name in names:
+            self.get_sink().copy(source, name)
+            self.disp("Linked '%s' to '%s'" % (name, source), 2)
 
     def format_inkscape_command(self, slide_type, svg_file, outfile, extra_args=''):
         """Builds the command to call inkscape depending on its version."""
-        if self.version.major == 0 and self.version.minor > 91:
-            command = '{} --export-{} {} {} {}'.format(self.inkPath, slide_type, outfile, extra_args, svg_file)
-        elif self.version.major >= 1:
-            command = '{} --export-type={} {} -o {} {}'.format(self.inkPath, slide_type, svg_file, outfile, extra_args)
-        return command
+        return format_inkscape_command(self.inkPath, self.version, slide_type, svg_file, outfile, extra_args)
 
     def svg2file(self, slide, filename='slide'):
         """
         Uses the inkscape executable to export the file to the specified format. Extra arguments are supported.
         The filename passed as argument can be the slide filename or the specific layer name for split mode.
+        When a slide has several types, the file is loaded once and exported to all of them.
         """
         if filename == 'slide':
             filename = slide.filename
-        p = pathlib.Path(self.infile_path + output_subfolder)
-        p.mkdir(parents=True, exist_ok=True)
-        outpath = self.infile_path + output_subfolder
-        svg_file = outpath + filename
-        base_name, ext = os.path.splitext(filename)
-        outfile = outpath + base_name + '.' + slide.type
-        command = self.format_inkscape_command(slide.type, svg_file, outfile, self.args.get('extra'))
-        self.disp("Running '%s'" % command, 2)
-        self.run(command, shell=True)
+        sink = self.get_sink()
+        svg_file = sink.work_path(filename)
+        exports = self.get_exports(slide, os.path.splitext(filename)[0])
+        extra = self.args.get('extra') or ''
+        area = None
+        if slide.area is not None and 'png' in slide.types:
+            # inkscape uses the export area for the raster exports only
+            area = self.format_export_area(slide.area)
+            extra = '%s %s' % (extra, area)
+        exports, keys = self.fetch_cached_exports(svg_file, exports, extra)
+        rendered = partial(self.export_rendered, keys)
+        if self.args.get('tile_size'):
+            exports = [e for e in exports if not (e[0] == 'png' and self.run_tiled_export(slide, svg_file, e, rendered))]
+        if len(exports) > 1 and self.can_export_together(svg_file, exports):
+            outputs = [(export_type, sink.new_path(name), dpi) for export_type, name, dpi, downsampled in exports]
+            self.run_exports(svg_file, outputs, extra if area else None,
+                             after=lambda: [rendered(e[1], e[3]) for e in exports])
+            return
+        for export_type, name, dpi, downsampled in exports:
+            if dpi is not None:
+                extra_args = '%s --export-dpi=%g' % (extra, dpi)
+            else:
+                extra_args = extra if area else None
+            self.run_export(export_type, svg_file, sink.new_path(name), extra_args,
+                            after=partial(rendered, name, downsampled))
+
+    def can_export_with_actions(self):
+        """
+        Checks whether the slides can be exported by a single inkscape run on the input
+        document (see export_with_actions). Reports the reason when they can not.
+        """
+        layer_ids = [layer.id for layer in self.slideConf.svg_file.layers]
+        names = [self.get_sink().path] + [slide.filename for slide in self.slideConf.slides]
+        reason = None
+        if (self.version.major, self.version.minor) < (1, 2):
+            reason = 'the actions used need Inkscape 1.2 or later'
+        elif self.slideConf.rasters:
+            reason = 'some layers are rasterized'
+        elif self.args.get('tile_size'):
+            reason = 'the exports are tiled'
+        elif any(x is None or ',' in x or ';' in x for x in layer_ids):
+            reason = 'some layers have no id or it includes "," or ";"'
+        elif any(';' in x for x in names):
+            reason = 'some file names include ";"'
+        if reason is not None:
+            self.disp('Exporting each slide from its own file: %s.' % reason, 1)
+            return False
+        return True
+
+    def export_with_actions(self, exports):
+        """
+        Exports the slides of the (slide, key) pairs *exports* with a single inkscape run,
+        which loads the input document once: an action script (see format_slide_actions)
+        sets the visibility of the layers of each slide and exports it.
+        The exports found in the render cache are left out.
+        """
+        sink = self.get_sink()
+        svg_file = self.slideConf.svg_file
+        extra = self.args.get('extra') or ''
+        dpi = re.search(r'--export-dpi[= ]([0-9.]+)', extra)
+        slides = []
+        exported = []
+        for slide, key in exports:
+            area = None
+            slide_extra = extra
+            if slide.area is not None and 'png' in slide.types:
+                area = '%g:%g:%g:%g' % slide.area
+                slide_extra = '%s %s' % (extra, self.format_export_area(slide.area))
+            missing, keys = self.fetch_cached_exports(sink.work_path(slide.filename),
+                                                      self.get_exports(slide, os.path.splitext(slide.filename)[0]),
+                                                      slide_extra)
+            if not missing:
+                continue
+            labels = slide.get_labels()
+            shown = [layer.id for layer in svg_file.layers if layer.get_label() in labels]
+            outputs = []
+            for export_type, name, export_dpi, downsampled in missing:
+                if os.path.exists(sink.new_path(name)):
+                    os.remove(sink.new_path(name))
+                outputs.append((export_type, sink.new_path(name), export_dpi))
+                exported.append((keys, name, downsampled))
+            slides.append((shown, area, outputs))
+        if not slides:
+            return
+        document = sink.new_path(svg_file.basefilename + '.actions.svg')
+        script = sink.new_path(svg_file.basefilename + '.actions')
+        with open(document, 'wb') as f:
+            f.write(etree.tostring(svg_file.tree, xml_declaration=True, encoding='utf-8'))
+        with open(script, 'w') as f:
+            f.write(format_slide_actions(svg_file.get_visible_layer_ids(), slides, float(dpi.group(1)) if dpi else 96))
+        def done():
+            os.remove(document)
+            os.remove(script)
+            for keys, name, downsampled in exported:
+                if not os.path.exists(sink.new_path(name)):
+                    raise RuntimeError("Inkscape did not export '%s'." % name)
+                self.export_rendered(keys, name, downsampled)
+        command = [self.inkPath, document, '--actions-file=' + script] + shlex.split(extra)
+        self.disp("Running '%s'" % shlex.join(command), 2)
+        stdout = self.get_output_stream() if self.args.get('verbosity') >= 1 else subprocess.DEVNULL
+        self.scheduler.submit('%s (%d slides)' % (svg_file.basefilename, len(slides)), command,
+                              stdout=stdout, after=done)
+
+    def get_exports(self, slide, base_name):
+        """
+        Returns the exports of the slide to the files *base_name*.*, as (type, name, dpi, downsampled)
+        tuples (see get_resolution_exports). The svg and svgz types are written by save_svg.
+        """
+        exports = []
+        for export_type in slide.types:
+            if export_type in slide.native_types:
+                continue
+            if slide.get_resolution_suffixes(export_type) != ['']:
+                exports += self.get_resolution_exports(slide, base_name)
+            else:
+                exports.append((export_type, base_name + '.' + export_type, None, []))
+        return exports
+
+    def fetch_cached_exports(self, svg_file, exports, extra):
+        """
+        Takes the exported files found in the render cache, if it is used.
+        Returns the exports still to run and the cache keys of their files {name: key}.
+        """
+        cache = self.get_render_cache()
+        if cache is None:
+            return exports, {}
+        sink = self.get_sink()
+        data = get_render_data(svg_file)
+        keys = {}
+        missing = []
+        for export_type, name, dpi, downsampled in exports:
+            keys[name] = cache.get_key(data, export_type, dpi, extra, self.version)
+            if cache.fetch(keys[name], sink.new_path(name)):
+                self.disp("Taken '%s' from the render cache" % name, 2)
+                self.export_done(name, downsampled)
+            else:
+                missing.append((export_type, name, dpi, downsampled))
+        return missing, keys
+
+    def export_rendered(self, keys, name, downsampled):
+        """
+        Called when inkscape exported the file *name*: stores it in the render cache
+        if it has a key in *keys*, then finishes it (see export_done).
+        """
+        if name in keys:
+            self.store_rendered(self.get_render_cache(), keys[name], self.get_sink().new_path(name))
+        self.export_done(name, downsampled)
+
+    def export_done(self, name, downsampled):
+        """
+        Called when the file *name* is exported: the files downsampled from it are written,
+        the PNG files optimized and all of them collected by the sink.
+        The optimization runs in the post-processing pool, overlapping with the next exports.
+        """
+        if self.slideConf.optimize:
+            self.scheduler.post(self.finish_export, name, downsampled)
+        else:
+            self.finish_export(name, downsampled)
+
+    def finish_export(self, name, downsampled):
+        sink = self.get_sink()
+        if downsampled:
+            downsample_png(sink.new_path(name), [(sink.new_path(x), scale) for x, scale in downsampled])
+        names = [name] + [x for x, scale in downsampled]
+        if self.slideConf.optimize:
+            for x in names:
+                if x.endswith('.png'):
+                    self.report_optimization(x, optimize_png(sink.new_path(x)))
+        sink.collect(names)
+
+    def get_render_cache(self):
+        """
+        Returns the render cache, or None if it is not used.
+        """
+        if self.render_cache is None and self.args.get('render_cache'):
+            size = parse_size(self.args.get('render_cache_size') or '5G')
+            self.render_cache = RenderCache(self.args.get('render_cache'), size)
+        return self.render_cache
+
+    def store_rendered(self, cache, key, path):
+        """
+        Adds an exported file to the render cache. The cache is not required for the export,
+        so its errors are only reported.
+        """
+        try:
+            cache.store(key, path)
+        except OSError as e:
+            self.disp('Render cache not updated: %s' % e, 1)
+
+    def run_tiled_export(self, slide, svg_file, export, done):
+        """
+        Renders a PNG export larger than the tile size in horizontal bands, exported
+        in parallel and stitched together (see stitch_png_bands) once they are all done.
+        Returns False if the export is small enough or the export size is unknown.
+        """
+        export_type, name, dpi, downsampled = export
+        extra = self.args.get('extra') or ''
+        # the size of the export is set by the bands
+        if any(option in extra for option in ['--export-dpi', '--export-width', '--export-height', '--export-area']):
+            return False
+        area = slide.area
+        if area is None:
+            root = self.slideConf.svg_file.tree.getroot()
+            width, height = get_page_width(root), get_page_height(root)
+            if width is None or height is None:
+                return False
+            area = (0, 0, width, height)
+        scale = (dpi or 96) / 96
+        width = int(round((area[2] - area[0]) * scale))
+        height = int(round((area[3] - area[1]) * scale))
+        tile_pixels = self.args.get('tile_size') ** 2
+        if width * height <= tile_pixels:
+            return False
+        bands = get_tile_bands(area, width, height, tile_pixels)
+        outfile = self.get_sink().new_path(name)
+        band_files = ['%s.band-%d.png' % (os.path.splitext(outfile)[0], i) for i in range(len(bands))]
+        remaining = [len(bands)]
+        lock = threading.Lock()
+        def band_done():
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            stitch_png_bands(band_files, outfile)
+            for band_file in band_files:
+                os.remove(band_file)
+            done(name, downsampled)
+        self.disp("Rendering '%s' (%dx%d pixels) in %d bands" % (name, width, height, len(bands)), 1)
+        for (band_area, rows), band_file in zip(bands, band_files):
+            extra_args = '%s %s --export-width=%d --export-height=%d' % (extra, self.format_export_area(band_area), width, rows)
+            self.run_export('png', svg_file, band_file, extra_args, after=band_done)
+        return True
+
+    def report_optimization(self, name, sizes):
+        """
+        Reports the bytes saved by the optimization of a PNG file.
+        """
+        before, after = sizes
+        self.optimized.append(sizes)
+        self.disp("Optimized '%s': %d -> %d bytes (-%.1f%%)" % (name, before, after, 100.0 * (before - after) / max(before, 1)), 1)
+
+    def get_resolution_exports(self, slide, base_name):
+        """
+        Returns the exports of a PNG slide at all its resolutions, as
+        (type, name, dpi, downsampled) tuples, where downsampled lists the
+        (name, scale) pairs of the files downsampled from the exported one.
+        The slide is rendered once at the highest resolution, the others are
+        downsampled from it. Without Pillow, each resolution is rendered by inkscape.
+        """
+        suffixes = slide.get_resolution_suffixes('png')
+        names = [base_name + suffix + '.png' for suffix in suffixes]
+        dpis = [slide.resolutions[suffix] for suffix in suffixes]
+        if importlib.util.find_spec('PIL') is None:
+            self.disp('Pillow not found: rendering each resolution with inkscape.', 1)
+            return [('png', name, dpi, []) for name, dpi in zip(names, dpis)]
+        return [('png', names[0], dpis[0], [(name, dpi / dpis[0]) for name, dpi in zip(names[1:], dpis[1:])])]
+
+    def can_export_together(self, svg_file, exports):
+        """
+        Checks whether the exports can be done by a single inkscape run.
+        """
+        if self.version.major >= 1:
+            # the file names are part of the actions, separated by ';'
+            return not any(';' in name for name in [svg_file] + [e[1] for e in exports])
+        types = [e[0] for e in exports]
+        # the dpi applies to all the exports
+        return len(set(types)) == len(types) and len(set(e[2] for e in exports)) <= 1
+
+    def run_export(self, export_type, svg_file, outfile, extra_args=None, after=None):
+        """
+        Runs inkscape to export *svg_file* to *outfile*.
+        *extra_args* replaces the extra options of the command line,
+        *after* is called once the export is done.
+        """
+        extra = self.args.get('extra') if extra_args is None else extra_args
+        command = self.format_inkscape_command(export_type, svg_file, outfile, extra)
+        self.disp("Running '%s'" % shlex.join(command), 2)
+        stdout = self.get_output_stream() if self.args.get('verbosity') >= 1 else subprocess.DEVNULL
+        self.scheduler.submit(os.path.basename(outfile), command, stdout=stdout, after=after,
+                              group=self.timing_key)
+
+    def run_exports(self, svg_file, exports, extra_args=None, after=None):
+        """
+        Runs inkscape once to export *svg_file* to several files.
+        *exports* is a list of (type, outfile, dpi) tuples,
+        *extra_args* replaces the extra options of the command line,
+        *after* is called once the exports are done.
+        """
+        extra = self.args.get('extra') if extra_args is None else extra_args
+        command = format_inkscape_exports_command(self.inkPath, self.version, svg_file, exports, extra or '')
+        self.disp("Running '%s'" % shlex.join(command), 2)
+        stdout = self.get_output_stream() if self.args.get('verbosity') >= 1 else subprocess.DEVNULL
+        self.scheduler.submit(os.path.basename(svg_file), command, stdout=stdout, after=after,
+                              group=self.timing_key)
 
     def report_layers_info(self, svg_file):
         """
@@ -800,37 +2398,73 @@ class InklayersShell(InklayersSystem):
         lines = ["#%d: '%s'" % (i, x.get_label()) for i, x in enumerate(svg_file.layers)]
         return lines
 
+    def report_layer_costs(self, svg_file, fmt='table'):
+        """
+        Retrieve the statistics of the layers of a SVG file (see SVGFile.get_layer_stats),
+        with the number of slides including each layer and, if the measure option was
+        specified, the time to render each layer alone.
+        Returns the set of strings to print, as a table or as JSON.
+        """
+        stats = svg_file.get_layer_stats()
+        counts = Counter(layer.get_label() for slide in self.slideConf.slides for layer in slide.layers)
+        for layer in stats:
+            layer['slides'] = counts[layer['label']]
+        if self.args.get('measure'):
+            self.measure_layers(svg_file, stats)
+        if fmt == 'json':
+            return json.dumps(stats, indent=2).splitlines()
+        columns = ['index', 'label', 'elements', 'bytes', 'image_bytes', 'filters', 'blurs', 'masks', 'texts', 'slides']
+        if self.args.get('measure'):
+            columns += ['time', 'total_time']
+        rows = [['#'] + columns[1:]] + [['#%d' % x['index'] if c == 'index' else
+                             '%.2f' % x[c] if c.endswith('time') else str(x[c]) for c in columns] for x in stats]
+        widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+        return ['  '.join(value.ljust(w) if c == 'label' else value.rjust(w)
+                          for c, value, w in zip(columns, row, widths)).rstrip() for row in rows]
+
+    def measure_layers(self, svg_file, stats):
+        """
+        Renders each layer alone to PNG and adds its 'time' (seconds) to the layer statistics,
+        and the 'total_time' of the slides including it. The time of rendering the
+        content that is not in any layer is measured once and left out.
+        """
+        extra = self.args.get('extra') or ''
+        with tempfile.TemporaryDirectory() as tmpdir:
+            svg = os.path.join(tmpdir, 'layer.svg')
+            def measure(labels, name):
+                with open(svg, 'wb') as f:
+                    f.write(etree.tostring(svg_file.get_filtered_obj(labels)))
+                command = self.format_inkscape_command('png', svg, os.path.join(tmpdir, 'layer.png'), extra)
+                usage = run_measured(name, command, stdout=subprocess.DEVNULL)
+                self.disp(ExportScheduler.format_usage(usage), 2)
+                return usage.wall
+            base = measure([], 'no layers')
+            for layer in stats:
+                layer['time'] = max(0.0, measure([layer['label']], layer['label']) - base)
+                layer['total_time'] = layer['time'] * layer['slides']
+
     def print_latex_code(self, infile):
         """Print code for inclusion into LaTeX documents.
         """
-        latex_basename = self.fileHandler.get_basename(infile)
-        outpath = self.infile_path + output_subfolder
-        fullpath = outpath + latex_basename + '.inc.tex'
-        with open(fullpath, 'w') as latex_file:
-            for i, slide in enumerate(self.slideConf.slides):
-                base_name, ext = os.path.splitext(slide.filename)
-                slide_name = base_name + '.' + slide.type
-                latex_file.write('\\includegraphics<{}|handout:0>[width=1.0\\columnwidth]{{{}}}%\n'.format(i + 1, slide_name))
+        latex_basename = self.fileHandler.get_basename(os.path.basename(infile))
+        lines = []
+        for i, slide in enumerate(self.slideConf.slides):
+            base_name, ext = os.path.splitext(slide.filename)
+            # the highest resolution is used for raster slides exported at several resolutions
+            latex_type = slide.get_latex_type()
+            slide_name = base_name + slide.get_resolution_suffixes(latex_type)[0] + '.' + latex_type
+            lines.append('\\includegraphics<{}|handout:0>[width=1.0\\columnwidth]{{{}}}%\n'.format(i + 1, slide_name))
+        self.get_sink().write(latex_basename + '.inc.tex', ''.join(lines).encode('utf-8'))
+
+    def get_output_stream(self):
+        """
+        Returns the stream for messages: stderr when the archive is written to stdout.
+        """
+        return sys.stderr if self.args.get('archive') == '-' else sys.stdout
 
     def disp(self, msg, level):
         """
         Print function that handles verbosity level.
         """
         if self.args.get('verbosity') >= level:
-            print(msg)
-
-
-def main():
-    # load command line arguments, initialize system
-    prog = InklayersShell(get_commandLine())
-    prog.fix_wildcard_names()
-    # process input files & export/save
-    prog.process_files()
-
-
-if __name__ == '__main__':
-    main()
-
-
-
-
+            print(msg, file=self.get_output_stream())
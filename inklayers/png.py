@@ -0,0 +1,243 @@
+"""
+PNG files of inklayers.
+
+Lossless optimization, downsampling and stitching of the exported PNG images.
+The chunks are handled directly, Pillow is only needed to downsample the images
+and to convert them to palette images.
+"""
+import io
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+def downsample_png(source, targets):
+    """
+    Writes downsampled copies of the PNG image *source*, in parallel.
+    *targets* is a list of (filename, scale) pairs. Requires Pillow.
+    """
+    from PIL import Image
+    resample = getattr(Image, 'Resampling', Image).LANCZOS
+    with Image.open(source) as image:
+        image.load()
+    def resize(target):
+        filename, scale = target
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image.resize(size, resample).save(filename, optimize=True)
+    with ThreadPoolExecutor() as pool:
+        list(pool.map(resize, targets))
+
+
+png_signature = b'\x89PNG\r\n\x1a\n'
+# ancillary chunks dropped by the PNG optimization: texts and modification time
+png_stripped_chunks = {b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+
+
+def read_png_chunks(data):
+    """
+    Returns the list of (type, data) chunks of the PNG image *data*.
+    """
+    if not data.startswith(png_signature):
+        raise ValueError('Not a PNG image.')
+    chunks = []
+    pos = len(png_signature)
+    while pos + 8 <= len(data):
+        length, = struct.unpack('>I', data[pos:pos + 4])
+        chunks.append((data[pos + 4:pos + 8], data[pos + 8:pos + 8 + length]))
+        pos += length + 12
+    return chunks
+
+
+def format_png_chunk(chunk_type, chunk_data):
+    """
+    Returns the bytes of a PNG chunk: length, type, data and CRC.
+    """
+    crc = zlib.crc32(chunk_type + chunk_data) & 0xffffffff
+    return struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data + struct.pack('>I', crc)
+
+
+def write_png_chunks(chunks):
+    """
+    Returns the PNG image made of the (type, data) *chunks*.
+    """
+    return b''.join([png_signature] + [format_png_chunk(chunk_type, chunk_data) for chunk_type, chunk_data in chunks])
+
+
+def recompress_png(data):
+    """
+    Returns the PNG image *data* without metadata and with the image data
+    recompressed with the best zlib settings. The filtered rows are not changed.
+    """
+    chunks = [chunk for chunk in read_png_chunks(data) if chunk[0] not in png_stripped_chunks]
+    raw = zlib.decompress(b''.join(chunk_data for chunk_type, chunk_data in chunks if chunk_type == b'IDAT'))
+    best = None
+    for strategy in [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED]:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+        compressed = compressor.compress(raw) + compressor.flush()
+        if best is None or len(compressed) < len(best):
+            best = compressed
+    result = []
+    for chunk_type, chunk_data in chunks:
+        if chunk_type != b'IDAT':
+            result.append((chunk_type, chunk_data))
+        elif best is not None:
+            # all the image data goes to a single IDAT chunk
+            result.append((b'IDAT', best))
+            best = None
+    return write_png_chunks(result)
+
+
+def palette_png(data):
+    """
+    Returns the PNG image *data* converted to a palette image, or None if the image
+    has more than 256 colors or the conversion would not be lossless. Requires Pillow.
+    """
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+    # images with color management data are left as they are
+    if image.mode not in ('RGB', 'RGBA') or \
+            any(key in image.info for key in ('icc_profile', 'gamma', 'srgb', 'chromaticity')):
+        return None
+    colors = image.getcolors(256)
+    if colors is None:
+        return None
+    # the palette has just the colors used, so that it is as short as possible
+    quantized = image.quantize(len(colors), method=getattr(Image, 'Quantize', Image).FASTOCTREE)
+    out = io.BytesIO()
+    options = {'dpi': image.info['dpi']} if 'dpi' in image.info else {}
+    quantized.save(out, 'PNG', optimize=True, **options)
+    result = out.getvalue()
+    with Image.open(io.BytesIO(result)) as check:
+        if check.convert(image.mode).tobytes() != image.tobytes():
+            return None
+    return result
+
+
+def optimize_png_data(data, palette=True):
+    """
+    Returns the PNG image *data* losslessly optimized: without metadata, recompressed
+    and, if *palette* is true and Pillow is available, converted to a palette when possible.
+    The original data is returned if it is already smaller.
+    """
+    candidates = [data, recompress_png(data)]
+    if palette:
+        try:
+            converted = palette_png(data)
+        except ImportError:
+            converted = None
+        if converted is not None:
+            candidates.append(recompress_png(converted))
+    return min(candidates, key=len)
+
+
+def optimize_png(filename, palette=True):
+    """
+    Optimizes the PNG file *filename* in place (see optimize_png_data).
+    Returns the sizes of the file before and after the optimization.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    optimized = optimize_png_data(data, palette)
+    if len(optimized) < len(data):
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(optimized)
+        os.replace(tmp, filename)
+    return len(data), len(optimized)
+
+
+def iter_png_file_chunks(f):
+    """
+    Yields the (type, data) chunks of the PNG file object *f*, one at a time.
+    """
+    if f.read(len(png_signature)) != png_signature:
+        raise ValueError('Not a PNG image.')
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return
+        length, = struct.unpack('>I', head[:4])
+        chunk_data = f.read(length)
+        f.read(4)
+        yield head[4:], chunk_data
+        if head[4:] == b'IEND':
+            return
+
+
+def unfilter_first_row(row, bpp):
+    """
+    Returns the first scanline of a PNG image (filter type byte included) stored
+    without filter. The previous row of the first scanline is zero, so only
+    the Sub, Average and Paeth filters change its bytes.
+    """
+    filter_type = row[0]
+    raw = bytearray(row[1:])
+    if filter_type in (1, 4):
+        # Paeth with a zero previous row always predicts the left byte, as Sub
+        for i in range(bpp, len(raw)):
+            raw[i] = (raw[i] + raw[i - bpp]) & 0xff
+    elif filter_type == 3:
+        for i in range(bpp, len(raw)):
+            raw[i] = (raw[i] + (raw[i - bpp] >> 1)) & 0xff
+    return b'\x00' + bytes(raw)
+
+
+def stitch_png_bands(bands, outfile, chunk_size=1 << 20):
+    """
+    Writes to *outfile* the PNG image made of the PNG images *bands* (file names,
+    from top to bottom), which must have the same width and pixel format.
+    The image data is streamed: it is decompressed and compressed again a chunk at
+    a time, so the memory used does not depend on the size of the images.
+    Only the first row of each band is changed, as it was filtered against a zero row.
+    """
+    headers = []
+    palettes = set()
+    for band in bands:
+        with open(band, 'rb') as f:
+            chunks = iter_png_file_chunks(f)
+            chunk_type, header = next(chunks)
+            headers.append(struct.unpack('>IIBBBBB', header))
+            for chunk_type, chunk_data in chunks:
+                if chunk_type in (b'PLTE', b'IDAT'):
+                    palettes.add(chunk_data if chunk_type == b'PLTE' else None)
+                    break
+    width, height, depth, color_type, compression, filters, interlace = headers[0]
+    if interlace or len(palettes) > 1 or any(h[0] != width or h[2:] != headers[0][2:] for h in headers):
+        raise ValueError('The PNG bands must have the same width and format, without interlacing.')
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    row_size = 1 + (width * channels * depth + 7) // 8
+    bpp = max(1, channels * depth // 8)
+    compressor = zlib.compressobj(6)
+    with open(outfile, 'wb') as out:
+        out.write(png_signature)
+        total = sum(h[1] for h in headers)
+        out.write(format_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, total, *headers[0][2:])))
+        pending = []
+        def write_data(data):
+            pending.append(data)
+            if sum(len(x) for x in pending) >= chunk_size:
+                out.write(format_png_chunk(b'IDAT', b''.join(pending)))
+                del pending[:]
+        for i, band in enumerate(bands):
+            decompressor = zlib.decompressobj()
+            first = b''
+            with open(band, 'rb') as f:
+                for chunk_type, chunk_data in iter_png_file_chunks(f):
+                    if chunk_type == b'IDAT':
+                        data = decompressor.decompress(chunk_data)
+                        if len(first) < row_size:
+                            first += data
+                            if len(first) < row_size:
+                                continue
+                            data = first[row_size:]
+                            write_data(compressor.compress(unfilter_first_row(first[:row_size], bpp)))
+                        write_data(compressor.compress(data))
+                    elif i == 0 and not first and chunk_type != b'IHDR' and chunk_type not in png_stripped_chunks:
+                        # the chunks preceding the image data of the first band (palette, resolution) are kept
+                        out.write(format_png_chunk(chunk_type, chunk_data))
+            write_data(compressor.compress(decompressor.flush()))
+        write_data(compressor.flush())
+        out.write(format_png_chunk(b'IDAT', b''.join(pending)))
+        out.write(format_png_chunk(b'IEND', b''))
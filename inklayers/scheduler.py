@@ -0,0 +1,208 @@
+"""
+Export scheduler of inklayers.
+
+Runs the inkscape commands, possibly in parallel, measuring their resource usage
+so that the number of parallel exports fits in the available memory.
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+ResourceUsage = namedtuple('ResourceUsage', ['name', 'wall', 'cpu', 'maxrss'])
+
+
+def run_measured(name, command, shell=False, stdout=None):
+    """
+    Runs a command and returns its resource usage: wall time and CPU time (seconds)
+    and peak resident memory (bytes, None where it can not be measured).
+    Raises CalledProcessError if the command fails.
+    """
+    start = time.monotonic()
+    process = subprocess.Popen(command, shell=shell, stdout=stdout)
+    if hasattr(os, 'wait4'):
+        pid, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        cpu = rusage.ru_utime + rusage.ru_stime
+        # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+        maxrss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    else:
+        process.wait()
+        cpu = None
+        maxrss = None
+    wall = time.monotonic() - start
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return ResourceUsage(name, wall, cpu, maxrss)
+
+
+def get_available_memory():
+    """
+    Returns the memory available for new processes in bytes, None if unknown.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class ExportScheduler:
+    """
+    Runs the export commands, possibly in parallel, and collects their resource usage.
+    With the adaptive mode, the number of parallel exports starts from one and is
+    updated after each export, so that the measured peak memory of the exports
+    fits in the available memory.
+    """
+    # fraction of the available memory that the exports may use
+    memory_margin = 0.8
+
+    def __init__(self, jobs='1', disp=None):
+        self.adaptive = (jobs == 'auto')
+        if self.adaptive:
+            self.max_jobs = os.cpu_count() or 1
+            self.limit = 1
+        else:
+            self.max_jobs = max(1, int(jobs))
+            self.limit = self.max_jobs
+        self.disp = disp if disp is not None else (lambda msg, level: None)
+        self.usages = []
+        # total wall time of the commands of each group (see submit)
+        self.group_times = {}
+        self.running = 0
+        self.condition = threading.Condition()
+        self.futures = []
+        self.executor = None
+        self.post_futures = []
+        self.post_executor = None
+
+    def submit(self, name, command, shell=False, stdout=None, after=None, group=None):
+        """
+        Runs the command: immediately if one job is used, in a worker thread otherwise.
+        *after* is called when the command is done.
+        The wall time of the command is added to the one of *group*, if given.
+        """
+        if self.max_jobs == 1:
+            self._run(name, command, shell, stdout, after, group)
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_jobs)
+        self.futures.append(self.executor.submit(self._run, name, command, shell, stdout, after, group))
+
+    def post(self, function, *args):
+        """
+        Runs function(*args) in the post-processing pool, while the exports continue.
+        """
+        with self.condition:
+            if self.post_executor is None:
+                self.post_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+            self.post_futures.append(self.post_executor.submit(function, *args))
+
+    def wait(self):
+        """
+        Waits for the submitted commands and for their post-processing. Raises the first error found.
+        """
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+        # the commands are done, no more post-processing can be submitted
+        with self.condition:
+            futures, self.post_futures = self.post_futures, []
+        for future in futures:
+            future.result()
+
+    def _run(self, name, command, shell, stdout, after=None, group=None):
+        with self.condition:
+            while self.running >= self.limit:
+                self.condition.wait()
+            self.running += 1
+        usage = None
+        try:
+            usage = run_measured(name, command, shell, stdout)
+        finally:
+            with self.condition:
+                self.running -= 1
+                if usage is not None:
+                    self.usages.append(usage)
+                    if group is not None:
+                        self.group_times[group] = self.group_times.get(group, 0.0) + usage.wall
+                    if self.adaptive:
+                        self.tune()
+                self.condition.notify_all()
+        self.disp(self.format_usage(usage), 1)
+        if after is not None:
+            after()
+
+    def tune(self):
+        """
+        Updates the number of parallel exports from the largest peak memory measured so far.
+        """
+        peaks = [u.maxrss for u in self.usages if u.maxrss]
+        available = get_available_memory()
+        if not peaks or available is None:
+            self.limit = self.max_jobs
+            return
+        peak = max(peaks)
+        # the memory of the exports still running is already taken from the available one
+        budget = available + self.running * peak
+        limit = max(1, min(self.max_jobs, int(budget * self.memory_margin // peak)))
+        if limit != self.limit:
+            self.disp('Parallel exports: %d -> %d' % (self.limit, limit), 2)
+        self.limit = limit
+
+    @staticmethod
+    def format_usage(usage):
+        cpu = '-' if usage.cpu is None else '%.2fs' % usage.cpu
+        rss = '-' if usage.maxrss is None else '%.1f MiB' % (usage.maxrss / 2**20)
+        return 'Exported %s: wall %.2fs, cpu %s, peak RSS %s' % (usage.name, usage.wall, cpu, rss)
+
+    def summary(self):
+        """
+        Returns the lines summarizing the resource usage of the exports, and resets it.
+        """
+        usages, self.usages = self.usages, []
+        if not usages:
+            return []
+        cpu = sum(u.cpu for u in usages if u.cpu is not None)
+        lines = ['Exports: %d, wall %.2fs, cpu %.2fs' % (len(usages), sum(u.wall for u in usages), cpu)]
+        measured = [u for u in usages if u.maxrss]
+        if measured:
+            heaviest = max(measured, key=lambda u: u.maxrss)
+            lines.append('Peak RSS: %.1f MiB (%s)' % (heaviest.maxrss / 2**20, heaviest.name))
+        slowest = max(usages, key=lambda u: u.wall)
+        lines.append('Slowest export: %.2fs (%s)' % (slowest.wall, slowest.name))
+        return lines
+
+
+def order_longest_first(items, durations, preview=0):
+    """
+    Returns the *items* in the order they should be exported: the first *preview*
+    items in their order, then the ones with an unknown duration (None), which may
+    be the longest ones, then the others by decreasing duration.
+    """
+    rest = list(zip(items, durations))[preview:]
+    unknown = [item for item, duration in rest if duration is None]
+    known = sorted([x for x in rest if x[1] is not None], key=lambda x: -x[1])
+    return list(items[:preview]) + unknown + [item for item, duration in known]
+
+
+def estimate_wall_time(durations, jobs):
+    """
+    Returns the wall time of running the commands lasting *durations*, in this order,
+    on *jobs* parallel workers: each command starts on the first worker available.
+    """
+    workers = [0.0] * max(1, jobs)
+    for duration in durations:
+        i = workers.index(min(workers))
+        workers[i] += duration
+    return max(workers)
@@ -0,0 +1,444 @@
+"""
+Render server of inklayers.
+
+Keeps the parsed SVG files and a pool of inkscape processes warm between
+requests, so that repeated exports do not pay the startup costs.
+Requests are JSON objects, one per line, received on a Unix socket or a TCP port.
+"""
+import argparse
+import ipaddress
+import json
+import os
+import queue
+import shlex
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+from .cli import get_parser
+from .inklayers import FileHandler, InklayersShell, get_inkscape
+
+
+# arguments writing files outside the output folder of the project, not accepted from the clients
+writing_arguments = ['archive', 'emit_ninja', 'emit_make', 'render_cache', 'outfolder']
+
+# inkscape options that the clients can pass with --extra, in the --name=value form
+export_options = {
+    'export-area', 'export-area-drawing', 'export-area-page', 'export-area-snap', 'export-background',
+    'export-background-opacity', 'export-dpi', 'export-height', 'export-id', 'export-id-only',
+    'export-ignore-filters', 'export-latex', 'export-margin', 'export-pdf-version', 'export-png-antialias',
+    'export-png-color-mode', 'export-ps-level', 'export-text-to-path', 'export-width',
+}
+
+
+def default_address():
+    """
+    Returns the default address of the server: a per-user Unix socket where supported.
+    """
+    if sys.platform == 'win32':
+        return 'localhost:8437'
+    return os.path.join(tempfile.gettempdir(), 'inklayers-{}.sock'.format(os.getuid()))
+
+
+def parse_address(address):
+    """
+    Returns the socket family and address.
+    'port' and 'host:port' are TCP addresses, anything else is a Unix socket path.
+    """
+    if address.isdigit():
+        return socket.AF_INET, ('127.0.0.1', int(address))
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, address
+
+
+def is_loopback(host):
+    """
+    Returns True if *host* is 'localhost' or a loopback IP address.
+    """
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def extra_to_actions(extra):
+    """
+    Translates the '--export-*' inkscape options into shell actions.
+    Raises ValueError if some option is not one of export_options.
+    Example: '--export-dpi=300 --export-area-drawing' -> ['export-dpi:300', 'export-area-drawing']
+    """
+    actions = []
+    for arg in shlex.split(extra or ''):
+        name, sep, value = arg[2:].partition('=')
+        if not arg.startswith('--') or name not in export_options or '\n' in value or ';' in value:
+            raise ValueError("Inkscape option not allowed: '{}'".format(arg))
+        actions.append(name + ':' + value if sep else name)
+    return actions
+
+
+def check_args(args):
+    """
+    Checks the command line arguments of a request. Only the options of the
+    inklayers command line are accepted, the server inkscape is used, the output
+    files are written to the output folder of the project (see writing_arguments)
+    and the extra inkscape options must be in export_options. Raises ValueError otherwise.
+    """
+    if not isinstance(args, dict):
+        raise ValueError('The arguments of a request must be an object.')
+    known = set(vars(get_parser().parse_args(['-'])))
+    unknown = sorted(set(args) - known)
+    if unknown:
+        raise ValueError('Unknown arguments: ' + ', '.join(unknown))
+    if args.get('inkscape') not in (None, 'Default'):
+        raise ValueError('The render server uses its own inkscape.')
+    for key in writing_arguments:
+        if args.get(key) is not None:
+            raise ValueError("Argument not accepted by the render server: '{}'".format(key))
+    outfile = args.get('outfile') or ''
+    if not isinstance(outfile, str) or os.path.isabs(outfile) or '..' in outfile.replace('\\', '/').split('/'):
+        raise ValueError('The output file names must be relative to the output folder of the project.')
+    if not isinstance(args.get('extra') or '', str):
+        raise ValueError('The extra inkscape options must be a string.')
+    extra_to_actions(args.get('extra'))
+
+
+def is_action_safe(text):
+    """
+    Returns True if *text* (a file name) can be part of a line of shell actions.
+    """
+    return ';' not in text and '\n' not in text
+
+
+class SVGCache:
+    """
+    LRU cache of the parsed SVG files, keyed by path and modification time.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename, basename, loader):
+        """
+        Returns the cached svg file object, or the one created by *loader* if the
+        file is not in the cache or it was modified.
+        """
+        key = (os.path.abspath(filename), basename)
+        mtime = os.stat(filename).st_mtime_ns
+        with self.lock:
+            entry = self.files.get(key)
+            if entry is not None and entry[0] == mtime:
+                self.files.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        svg_file = loader()
+        with self.lock:
+            self.files[key] = (mtime, svg_file)
+            self.files.move_to_end(key)
+            while len(self.files) > self.size:
+                self.files.popitem(last=False)
+        return svg_file
+
+
+class CachingFileHandler(FileHandler):
+    """
+    File handler that takes the svg file objects from the server cache.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get_svg_file(self, filename, basename):
+        return self.cache.get(filename, basename, lambda: FileHandler.get_svg_file(self, filename, basename))
+
+
+class InkscapeWorker:
+    """
+    An inkscape process running in shell mode, exporting files one after the other.
+    """
+    prompt = b'> '
+
+    def __init__(self, inkPath):
+        self.inkPath = inkPath
+        self.process = None
+        self.action_names = None
+
+    def start(self):
+        self.process = subprocess.Popen([self.inkPath, '--shell'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.read_reply()
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+    def read_reply(self):
+        """
+        Reads the output of the shell until the prompt is shown again.
+        """
+        data = b''
+        while not data.endswith(self.prompt):
+            chunk = self.process.stdout.read1(4096)
+            if not chunk:
+                raise RuntimeError('Inkscape shell terminated unexpectedly.')
+            data += chunk
+        return data
+
+    def export(self, svg_file, exports, actions):
+        """
+        Opens *svg_file* once and exports it to the (type, outfile) pairs *exports*.
+        The export options persist in the inkscape shell: they are set again for
+        each export, and the process is restarted when some option is no longer used.
+        """
+        action_names = [action.partition(':')[0] for action in actions]
+        if action_names != self.action_names:
+            self.stop()
+            self.action_names = action_names
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        command = ['file-open:' + svg_file]
+        for export_type, outfile in exports:
+            if os.path.exists(outfile):
+                os.remove(outfile)
+            command += ['export-type:' + export_type, 'export-filename:' + outfile] + actions + ['export-do']
+        command.append('file-close')
+        self.process.stdin.write((';'.join(command) + '\n').encode('utf-8'))
+        self.process.stdin.flush()
+        self.read_reply()
+        for export_type, outfile in exports:
+            if not os.path.exists(outfile):
+                raise RuntimeError("Inkscape shell did not export '{}'.".format(outfile))
+
+
+class WorkerPool:
+    """
+    Pool of warm inkscape workers.
+    """
+    def __init__(self, inkPath, size):
+        self.all_workers = [InkscapeWorker(inkPath) for i in range(size)]
+        self.workers = queue.Queue()
+        for worker in self.all_workers:
+            worker.start()
+            self.workers.put(worker)
+
+    def export(self, svg_file, exports, actions):
+        worker = self.workers.get()
+        try:
+            worker.export(svg_file, exports, actions)
+        except Exception:
+            worker.stop()
+            raise
+        finally:
+            self.workers.put(worker)
+
+    def stop(self):
+        for worker in self.all_workers:
+            worker.stop()
+
+
+class InklayersServerShell(InklayersShell):
+    """
+    InklayersShell processing one request of the render server.
+    Uses the server caches and collects the output instead of printing it.
+    """
+    def __init__(self, args, server):
+        self.server = server
+        self.output = []
+        InklayersShell.__init__(self, args)
+        self.fileHandler = CachingFileHandler(server.svg_cache)
+
+    def verify_inkscape(self):
+        return self.server.inkPath, self.server.version
+
+    def run_export(self, export_type, svg_file, outfile, extra_args=None, after=None):
+        """
+        Exports using a warm worker when possible, running inkscape otherwise.
+        """
+        extra = self.args.get('extra') if extra_args is None else extra_args
+        actions = extra_to_actions(extra)
+        if self.server.workers is None or not is_action_safe(svg_file + outfile):
+            InklayersShell.run_export(self, export_type, svg_file, outfile, extra_args, after)
+            return
+        self.disp("Exporting '%s' with a warm worker" % outfile, 2)
+        try:
+            self.server.workers.export(svg_file, [(export_type, outfile)], actions)
+        except RuntimeError as e:
+            self.disp('%s Running inkscape.' % e, 1)
+            InklayersShell.run_export(self, export_type, svg_file, outfile, extra_args, after)
+            return
+        if after is not None:
+            after()
+
+    def run_exports(self, svg_file, exports, extra_args=None, after=None):
+        """
+        Exports to several files with one file-open of a warm worker when possible.
+        """
+        actions = extra_to_actions(self.args.get('extra') if extra_args is None else extra_args)
+        outfiles = [outfile for export_type, outfile, dpi in exports]
+        # the export dpi would persist in the worker: exports at a given dpi run inkscape
+        if (self.server.workers is None or not is_action_safe(svg_file + ''.join(outfiles))
+                or any(dpi is not None for export_type, outfile, dpi in exports)):
+            InklayersShell.run_exports(self, svg_file, exports, extra_args, after)
+            return
+        self.disp("Exporting '%s' with a warm worker" % "', '".join(outfiles), 2)
+        try:
+            self.server.workers.export(svg_file, [(export_type, outfile) for export_type, outfile, dpi in exports], actions)
+        except RuntimeError as e:
+            self.disp('%s Running inkscape.' % e, 1)
+            InklayersShell.run_exports(self, svg_file, exports, extra_args, after)
+            return
+        if after is not None:
+            after()
+
+    def disp(self, msg, level):
+        if self.args.get('verbosity') >= level:
+            self.output.append(str(msg))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads one JSON request and writes back one JSON reply.
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            request = json.loads(line.decode('utf-8'))
+            reply = self.server.render_server.process_request(request)
+        except Exception as e:
+            reply = {'status': 1, 'output': [], 'error': '{}: {}'.format(type(e).__name__, e)}
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+class RenderServer:
+    """
+    Server processing the requests of the inklayers clients.
+    A request has the form {"args": {...}}, where args are the command line
+    arguments of the client (input files with absolute paths).
+    """
+    def __init__(self, address, inkPath='Default', workers=2, cache_size=32, allow_remote=False):
+        self.address = address
+        family, addr = parse_address(address)
+        if family == socket.AF_INET and not allow_remote and not is_loopback(addr[0]):
+            raise ValueError("Not a loopback address: '{}'. Use --allow-remote to accept remote clients.".format(addr[0]))
+        self.svg_cache = SVGCache(cache_size)
+        self.inkPath, self.version = get_inkscape(inkPath)
+        # the shell actions used by the workers are available since inkscape 1.0
+        if self.version.major >= 1 and workers > 0:
+            self.workers = WorkerPool(self.inkPath, workers)
+        else:
+            self.workers = None
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.remove(addr)
+            server_class = UnixServer
+        else:
+            server_class = TCPServer
+        self.server = server_class(addr, RequestHandler)
+        self.server.render_server = self
+
+    def process_request(self, request):
+        if request.get('command') == 'stats':
+            return {'status': 0, 'output': ['SVG cache: %d hits, %d misses, %d files' %
+                                            (self.svg_cache.hits, self.svg_cache.misses, len(self.svg_cache.files))]}
+        check_args(request['args'])
+        shell = InklayersServerShell(request['args'], self)
+        try:
+            shell.fix_wildcard_names()
+            shell.process_files()
+        except Exception as e:
+            return {'status': 1, 'output': shell.output, 'error': '{}: {}'.format(type(e).__name__, e)}
+        return {'status': 0, 'output': shell.output}
+
+    def serve_forever(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.server.server_close()
+        if self.workers is not None:
+            self.workers.stop()
+        family, addr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+
+
+def send_request(address, request):
+    """
+    Sends a request to the render server and returns its reply.
+    """
+    family, addr = parse_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as s:
+        s.connect(addr)
+        s.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with s.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError('No reply from the render server.')
+    return json.loads(line.decode('utf-8'))
+
+
+def run_client(args):
+    """
+    Forwards the command line arguments to the render server and prints its output.
+    Returns the exit status.
+    """
+    address = args.get('address') or default_address()
+    args = dict(args)
+    args['infiles'] = [os.path.abspath(f) for f in args.get('infiles')]
+    try:
+        reply = send_request(address, {'args': args})
+    except (ConnectionError, FileNotFoundError) as e:
+        print('Unable to reach the render server at {}: {}'.format(address, e), file=sys.stderr)
+        return 2
+    for line in reply.get('output', []):
+        print(line)
+    if reply.get('error'):
+        print(reply['error'], file=sys.stderr)
+    return reply.get('status', 1)
+
+
+def serve_main(argv=None):
+    parser = argparse.ArgumentParser(prog='inklayers serve',
+                                     description='Runs the inklayers render server. Use "inklayers --client" to send commands.')
+    p_add = parser.add_argument
+    p_add('--address', action='store', default=default_address(),
+          help='Unix socket path, port or host:port to listen on.')
+    p_add('-i', '--inkscape', action='store', default='Default',
+          help='Path to inkscape command line executable')
+    p_add('-w', '--workers', action='store', type=int, default=2,
+          help='Number of warm inkscape processes.')
+    p_add('-c', '--cache-size', action='store', type=int, default=32,
+          help='Number of parsed SVG files kept in memory.')
+    p_add('--allow-remote', action='store_true', default=False,
+          help='Listen on a TCP address that is not a loopback one. Any client reaching it can export files as the server user.')
+    args = parser.parse_args(argv)
+    server = RenderServer(args.address, args.inkscape, args.workers, args.cache_size, args.allow_remote)
+    print('inklayers render server listening on %s' % args.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
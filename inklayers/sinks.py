@@ -0,0 +1,277 @@
+"""
+Output sinks of inklayers.
+
+The output files are written to a folder, replaced only when their content
+changes, or streamed into an archive or kept in memory.
+"""
+import abc
+import json
+import os
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import zipfile
+
+from .cache import get_file_digest
+
+
+# creation dates embedded in the exported files, ignored when the files are compared
+creation_dates = {
+    '.pdf': re.compile(rb'/(CreationDate|ModDate)\s*\(D:[^)]*\)'),
+    '.ps': re.compile(rb'^%%CreationDate:[^\r\n]*'),
+    '.eps': re.compile(rb'^%%CreationDate:[^\r\n]*'),
+}
+
+
+def same_content(path1, path2):
+    """
+    Checks whether two files have the same content: their sizes are compared first,
+    then their hashes. The creation dates of PDF and PostScript files are ignored.
+    """
+    if os.path.getsize(path1) != os.path.getsize(path2):
+        return False
+    ignored = creation_dates.get(os.path.splitext(path2)[1].lower())
+    return get_file_digest(path1, ignored) == get_file_digest(path2, ignored)
+
+
+def replace_if_changed(new, path):
+    """
+    Moves the file *new* to *path*, unless *path* has the same content: in that case
+    *new* is removed and *path* keeps its modification time.
+    Returns True if *path* was replaced.
+    """
+    if os.path.exists(path) and same_content(new, path):
+        os.remove(new)
+        return False
+    os.replace(new, path)
+    return True
+
+
+class DirectorySink:
+    """
+    Output sink writing the output files to a folder.
+    The files are replaced only when their content changes, so that their modification
+    time can be used by the build tools: the new files are written next to the old ones
+    and compared with them.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.unchanged = 0
+        os.makedirs(path, exist_ok=True)
+
+    def work_path(self, name):
+        """
+        Returns the path of the file *name*, to be read by external programs (inkscape).
+        """
+        return os.path.join(self.path, name)
+
+    def new_path(self, name):
+        """
+        Returns the path where a new version of the file *name* is written by external programs.
+        The extension is kept, as some programs use it to choose the file format.
+        """
+        folder, base = os.path.split(name)
+        return os.path.join(self.path, folder, '.new-' + base)
+
+    def write(self, name, data):
+        with open(self.new_path(name), 'wb') as f:
+            f.write(data)
+        self.collect([name])
+
+    def collect(self, names):
+        """
+        Called when the files *names* have been written to their new path.
+        """
+        for name in names:
+            new = self.new_path(name)
+            if os.path.exists(new) and not replace_if_changed(new, self.work_path(name)):
+                self.unchanged += 1
+
+    def copy(self, source, name):
+        """
+        Makes the file *name* a copy of *source*. Hard links are used when possible.
+        """
+        src = self.work_path(source)
+        dst = self.work_path(name)
+        if os.path.exists(dst) and (os.path.samefile(src, dst) or same_content(src, dst)):
+            self.unchanged += 1
+            return
+        self.link(source, name)
+        os.replace(self.new_path(name), dst)
+
+    def link(self, source, name):
+        """
+        Makes the new version of the file *name* (see new_path) a hard link to *source*,
+        or a copy of it if hard links are not supported.
+        """
+        new = self.new_path(name)
+        if os.path.lexists(new):
+            os.remove(new)
+        try:
+            os.link(self.work_path(source), new)
+        except OSError:
+            shutil.copyfile(self.work_path(source), new)
+
+    def close(self):
+        pass
+
+
+class StagingSink(DirectorySink, metaclass=abc.ABCMeta):
+    """
+    Output sink whose files are written to a private staging folder and stored
+    elsewhere by the *store* method as soon as they are complete.
+    The staging folder is removed when the sink is closed.
+    Subclasses implement *store*.
+    """
+    def __init__(self):
+        DirectorySink.__init__(self, tempfile.mkdtemp(prefix='inklayers-'))
+        self.lock = threading.Lock()
+
+    def new_path(self, name):
+        return self.work_path(name)
+
+    def write(self, name, data):
+        with open(self.work_path(name), 'wb') as f:
+            f.write(data)
+        self.collect([name])
+
+    def collect(self, names):
+        with self.lock:
+            for name in names:
+                self.store(name, self.work_path(name))
+
+    def copy(self, source, name):
+        shutil.copyfile(self.work_path(source), self.work_path(name))
+        self.collect([name])
+
+    @abc.abstractmethod
+    def store(self, name, path):
+        """
+        Stores the complete file *name*, found at *path* in the staging folder.
+        """
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class ArchiveSink(StagingSink):
+    """
+    Output sink streaming the output files into a zip or tar archive.
+    The archive type follows the extension of *target* (.zip, .tar, .tar.gz, .tgz);
+    '-' writes a tar stream to stdout.
+    """
+    def __init__(self, target):
+        StagingSink.__init__(self)
+        stream = sys.stdout.buffer if target == '-' else None
+        if target.endswith('.zip'):
+            self.archive = zipfile.ZipFile(stream or target, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            mode = 'w|gz' if target.endswith(('.tar.gz', '.tgz')) else 'w|'
+            self.archive = tarfile.open(None if stream else target, mode, fileobj=stream)
+
+    def store(self, name, path):
+        if isinstance(self.archive, zipfile.ZipFile):
+            self.archive.write(path, name)
+        else:
+            self.archive.add(path, name)
+
+    def close(self):
+        self.archive.close()
+        StagingSink.close(self)
+
+
+class MemorySink(StagingSink):
+    """
+    Output sink keeping the output files in the *files* dictionary {name: bytes}.
+    """
+    def __init__(self):
+        StagingSink.__init__(self)
+        self.files = {}
+
+    def store(self, name, path):
+        with open(path, 'rb') as f:
+            self.files[name] = f.read()
+
+
+class OutputManifest:
+    """
+    Record of the files exported for the slides of an input file in the output folder,
+    keyed by the content and the export settings of the slides.
+    The files of a slide that only changed name (slides inserted, reordered, or a different
+    zero padding of the numbers) can be reused instead of exporting the slide again.
+    Each file (the slide svg too) is recorded with its size and modification time,
+    so that the files changed by other programs are neither reused nor removed.
+    """
+    def __init__(self, folder, path):
+        self.folder = folder
+        self.path = path
+        # {key: [(name, size, mtime)]} and [(name, size, mtime)] of the svg files of the previous run,
+        # and [(key, svg name, export names)] of this one
+        self.previous = {}
+        self.previous_svgs = []
+        self.current = []
+        try:
+            with open(path) as f:
+                entries = json.load(f)['slides']
+            for entry in entries:
+                self.previous[entry['key']] = [tuple(x) for x in entry['files']]
+                # older manifests have the svg name only: the file is left alone
+                if isinstance(entry['svg'], list):
+                    self.previous_svgs.append(tuple(entry['svg']))
+        except (OSError, ValueError, KeyError, TypeError):
+            self.previous = {}
+            self.previous_svgs = []
+
+    def stat(self, name):
+        """
+        Returns the (name, size, mtime) record of the file *name*, or None if it does not exist.
+        """
+        try:
+            st = os.stat(os.path.join(self.folder, name))
+        except OSError:
+            return None
+        return (name, st.st_size, st.st_mtime_ns)
+
+    def find(self, key):
+        """
+        Returns the names of the files exported in the previous run for *key*,
+        or None if some of them was removed or changed since then.
+        """
+        files = self.previous.get(key)
+        if not files or any(self.stat(f[0]) != f for f in files):
+            return None
+        return [f[0] for f in files]
+
+    def add(self, key, svg, names):
+        self.current.append((key, svg, names))
+
+    def get_stale(self):
+        """
+        Returns the names of the files of the previous run that are not produced any more,
+        and that were not changed since then.
+        """
+        produced = set()
+        for key, svg, names in self.current:
+            produced.add(svg)
+            produced.update(names)
+        stale = [f[0] for f in self.previous_svgs if f[0] not in produced and self.stat(f[0]) == f]
+        for files in self.previous.values():
+            stale += [f[0] for f in files if f[0] not in produced and self.stat(f[0]) == f]
+        return sorted(set(stale))
+
+    def save(self):
+        """
+        Writes the files of this run that exist, with their size and modification time.
+        """
+        entries = []
+        for key, svg, names in self.current:
+            files = [self.stat(name) for name in names]
+            if None not in files:
+                entries.append({'key': key, 'svg': svg and self.stat(svg), 'files': files})
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'slides': entries}, f, indent=1)
+        os.replace(tmp, self.path)